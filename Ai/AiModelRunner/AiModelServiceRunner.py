@@ -9,6 +9,7 @@ import warnings
 
 # Import the shared model core
 from ai_model_core import get_model_instance
+from ai_model_protocol import ProtocolSession, parse_hello
 
 
 def main_c_sharp_mode(model_core):
@@ -30,6 +31,15 @@ def main_c_sharp_mode(model_core):
                 sys.stdout.flush()
                 break
 
+            # {"protocol": 1} switches to pipelined JSON lines with request ids ("stream": true streams)
+            hello = parse_hello(input_line)
+            if hello is not None:
+                session = ProtocolSession(model_core)
+                if session.handshake(hello):
+                    session.serve()
+                    break
+                continue
+
             # Generate response
             response = model_core.generate_response(input_line)
 
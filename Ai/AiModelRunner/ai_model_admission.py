@@ -0,0 +1,86 @@
+"""
+Admission control for the AI model server.
+Bounds the number of generation requests queued or running at once so that
+overload is answered immediately with 429 + Retry-After instead of piling up
+threads behind the model.
+"""
+
+import contextlib
+import math
+import threading
+import time
+from typing import Dict, Any
+
+
+class QueueFullError(Exception):
+    """Raised when a request arrives while the request queue is full."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is at capacity, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Bounded request queue shared by all generation endpoints."""
+
+    def __init__(self, max_queue_depth: int = 64, min_retry_after: int = 1):
+        """
+        Initialize the controller.
+
+        Args:
+            max_queue_depth: Maximum requests queued or in generation (0 = unlimited)
+            min_retry_after: Smallest Retry-After value in seconds
+        """
+        self.max_queue_depth = max_queue_depth
+        self.min_retry_after = min_retry_after
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # Exponentially weighted average request latency, used for Retry-After
+        self._latency_ewma = 0.0
+        self._stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "completed": 0
+        }
+
+    def acquire(self):
+        """Admit a request or raise QueueFullError."""
+        with self._lock:
+            if self.max_queue_depth and self._in_flight >= self.max_queue_depth:
+                self._stats["rejected"] += 1
+                raise QueueFullError(self._retry_after())
+            self._in_flight += 1
+            self._stats["admitted"] += 1
+
+    def release(self, latency: float = None):
+        """Mark an admitted request as finished."""
+        with self._lock:
+            self._in_flight -= 1
+            self._stats["completed"] += 1
+            if latency is not None:
+                self._latency_ewma = latency if not self._latency_ewma else \
+                    0.9 * self._latency_ewma + 0.1 * latency
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Hold a queue slot for the duration of a with-block."""
+        self.acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.release(time.perf_counter() - started)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get admission counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = self._in_flight
+            stats["average_latency"] = self._latency_ewma
+        stats["max_queue_depth"] = self.max_queue_depth
+        return stats
+
+    def _retry_after(self) -> int:
+        # Roughly when the current backlog should have drained one request
+        return max(self.min_retry_after, math.ceil(self._latency_ewma))
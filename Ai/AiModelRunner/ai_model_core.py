@@ -9,8 +9,18 @@ import os
 import warnings
 import logging
 import contextlib
+import copy
 import io
-from typing import Optional, Dict, Any
+import json
+import math
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Set, Tuple, Iterator, Sequence
+
+from ai_model_metrics import time_stage, observe_stage, record_generation, ADAPTER_RELOADS
+from ai_model_threads import DEFAULT_THREAD_CONFIG, load_thread_config, apply_thread_settings
 
 # Suppress all warnings
 warnings.filterwarnings('ignore')
@@ -23,6 +33,135 @@ logging.getLogger('transformers.tokenization_utils').setLevel(logging.ERROR)
 logging.getLogger('peft').setLevel(logging.ERROR)
 logging.getLogger('bitsandbytes').setLevel(logging.ERROR)
 
+# Written by merge_adapters.py next to a merged checkpoint
+MERGED_ADAPTER_FILE = "merged_adapter.json"
+
+# Written by ai_model_snapshot.py into a compiled snapshot directory
+SNAPSHOT_MANIFEST = "snapshot.json"
+SNAPSHOT_WEIGHTS = "weights.pt"
+DEFAULT_SNAPSHOT_DIR = "./model_snapshot"
+
+# Supported values for AiModelCore(precision=...)
+PRECISIONS = ("float32", "bfloat16", "int8")
+
+# Adapter names: adapter_path is loaded as DEFAULT_ADAPTER; requests pick BASE_ADAPTER to skip all adapters
+DEFAULT_ADAPTER = "default"
+BASE_ADAPTER = "base"
+# peft's name for "no adapter" in a mixed-adapter batch
+_PEFT_BASE_ADAPTER = "__base__"
+
+# Prompt run through reloaded adapters before they are swapped in
+ADAPTER_PROBE_PROMPT = "Please suggest a habit that can be tracked"
+
+SYSTEM_PROMPT = "You are a helpful habit tracking assistant. Provide concise, actionable responses."
+
+# Placeholder used to split a rendered chat template into shared prefix and user suffix
+_PREFIX_SENTINEL = "<<USER_INPUT>>"
+
+# Prompt truncation length in tokens
+MAX_INPUT_LENGTH = 512
+
+# Generation stops here by default: _clean_response keeps only the first line
+DEFAULT_STOP_SEQUENCES = ("\n",)
+
+# Start of the response text generate_response/generate_batch return when generation fails
+ERROR_PREFIX = "An error occurred:"
+
+# Fixed prompt set for offline checks: the production habit prompt plus the prompts used by the C# tests
+SAMPLE_PROMPTS = [
+    "Please suggest a habit that can be tracked",
+    "Suggest a morning habit",
+    "Suggest an evening habit",
+    "Suggest a weekend habit",
+    "Can you tell me about yourself?",
+    "Can you tell me one good joke?",
+    "Do you have an opinion on jokes?",
+    "Can you tell me something smart?",
+]
+
+# torch, imported once by _import_torch()
+_torch = None
+
+# Per-row adapter names for the model calls of the current thread (see AiModelCore._use_adapters)
+_adapter_selection = threading.local()
+
+
+def _import_torch():
+    """Import torch once with its import-time output suppressed, keeping the import off the request path."""
+    global _torch
+    if _torch is None:
+        with contextlib.redirect_stderr(io.StringIO()):
+            import torch
+        _torch = torch
+    return _torch
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's deadline passes or it is cancelled before generation finishes."""
+    
+    def __init__(self, message: str = "Request deadline exceeded"):
+        super().__init__(message)
+
+
+class AdapterReloadError(Exception):
+    """Raised when reloaded adapter weights fail to load or validate; the previous weights stay live."""
+
+
+def _positive_int(value) -> int:
+    """int(value) for integers and integral floats or strings; ValueError for anything else."""
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(value)
+    return int(number)
+
+
+# Numeric overrides: converter, accepted range, and the error message's description
+_NUMERIC_OVERRIDES = (
+    ("temperature", float, lambda value: 0 < value < math.inf, "a positive number"),
+    ("top_p", float, lambda value: 0 < value <= 1, "a number above 0 and at most 1"),
+    ("max_new_tokens", _positive_int, lambda value: value >= 1, "a positive integer"),
+)
+
+
+def validate_generation_overrides(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Check and coerce the numeric generation overrides of a request.
+    
+    Args:
+        params: Generation overrides, e.g. from a request body
+        
+    Returns:
+        A copy of params with temperature and top_p as floats and max_new_tokens as an int
+        
+    Raises:
+        ValueError: An override is not a number or is out of range
+    """
+    params = dict(params)
+    for name, convert, in_range, expected in _NUMERIC_OVERRIDES:
+        if name not in params:
+            continue
+        value = params[name]
+        try:
+            # JSON true/false would otherwise pass as 1 and 0
+            if isinstance(value, bool):
+                raise ValueError(value)
+            number = convert(value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"'{name}' must be {expected}")
+        if not in_range(number):
+            raise ValueError(f"'{name}' must be {expected}")
+        params[name] = number
+    return params
+
+
+def _select_adapters_hook(module, args, kwargs):
+    """Forward pre-hook on LoRA layers passing the calling thread's per-row adapter names."""
+    adapter_names = getattr(_adapter_selection, "adapter_names", None)
+    if adapter_names is None:
+        return None
+    kwargs["adapter_names"] = adapter_names
+    return args, kwargs
+
 
 class AiModelCore:
     """Core AI model class that handles model loading and text generation."""
@@ -33,7 +172,16 @@ class AiModelCore:
                  device: str = "cpu",
                  max_new_tokens: int = 10,
                  temperature: float = 0.5,
-                 top_p: float = 0.9):
+                 top_p: float = 0.9,
+                 prefix_cache: bool = True,
+                 merge_adapters: bool = False,
+                 precision: str = "float32",
+                 snapshot_dir: Optional[str] = DEFAULT_SNAPSHOT_DIR,
+                 prompt_cache_size: int = 256,
+                 stop_sequences: Sequence[str] = DEFAULT_STOP_SEQUENCES,
+                 num_threads: Optional[int] = None,
+                 thread_config: Optional[str] = DEFAULT_THREAD_CONFIG,
+                 adapters: Optional[Dict[str, str]] = None):
         """
         Initialize the AI model core.
         
@@ -44,55 +192,573 @@ class AiModelCore:
             max_new_tokens: Maximum tokens to generate
             temperature: Sampling temperature
             top_p: Nucleus sampling parameter
+            prefix_cache: Precompute KV-cache for the shared chat-template prefixes
+            merge_adapters: Fold LoRA adapters into the base weights after loading
+            precision: Weight precision - 'float32', 'bfloat16' or 'int8'
+                (dynamic quantization of Linear layers, CPU only)
+            snapshot_dir: Compiled snapshot to load instead of from_pretrained when it
+                matches model_name, adapter_path and precision (see ai_model_snapshot.py)
+            prompt_cache_size: Tokenized prompts kept for repeated inputs (0 disables)
+            stop_sequences: Strings that end generation by default; a request's `stop`
+                override replaces them (`stop=[]` disables them)
+            num_threads: Intra-op threads, overriding thread_config
+            thread_config: Tuned thread settings written by tune_threads.py, applied when
+                present (None leaves torch's thread counts alone)
+            adapters: More LoRA adapters to load on the same base weights, by name; requests
+                choose one with the `adapter` override (adapter_path is named "default")
         """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+        adapters = dict(adapters or {})
+        for name in adapters:
+            if name in (DEFAULT_ADAPTER, BASE_ADAPTER) or name.startswith("__"):
+                raise ValueError(f"Adapter name '{name}' is reserved")
+        if adapters and merge_adapters:
+            raise ValueError("merge_adapters cannot be combined with extra adapters")
+        
         self.model_name = model_name
         self.adapter_path = adapter_path
         self.device = device
         self.max_new_tokens = max_new_tokens
         self.temperature = temperature
         self.top_p = top_p
+        self.prefix_cache = prefix_cache
+        self.merge_adapters = merge_adapters
+        self.precision = precision
+        self.snapshot_dir = snapshot_dir
+        self.stop_sequences = list(stop_sequences)
+        self.extra_adapters = adapters
+        self.num_threads = num_threads
+        self.thread_config = thread_config
         
         self.model = None
         self.tokenizer = None
+        self.adapter_loaded = False
+        self.adapters_merged = False
+        # Adapter name -> path for every LoRA adapter loaded on the base model
+        self.adapters: Dict[str, str] = {}
+        # Adapter name -> adapter_fingerprint() of the files it was last loaded from
+        self.adapter_fingerprints: Dict[str, Tuple] = {}
+        # Adapter name -> outcome of its last reload or rollback
+        self.adapter_reloads: Dict[str, Dict[str, Any]] = {}
+        # Adapter name -> peft adapter serving it after a reload (the name itself until then)
+        self._live_adapters: Dict[str, str] = {}
+        # Adapter name -> (peft adapter, path) it replaced, kept for rollback_adapter()
+        self._previous_adapters: Dict[str, Tuple[str, str]] = {}
+        self._reload_lock = threading.Lock()
+        self._reload_count = 0
+        # peft adapter -> requests generating with it (see acquire_adapter)
+        self._adapter_users: Dict[str, int] = {}
+        # Replaced peft adapters waiting for their last request before they are deleted
+        self._retiring_adapters: Set[str] = set()
+        self._adapter_users_lock = threading.Lock()
+        # Set when model_name is a checkpoint written by merge_adapters.py
+        self.merged_from: Optional[Dict[str, Any]] = None
+        # Set when the weights came from a compiled snapshot
+        self.snapshot_loaded: Optional[str] = None
+        # Startup stage -> seconds
+        self.load_timings: Dict[str, float] = {}
+        # Thread counts in effect after loading, and where they came from
+        self.thread_settings: Dict[str, Any] = {}
+        # (template variant, adapter) -> (prefix token ids, past_key_values)
+        self._prefix_caches: Dict[Tuple[str, Optional[str]], Tuple[List[int], Any]] = {}
+        # (template variant, prompt text, truncation length) -> tokenized prompt on the model device
+        self._prompt_cache = _PromptCache(prompt_cache_size)
+        
+        started = time.perf_counter()
         self._load_model()
+        
+        if self.prefix_cache:
+            stage_started = time.perf_counter()
+            self._build_prefix_caches()
+            self.load_timings["prefix_cache"] = time.perf_counter() - stage_started
+        
+        self.load_timings["total"] = time.perf_counter() - started
+        print("Startup timings: " + " | ".join(
+            f"{stage} {seconds:.2f}s" for stage, seconds in self.load_timings.items()))
     
     def _load_model(self):
         """Load the model and tokenizer with all suppressions."""
+        timings = self.load_timings
+        
         # Import transformers with suppression
+        stage_started = time.perf_counter()
         with contextlib.redirect_stderr(io.StringIO()):
             from transformers import AutoTokenizer, AutoModelForCausalLM
-            from peft import PeftModel
-            import torch
             import transformers
             transformers.logging.set_verbosity_error()
+        torch = _import_torch()
+        timings["import"] = time.perf_counter() - stage_started
+        
+        # Before any model work, so the inter-op pool can still be sized
+        self._configure_threads()
+        
+        snapshot = self._find_snapshot()
         
         print(f"Loading tokenizer for {self.model_name}...")
+        stage_started = time.perf_counter()
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(snapshot[0] if snapshot else self.model_name)
+        
+        # Left padding keeps the last position of every row aligned for batched decoding
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        timings["tokenizer"] = time.perf_counter() - stage_started
         
-        print(f"Loading base model...")
+        stage_started = time.perf_counter()
+        if snapshot:
+            self._load_snapshot(*snapshot)
+            timings["weights"] = time.perf_counter() - stage_started
+        else:
+            print(f"Loading base model...")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                with contextlib.redirect_stderr(io.StringIO()):
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                        self.model_name,
+                        # float32 on CPU unless bfloat16 was requested; int8 quantizes float32 weights
+                        torch_dtype=torch.bfloat16 if self.precision == "bfloat16" else torch.float32,
+                        device_map=self.device,
+                        low_cpu_mem_usage=True,
+                        trust_remote_code=True,  # Required for Phi-3.5
+                        code_revision=None  # Use latest code revision with security patches
+                    )
+            timings["weights"] = time.perf_counter() - stage_started
+            
+            stage_started = time.perf_counter()
+            self._load_adapters()
+            timings["adapter"] = time.perf_counter() - stage_started
+        
+        if self.precision == "int8":
+            stage_started = time.perf_counter()
+            self._quantize_int8()
+            timings["quantize"] = time.perf_counter() - stage_started
+    
+    def _find_snapshot(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Return (directory, manifest) of a compiled snapshot usable for this configuration."""
+        # model_name may point straight at a snapshot
+        manifest_path = os.path.join(self.model_name, SNAPSHOT_MANIFEST)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                return self.model_name, json.load(f)
+        
+        if not self.snapshot_dir:
+            return None
+        if self.extra_adapters:
+            # Snapshots have the default adapter merged in; extra adapters need the plain base weights
+            return None
+        manifest_path = os.path.join(self.snapshot_dir, SNAPSHOT_MANIFEST)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        
+        adapter = os.path.abspath(self.adapter_path) if os.path.exists(self.adapter_path) else None
+        dtype = "bfloat16" if self.precision == "bfloat16" else "float32"
+        if (manifest.get("model_name") != self.model_name
+                or manifest.get("adapter_path") != adapter
+                or manifest.get("dtype") != dtype):
+            print(f"Snapshot at {self.snapshot_dir} does not match this configuration, ignoring it")
+            return None
+        
+        # Adapters retrained after the snapshot was compiled make it stale
+        if adapter and _newest_mtime(adapter) > manifest.get("created", 0):
+            print(f"Snapshot at {self.snapshot_dir} is older than {self.adapter_path}, ignoring it")
+            return None
+        
+        return self.snapshot_dir, manifest
+    
+    def _load_snapshot(self, snapshot_dir: str, manifest: Dict[str, Any]):
+        """Build the model skeleton without allocating weights, then map the snapshot weights in lazily."""
+        with contextlib.redirect_stderr(io.StringIO()):
+            from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+            import torch
+        
+        print(f"Loading model snapshot from {snapshot_dir}...")
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
             with contextlib.redirect_stderr(io.StringIO()):
-                self.model = AutoModelForCausalLM.from_pretrained(
-                    self.model_name,
-                    torch_dtype=torch.float32,  # Force float32 for CPU
-                    device_map=self.device,
-                    low_cpu_mem_usage=True,
-                    trust_remote_code=True,  # Required for Phi-3.5
-                    code_revision=None  # Use latest code revision with security patches
-                )
+                config = AutoConfig.from_pretrained(snapshot_dir, trust_remote_code=True)
+                with torch.device("meta"):
+                    model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+        
+        # mmap=True leaves the tensors backed by the page cache; pages are read on first touch
+        saved = torch.load(os.path.join(snapshot_dir, SNAPSHOT_WEIGHTS), mmap=True, weights_only=True)
+        model.load_state_dict(saved["state_dict"], assign=True, strict=True)
+        
+        # Non-persistent buffers (e.g. rotary frequencies) are not in the state dict
+        for key, tensor in saved["extra_tensors"].items():
+            module_name, _, attribute = key.rpartition(".")
+            module = model.get_submodule(module_name)
+            if attribute in module._buffers:
+                module._buffers[attribute] = tensor
+            else:
+                setattr(module, attribute, tensor)
+        
+        if os.path.isfile(os.path.join(snapshot_dir, "generation_config.json")):
+            model.generation_config = GenerationConfig.from_pretrained(snapshot_dir)
+        
+        if self.precision == "bfloat16" and manifest.get("dtype") != "bfloat16":
+            model = model.to(torch.bfloat16)
+        elif self.precision != "bfloat16" and manifest.get("dtype") == "bfloat16":
+            model = model.to(torch.float32)
+        if self.device != "cpu":
+            model = model.to(self.device)
+        
+        self.model = model.eval()
+        self.snapshot_loaded = snapshot_dir
+        if manifest.get("adapter_path"):
+            self.merged_from = {
+                "base_model": manifest.get("model_name"),
+                "adapter_path": manifest.get("adapter_path")
+            }
+    
+    def _load_adapters(self):
+        """Load (and optionally merge) LoRA adapters on top of the base model."""
+        # A merged checkpoint already contains its adapters; loading them again would apply them twice
+        merged_info_path = os.path.join(self.model_name, MERGED_ADAPTER_FILE)
+        if os.path.isfile(merged_info_path):
+            with open(merged_info_path) as f:
+                self.merged_from = json.load(f)
+            if self.extra_adapters:
+                raise ValueError(f"{self.model_name} has adapters merged in; extra adapters need the base model")
+            print(f"Using merged checkpoint (adapters from {self.merged_from.get('adapter_path')})")
+            return
         
         # Load LoRA adapters if available
         if os.path.exists(self.adapter_path):
             print(f"Loading LoRA adapters from {self.adapter_path}...")
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                self.model = PeftModel.from_pretrained(self.model, self.adapter_path)
+            self._load_adapter(DEFAULT_ADAPTER, self.adapter_path)
+            self.adapter_loaded = True
             print("LoRA adapters loaded successfully")
+            
+            if self.merge_adapters:
+                # Fold the LoRA deltas into the base weights so decoding skips the extra matmuls
+                print("Merging LoRA adapters into base weights...")
+                self.model = self.model.merge_and_unload()
+                self.adapters_merged = True
         else:
             print(f"No LoRA adapters found at {self.adapter_path}, using base model")
+        
+        # Further adapters share the base weights; only their LoRA matrices take extra memory
+        for name, path in self.extra_adapters.items():
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No LoRA adapters found at {path} for adapter '{name}'")
+            print(f"Loading LoRA adapters '{name}' from {path}...")
+            self._load_adapter(name, path)
+        if self.extra_adapters:
+            print(f"Adapters loaded: {', '.join(self.adapters)}")
+    
+    def _load_adapter(self, name: str, path: str):
+        """Add a named LoRA adapter, wrapping the base model in a PeftModel for the first one."""
+        fingerprint = adapter_fingerprint(path)
+        self._add_lora_weights(name, path)
+        self.adapters[name] = path
+        self.adapter_fingerprints[name] = fingerprint
+    
+    def _add_lora_weights(self, peft_name: str, path: str) -> List[str]:
+        """
+        Load LoRA weights from path as a peft adapter.
+        
+        Returns:
+            State dict keys of the adapter that the files did not contain
+        """
+        with contextlib.redirect_stderr(io.StringIO()):
+            from peft import PeftModel
+            from peft.tuners.lora import LoraLayer
+            from peft.utils import ModulesToSaveWrapper
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            if isinstance(self.model, PeftModel):
+                load_result = self.model.load_adapter(path, adapter_name=peft_name)
+            else:
+                self.model = PeftModel.from_pretrained(self.model, path, adapter_name=peft_name)
+                load_result = None
+        
+        # Adapters can bring new LoRA layers; every layer reads the per-thread selection
+        for module in self.model.modules():
+            if isinstance(module, (LoraLayer, ModulesToSaveWrapper)) and not getattr(module, "_selects_adapters", False):
+                module.register_forward_pre_hook(_select_adapters_hook, with_kwargs=True)
+                module._selects_adapters = True
+        return list(getattr(load_result, "missing_keys", []))
+    
+    def _remove_lora_weights(self, peft_name: str):
+        """Delete a peft adapter and its prefix caches."""
+        # Rows without an explicit adapter (None) ran on the startup default
+        stale = {peft_name, None} if peft_name == DEFAULT_ADAPTER else {peft_name}
+        for key in [key for key in self._prefix_caches if key[1] in stale]:
+            del self._prefix_caches[key]
+        if peft_name not in getattr(self.model, "peft_config", {}):
+            return
+        was_active = peft_name in self.model.active_adapters
+        self.model.delete_adapter(peft_name)
+        if was_active and DEFAULT_ADAPTER in self._live_adapters:
+            # Keep rows without an explicit adapter on the live default
+            self.model.set_adapter(self._live_adapters[DEFAULT_ADAPTER])
+    
+    def reload_adapter(self, name: str = DEFAULT_ADAPTER, path: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Load new weights for a LoRA adapter while requests keep being served.
+        
+        The new weights are loaded next to the current ones, run on a probe prompt and
+        given their own prefix caches before they are swapped in. Requests resolved after
+        the swap use them; requests already generating finish on the old weights, which
+        are kept for rollback_adapter() until the next reload.
+        
+        Args:
+            name: Adapter to reload ("default" is adapter_path)
+            path: Directory to load from (default: the adapter's current path)
+            
+        Returns:
+            The reload outcome, also kept in adapter_reloads
+            
+        Raises:
+            ValueError: Unknown adapter, or adapters that are merged into the weights
+            FileNotFoundError: Nothing at path
+            AdapterReloadError: The new weights failed to load or validate
+        """
+        with self._reload_lock:
+            self._check_reloadable(name)
+            path = path or self.adapters[name]
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No LoRA adapters found at {path}")
+            
+            # Taken first, so files rewritten during the load count as changed again
+            fingerprint = adapter_fingerprint(path)
+            self._reload_count += 1
+            # Reserved prefix, so it cannot clash with a user-chosen adapter name
+            staged = f"__{name}_{self._reload_count}"
+            print(f"Reloading LoRA adapters '{name}' from {path}...")
+            started = time.perf_counter()
+            try:
+                missing_keys = self._add_lora_weights(staged, path)
+                if missing_keys:
+                    raise ValueError(f"{len(missing_keys)} LoRA weights missing, e.g. {missing_keys[0]}")
+                self._validate_adapter(staged)
+                if self.prefix_cache:
+                    self._build_prefix_caches([staged])
+            except Exception as e:
+                self._remove_lora_weights(staged)
+                ADAPTER_RELOADS.inc(adapter=name, status="failed")
+                self.adapter_reloads[name] = {
+                    "status": "failed",
+                    "path": path,
+                    "error": str(e),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+                }
+                print(f"Reloading '{name}' failed, still serving {self.adapters[name]}: {e}")
+                raise AdapterReloadError(f"Reloading adapter '{name}' from {path} failed: {e}") from e
+            
+            # The swap: one assignment, read once per request by resolve_adapter()
+            replaced = (self._live_adapters.get(name, name), self.adapters[name])
+            self._live_adapters[name] = staged
+            self.adapters[name] = path
+            self.adapter_fingerprints[name] = fingerprint
+            if name == DEFAULT_ADAPTER:
+                self.adapter_path = path
+            
+            # Weights from two reloads ago; sequences resolved to them may still be decoding
+            retired = self._previous_adapters.get(name)
+            self._previous_adapters[name] = replaced
+            if retired is not None:
+                with self._adapter_users_lock:
+                    self._retiring_adapters.add(retired[0])
+            self._delete_retired_adapters()
+            
+            ADAPTER_RELOADS.inc(adapter=name, status="reloaded")
+            self.adapter_reloads[name] = {
+                "status": "reloaded",
+                "path": path,
+                "version": self._reload_count,
+                "seconds": time.perf_counter() - started,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+            print(f"Adapter '{name}' reloaded in {self.adapter_reloads[name]['seconds']:.2f}s")
+            return dict(self.adapter_reloads[name], adapter=name)
+    
+    def rollback_adapter(self, name: str = DEFAULT_ADAPTER) -> Dict[str, Any]:
+        """
+        Swap an adapter back to the weights its last reload replaced (calling it again
+        swaps forward).
+        
+        Raises:
+            ValueError: Unknown adapter, or no reload to roll back
+        """
+        with self._reload_lock:
+            self._check_reloadable(name)
+            previous = self._previous_adapters.get(name)
+            if previous is None:
+                raise ValueError(f"Adapter '{name}' has not been reloaded, nothing to roll back to")
+            
+            peft_name, path = previous
+            self._previous_adapters[name] = (self._live_adapters.get(name, name), self.adapters[name])
+            if peft_name == name:
+                # Back on the weights loaded at startup
+                del self._live_adapters[name]
+            else:
+                self._live_adapters[name] = peft_name
+            self.adapters[name] = path
+            # The files now at path count as handled, so a watcher does not load the rolled-back ones again
+            self.adapter_fingerprints[name] = adapter_fingerprint(path)
+            if name == DEFAULT_ADAPTER:
+                self.adapter_path = path
+            
+            ADAPTER_RELOADS.inc(adapter=name, status="rolled_back")
+            self.adapter_reloads[name] = {
+                "status": "rolled_back",
+                "path": path,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+            }
+            print(f"Adapter '{name}' rolled back to {path}")
+            return dict(self.adapter_reloads[name], adapter=name)
+    
+    def _check_reloadable(self, name: str):
+        """Raise ValueError unless name is a LoRA adapter that can be swapped at runtime."""
+        if self.adapters_merged or self.merged_from is not None:
+            raise ValueError("The adapters are merged into the weights; restart to load new ones")
+        if self.precision == "int8":
+            # peft cannot add LoRA layers on top of dynamically quantized Linear layers
+            raise ValueError("Adapters cannot be reloaded into an int8 model; restart to load new ones")
+        if not self.adapters:
+            raise ValueError("No LoRA adapters were loaded at startup, so there are none to reload")
+        if name not in self.adapters:
+            raise ValueError(f"Unknown adapter '{name}', available: {', '.join(self.adapters)}")
+    
+    def _validate_adapter(self, peft_name: str):
+        """Run the probe prompt through a loaded adapter and check its logits are finite."""
+        torch = _import_torch()
+        _, _, inputs = self.tokenize_prompt(ADAPTER_PROBE_PROMPT)
+        with torch.no_grad(), self._use_adapters([peft_name]):
+            logits = self.model(**inputs).logits
+        if not bool(torch.isfinite(logits).all()):
+            raise ValueError("the probe prompt produced non-finite logits")
+    
+    def resolve_adapter(self, adapter: Optional[str]) -> Optional[str]:
+        """
+        Map a request's `adapter` override to the name passed to the model.
+        
+        Args:
+            adapter: Adapter name, "base" for no adapter, or None for the default
+            
+        Returns:
+            The peft adapter name, or None when the model's default applies and
+            no per-row selection is needed
+            
+        Raises:
+            ValueError: Unknown adapter name
+        """
+        # Only unmerged peft models can switch adapters per row
+        selectable = bool(self.adapters) and not self.adapters_merged
+        if adapter is None or adapter == DEFAULT_ADAPTER:
+            if selectable and DEFAULT_ADAPTER not in self.adapters:
+                # Only extra adapters are loaded; the default is the plain base model
+                return _PEFT_BASE_ADAPTER
+            # Reloaded weights are selected by name; the startup ones are the active adapter
+            return self._live_adapters.get(DEFAULT_ADAPTER)
+        if not isinstance(adapter, str):
+            raise ValueError("'adapter' must be a string")
+        if adapter == BASE_ADAPTER and selectable:
+            return _PEFT_BASE_ADAPTER
+        if adapter == BASE_ADAPTER and not self.adapters and self.merged_from is None:
+            # Nothing loaded: the base model is the default
+            return None
+        if adapter not in self.adapters or not selectable:
+            available = ", ".join(self.adapter_names())
+            raise ValueError(f"Unknown adapter '{adapter}', available: {available}")
+        return self._live_adapters.get(adapter, adapter)
+    
+    def acquire_adapter(self, adapter: Optional[str]) -> Optional[str]:
+        """
+        resolve_adapter(), also marking the peft adapter as in use so a reload does not
+        delete it; pair every call with release_adapter().
+        
+        Raises:
+            ValueError: Unknown adapter name
+        """
+        with self._adapter_users_lock:
+            peft_name = self.resolve_adapter(adapter)
+            # None selects the model's active adapter, i.e. the startup default
+            key = peft_name or DEFAULT_ADAPTER
+            self._adapter_users[key] = self._adapter_users.get(key, 0) + 1
+        return peft_name
+    
+    def release_adapter(self, peft_name: Optional[str]):
+        """Mark one acquire_adapter() use finished; the last user of replaced weights deletes them."""
+        key = peft_name or DEFAULT_ADAPTER
+        with self._adapter_users_lock:
+            users = self._adapter_users.get(key, 0) - 1
+            if users > 0:
+                self._adapter_users[key] = users
+                return
+            self._adapter_users.pop(key, None)
+            if key not in self._retiring_adapters:
+                return
+        # Deleting changes the peft model, so not during a reload; the reload sweeps it up instead
+        if self._reload_lock.acquire(blocking=False):
+            try:
+                self._delete_retired_adapters()
+            finally:
+                self._reload_lock.release()
+    
+    def _delete_retired_adapters(self):
+        """Delete replaced peft adapters no request is using; the caller holds _reload_lock."""
+        with self._adapter_users_lock:
+            idle = [name for name in self._retiring_adapters if name not in self._adapter_users]
+            self._retiring_adapters.difference_update(idle)
+        for peft_name in idle:
+            self._remove_lora_weights(peft_name)
+    
+    def adapter_names(self) -> List[str]:
+        """Names requests can pass as `adapter`."""
+        if self.adapters_merged or self.merged_from is not None:
+            return [DEFAULT_ADAPTER]
+        if not self.adapters:
+            return [DEFAULT_ADAPTER, BASE_ADAPTER]
+        return [DEFAULT_ADAPTER] + [name for name in self.adapters if name != DEFAULT_ADAPTER] + [BASE_ADAPTER]
+    
+    @contextlib.contextmanager
+    def _use_adapters(self, adapters: Sequence[Optional[str]]):
+        """
+        Select an adapter per batch row for the model calls this thread makes inside the block.
+        
+        peft's own `adapter_names` argument hooks the shared LoRA layers for the length of
+        the call, so concurrent calls (request threads, the scheduler, adapter reloads)
+        would see each other's selection; the hooks added by _add_lora_weights read it
+        per thread instead.
+        
+        Args:
+            adapters: resolve_adapter() results, one per row
+        """
+        previous = getattr(_adapter_selection, "adapter_names", None)
+        if all(adapter is None for adapter in adapters):
+            _adapter_selection.adapter_names = None
+        else:
+            # peft splits the batch by adapter inside every LoRA layer
+            _adapter_selection.adapter_names = [adapter or DEFAULT_ADAPTER for adapter in adapters]
+        try:
+            yield
+        finally:
+            _adapter_selection.adapter_names = previous
+    
+    def _quantize_int8(self):
+        """Dynamically quantize Linear layers to int8, leaving unmerged LoRA layers in float."""
+        with contextlib.redirect_stderr(io.StringIO()):
+            import torch
+        
+        # peft's LoRA layers read lora_A/lora_B weights directly, so only base projections are swapped
+        linear_names = {
+            name for name, module in self.model.named_modules()
+            if type(module) is torch.nn.Linear and "lora_" not in name
+        }
+        print(f"Quantizing {len(linear_names)} Linear layers to int8...")
+        self.model = torch.ao.quantization.quantize_dynamic(
+            self.model,
+            {name: torch.ao.quantization.default_dynamic_qconfig for name in linear_names},
+            dtype=torch.qint8,
+            inplace=True  # avoid a transient second copy of the float weights
+        )
     
     def generate_response(self, input_text: str, **kwargs) -> str:
         """
@@ -100,72 +766,445 @@ class AiModelCore:
         
         Args:
             input_text: The input prompt
-            **kwargs: Override default generation parameters
+            **kwargs: Override default generation parameters (plus optional
+                `deadline`/`cancel_event`, see _generation_params)
             
         Returns:
             Generated text response
+            
+        Raises:
+            DeadlineExceeded: The deadline passed or the request was cancelled
         """
         try:
-            # Import torch with suppression
-            with contextlib.redirect_stderr(io.StringIO()):
-                import torch
-                import random
-                import numpy as np
-            
-            # Build messages based on input type
-            if "suggest a habit" in input_text.lower():
-                messages = [
-                    {"role": "user", "content": input_text}
-                ]
-            else:
-                messages = [
-                    {
-                        "role": "system", 
-                        "content": "You are a helpful habit tracking assistant. Provide concise, actionable responses."
-                    },
-                    {"role": "user", "content": input_text}
-                ]
-            
-            # Apply chat template
-            prompt = self.tokenizer.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True
-            )
-            
-            # Tokenize input
-            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512)
-            
-            # Move to correct device
-            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
-            
-            # Get generation parameters
-            gen_params = {
-                "max_new_tokens": kwargs.get("max_new_tokens", self.max_new_tokens),
-                "do_sample": kwargs.get("do_sample", True),
-                "temperature": kwargs.get("temperature", self.temperature),
-                "top_p": kwargs.get("top_p", self.top_p),
-                "pad_token_id": self.tokenizer.pad_token_id,
-                "eos_token_id": self.tokenizer.eos_token_id
-            }
+            torch = _import_torch()
             
-            # Generate response
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                with torch.no_grad():
-                    outputs = self.model.generate(**inputs, **gen_params)
+            inputs, gen_params, adapter = self._prepare_inputs(input_text, **kwargs)
+            try:
+                self._check_deadline(gen_params)
+                timer = _GenerationTimer()
+                gen_params["streamer"] = timer
+                
+                # Generate response
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    with torch.no_grad(), self._use_adapters([adapter]):
+                        outputs = self.model.generate(**inputs, **gen_params)
+                timer.end()
+            finally:
+                self.release_adapter(adapter)
+            self._check_deadline(gen_params)
             
             # Decode response
             generated_tokens = outputs[0][len(inputs['input_ids'][0]):]
-            response = self.tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
+            with time_stage("detokenize"):
+                response = self.tokenizer.decode(generated_tokens, skip_special_tokens=True)
+                response = self._truncate_at_stop(response, **kwargs).strip()
             
             # Clean up response
-            response = self._clean_response(response)
+            with time_stage("clean"):
+                response = self._clean_response(response)
             
+            record_generation([inputs['input_ids'].shape[1]], [len(generated_tokens)],
+                              timer.prefill_seconds, timer.decode_seconds)
             return response
             
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            return f"{ERROR_PREFIX} {str(e)}"
+    
+    def generate_stream(self, input_text: str, **kwargs) -> Iterator[Dict[str, Any]]:
+        """
+        Generate a response, yielding text as tokens are decoded.
+        
+        Args:
+            input_text: The input prompt
+            **kwargs: Override default generation parameters
+            
+        Yields:
+            {"event": "token", "text": ...} for each decoded piece of text, then one
+            {"event": "done", "response": ..., "time_to_first_token": ..., "tokens_per_second": ...}
+            with the cleaned response and timings, or {"event": "error", "error": ...}.
+            Closing the generator early (e.g. on client disconnect) stops generation.
+        """
+        started = time.perf_counter()
+        # Set when the consumer goes away so the generate thread stops decoding
+        cancel_event = kwargs.pop("cancel_event", None) or threading.Event()
+        try:
+            torch = _import_torch()
+            
+            inputs, gen_params, adapter = self._prepare_inputs(input_text, cancel_event=cancel_event, **kwargs)
+            try:
+                self._check_deadline(gen_params)
+                from ai_model_stopping import truncate_at_stop
+                stop_strings, _ = self._stop_settings(**kwargs)
+                streamer = _TokenStreamer()
+                gen_params["streamer"] = streamer
+                
+                def run_generate():
+                    try:
+                        with warnings.catch_warnings():
+                            warnings.simplefilter("ignore")
+                            with torch.no_grad(), self._use_adapters([adapter]):
+                                self.model.generate(**inputs, **gen_params)
+                    except Exception as e:
+                        streamer.fail(e)
+                    finally:
+                        # Here rather than in the consumer, which can close before generate() stops
+                        self.release_adapter(adapter)
+                
+                generate_started = time.perf_counter()
+                thread = threading.Thread(target=run_generate, daemon=True)
+                thread.start()
+            except BaseException:
+                self.release_adapter(adapter)
+                raise
+            
+            token_ids: List[int] = []
+            text = ""
+            first_token_at = None
+            detokenize_time = 0.0
+            for new_ids in streamer:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                token_ids.extend(new_ids)
+                
+                # Decode everything so far and emit only the new, complete characters
+                decode_started = time.perf_counter()
+                decoded = truncate_at_stop(self.tokenizer.decode(token_ids, skip_special_tokens=True),
+                                           stop_strings)
+                detokenize_time += time.perf_counter() - decode_started
+                if decoded.endswith("\ufffd"):
+                    continue
+                if len(decoded) > len(text):
+                    yield {"event": "token", "text": decoded[len(text):]}
+                    text = decoded
+            thread.join()
+            self._check_deadline(gen_params)
+            
+            # Flush anything held back waiting for a multi-byte character to complete
+            decoded = truncate_at_stop(self.tokenizer.decode(token_ids, skip_special_tokens=True), stop_strings)
+            if len(decoded) > len(text):
+                yield {"event": "token", "text": decoded[len(text):]}
+                text = decoded
+            
+            finished_at = time.perf_counter()
+            decode_time = finished_at - first_token_at if first_token_at else 0.0
+            with time_stage("clean"):
+                response = self._clean_response(text.strip())
+            observe_stage("detokenize", detokenize_time)
+            record_generation([inputs['input_ids'].shape[1]], [len(token_ids)],
+                              (first_token_at or finished_at) - generate_started, decode_time)
+            yield {
+                "event": "done",
+                "response": response,
+                "generated_tokens": len(token_ids),
+                "time_to_first_token": (first_token_at or finished_at) - started,
+                "tokens_per_second": (len(token_ids) - 1) / decode_time if decode_time > 0 else 0.0,
+                "total_time": finished_at - started
+            }
+            
+        except DeadlineExceeded as e:
+            yield {"event": "error", "error": str(e), "deadline_exceeded": True}
+        except Exception as e:
+            yield {"event": "error", "error": f"{ERROR_PREFIX} {str(e)}"}
+        finally:
+            cancel_event.set()
+    
+    def generate_batch(self, prompts: List[str], batch_size: Optional[int] = None, **kwargs) -> List[str]:
+        """
+        Generate responses for several prompts with one generate call per batch.
+        
+        Args:
+            prompts: Input prompts
+            batch_size: Maximum prompts per generate call (all at once if None)
+            **kwargs: Override default generation parameters
+            
+        Returns:
+            Generated text responses, in the same order as prompts
+        """
+        if not prompts:
+            return []
+        
+        batch_size = batch_size or len(prompts)
+        responses = []
+        for start in range(0, len(prompts), batch_size):
+            responses.extend(self._generate_batch_chunk(prompts[start:start + batch_size], **kwargs))
+        return responses
+    
+    def _generate_batch_chunk(self, prompts: List[str], **kwargs) -> List[str]:
+        """Run a single left-padded generate call for a chunk of prompts."""
+        try:
+            torch = _import_torch()
+            
+            # Build every chat prompt and tokenize with left padding
+            with time_stage("template"):
+                texts = [self.build_prompt(prompt) for prompt in prompts]
+            with time_stage("tokenize"):
+                inputs = self.tokenizer(
+                    texts, 
+                    return_tensors="pt", 
+                    padding=True, 
+                    truncation=True, 
+                    max_length=MAX_INPUT_LENGTH
+                )
+                inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            
+            gen_params = self._generation_params(**kwargs)
+            adapter = self.acquire_adapter(kwargs.get("adapter"))
+            try:
+                self._check_deadline(gen_params)
+                timer = _GenerationTimer()
+                gen_params["streamer"] = timer
+                
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    with torch.no_grad(), self._use_adapters([adapter] * len(prompts)):
+                        outputs = self.model.generate(**inputs, **gen_params)
+                timer.end()
+            finally:
+                self.release_adapter(adapter)
+            self._check_deadline(gen_params)
+            
+            # Every row shares the padded prompt length
+            prompt_length = inputs['input_ids'].shape[1]
+            generated = outputs[:, prompt_length:]
+            with time_stage("detokenize"):
+                decoded = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+                decoded = [self._truncate_at_stop(text, **kwargs) for text in decoded]
+            
+            with time_stage("clean"):
+                responses = [self._clean_response(text.strip()) for text in decoded]
+            
+            # Rows that finished early are padded out to the longest one
+            output_lengths = (generated != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+            record_generation(inputs['attention_mask'].sum(dim=1).tolist(), output_lengths,
+                              timer.prefill_seconds, timer.decode_seconds)
+            return responses
+            
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            return f"An error occurred: {str(e)}"
+            return [f"{ERROR_PREFIX} {str(e)}"] * len(prompts)
+    
+    def _prepare_inputs(self, input_text: str, **kwargs) -> Tuple[Dict[str, Any], Dict[str, Any], Optional[str]]:
+        """
+        Build, tokenize and move a single prompt, returning model inputs, generation parameters
+        and the resolved adapter, which the caller must pass to release_adapter().
+        """
+        # Resolved once, so the prefix cache and the generate call agree across an adapter reload
+        adapter = self.acquire_adapter(kwargs.get("adapter"))
+        try:
+            variant, input_ids, inputs = self.tokenize_prompt(input_text)
+            # generate() builds new tensors rather than writing to its inputs, so cached tensors can be shared
+            inputs = dict(inputs)
+            
+            # Get generation parameters
+            gen_params = self._generation_params(**kwargs)
+            
+            # Reuse the precomputed prefix so only the user-specific suffix is prefilled
+            past_key_values = self._get_prefix_cache(variant, input_ids, adapter)
+            if past_key_values is not None:
+                gen_params["past_key_values"] = past_key_values
+        except BaseException:
+            self.release_adapter(adapter)
+            raise
+        
+        return inputs, gen_params, adapter
+    
+    def tokenize_prompt(self, input_text: str,
+                        max_length: int = MAX_INPUT_LENGTH) -> Tuple[str, List[int], Dict[str, Any]]:
+        """
+        Render and tokenize a prompt, reusing the result for repeated inputs.
+        
+        Args:
+            input_text: The input prompt
+            max_length: Truncation length in tokens
+            
+        Returns:
+            (template variant, token ids, {"input_ids", "attention_mask"} tensors on the model device).
+            Cached values are shared between callers and must not be modified.
+        """
+        variant, messages = self._build_messages(input_text)
+        key = (variant, input_text, max_length)
+        entry = self._prompt_cache.get(key)
+        if entry is not None:
+            return entry
+        
+        # Build the chat prompt for this input
+        with time_stage("template"):
+            prompt = self._render_messages(messages)
+        
+        # Tokenize input and move to correct device
+        with time_stage("tokenize"):
+            inputs = self.tokenizer(prompt, return_tensors="pt", truncation=True, max_length=max_length)
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+        
+        entry = (variant, inputs['input_ids'][0].tolist(), inputs)
+        self._prompt_cache.put(key, entry)
+        return entry
+    
+    def _generation_params(self, **kwargs) -> Dict[str, Any]:
+        """
+        Merge request overrides with the default generation parameters.
+        
+        A `deadline` (time.monotonic() value) or `cancel_event` (threading.Event)
+        override adds a stopping criterion that ends generation early.
+        """
+        params = {
+            "max_new_tokens": kwargs.get("max_new_tokens", self.max_new_tokens),
+            "do_sample": kwargs.get("do_sample", True),
+            "temperature": kwargs.get("temperature", self.temperature),
+            "top_p": kwargs.get("top_p", self.top_p),
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id
+        }
+        # Forces a fixed output length, e.g. for benchmarks
+        if "min_new_tokens" in kwargs:
+            params["min_new_tokens"] = kwargs["min_new_tokens"]
+        
+        # transformers is already loaded with the model, so this import is only a lookup
+        from ai_model_stopping import DeadlineStoppingCriteria, StopSequenceCriteria, StoppingCriteriaList
+        criteria = []
+        
+        deadline = kwargs.get("deadline")
+        cancel_event = kwargs.get("cancel_event")
+        if deadline is not None or cancel_event is not None:
+            criteria.append(DeadlineStoppingCriteria(deadline, cancel_event))
+        
+        # Each row stops on its own, so discarded text never costs decode steps
+        stop_strings, stop_token_ids = self._stop_settings(**kwargs)
+        if stop_strings or stop_token_ids:
+            criteria.append(StopSequenceCriteria(self.tokenizer, stop_strings, stop_token_ids))
+        
+        if criteria:
+            params["stopping_criteria"] = StoppingCriteriaList(criteria)
+        return params
+    
+    def _stop_settings(self, **kwargs) -> Tuple[List[str], List[int]]:
+        """
+        Stop strings and token ids for a request.
+        
+        The `stop` override (a string or list of strings) replaces the default
+        stop_sequences, so `stop=[]` turns them off; `stop_token_ids` adds token
+        ids besides EOS.
+        """
+        stop = kwargs.get("stop")
+        if stop is None:
+            stop = self.stop_sequences
+        elif isinstance(stop, str):
+            stop = [stop]
+        if not isinstance(stop, (list, tuple)) or not all(isinstance(item, str) for item in stop):
+            raise ValueError("'stop' must be a string or a list of strings")
+        stop_token_ids = kwargs.get("stop_token_ids")
+        if stop_token_ids is None:
+            stop_token_ids = []
+        # bool is an int subclass; JSON true/false are not token ids
+        if not isinstance(stop_token_ids, (list, tuple)) or not all(
+                isinstance(item, int) and not isinstance(item, bool) and item >= 0 for item in stop_token_ids):
+            raise ValueError("'stop_token_ids' must be a list of non-negative integers")
+        # dict.fromkeys drops duplicates but keeps the order
+        return list(dict.fromkeys(stop)), list(stop_token_ids)
+    
+    def _truncate_at_stop(self, text: str, **kwargs) -> str:
+        """Cut decoded text at the request's first stop string."""
+        from ai_model_stopping import truncate_at_stop
+        stop_strings, _ = self._stop_settings(**kwargs)
+        return truncate_at_stop(text, stop_strings)
+    
+    def _check_deadline(self, gen_params: Dict[str, Any]):
+        """Raise DeadlineExceeded when a deadline criterion in gen_params has expired."""
+        for criteria in gen_params.get("stopping_criteria", ()):
+            if hasattr(criteria, "expired") and criteria.expired():
+                raise DeadlineExceeded()
+    
+    def build_prompt(self, input_text: str) -> str:
+        """
+        Render the chat template for an input.
+        
+        Args:
+            input_text: The input prompt
+            
+        Returns:
+            Prompt text ready for tokenization
+        """
+        _, messages = self._build_messages(input_text)
+        return self._render_messages(messages)
+    
+    def _build_messages(self, input_text: str) -> Tuple[str, List[Dict[str, str]]]:
+        """Build chat messages based on input type, returning the template variant name."""
+        if "suggest a habit" in input_text.lower():
+            return "habit", [
+                {"role": "user", "content": input_text}
+            ]
+        return "assistant", [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": input_text}
+        ]
+    
+    def _render_messages(self, messages: List[Dict[str, str]]) -> str:
+        """Apply the chat template."""
+        return self.tokenizer.apply_chat_template(
+            messages, 
+            tokenize=False, 
+            add_generation_prompt=True
+        )
+    
+    def _build_prefix_caches(self, adapters: Optional[Sequence[Optional[str]]] = None):
+        """
+        Prefill the shared prefix of every message-template variant once.
+        
+        Args:
+            adapters: resolve_adapter() results to build prefixes for (default: every adapter)
+        """
+        with contextlib.redirect_stderr(io.StringIO()):
+            import torch
+        
+        # One prefix per adapter, since the adapters change the prefix's keys and values
+        if adapters is None:
+            adapters = list(dict.fromkeys(self.resolve_adapter(name) for name in self.adapter_names()))
+        for adapter in adapters:
+            for probe in ("suggest a habit", "help"):
+                variant, messages = self._build_messages(probe)
+                messages[-1]["content"] = _PREFIX_SENTINEL
+                rendered = self._render_messages(messages)
+                prefix_text = rendered[:rendered.index(_PREFIX_SENTINEL)]
+                
+                # Leave the last prefix token to the suffix in case it merges with user text
+                prefix_ids = self.tokenizer(prefix_text, add_special_tokens=True)["input_ids"][:-1]
+                if not prefix_ids:
+                    continue
+                
+                with torch.no_grad(), self._use_adapters([adapter]):
+                    outputs = self.model(
+                        input_ids=torch.tensor([prefix_ids], device=self.model.device),
+                        use_cache=True
+                    )
+                self._prefix_caches[(variant, adapter)] = (prefix_ids, outputs.past_key_values)
+    
+    def _match_prefix_cache(self, variant: str, input_ids: List[int],
+                            adapter: Optional[str] = None) -> Optional[Tuple[List[int], Any]]:
+        """
+        The adapter's (prefix token ids, KV-cache) entry if the prefix matches the start of
+        input_ids. The cache is shared and must not be modified.
+        """
+        entry = self._prefix_caches.get((variant, adapter))
+        if entry is None:
+            return None
+        
+        prefix_ids = entry[0]
+        if len(input_ids) <= len(prefix_ids) or input_ids[:len(prefix_ids)] != prefix_ids:
+            return None
+        return entry
+    
+    def _get_prefix_cache(self, variant: str, input_ids: List[int], adapter: Optional[str] = None):
+        """Return a private copy of the adapter's prefix KV-cache if it matches the start of input_ids."""
+        entry = self._match_prefix_cache(variant, input_ids, adapter)
+        if entry is None:
+            return None
+        
+        # generate() appends to the cache in place, so each request works on a copy
+        return copy.deepcopy(entry[1])
     
     def _clean_response(self, response: str) -> str:
         """Clean up the generated response."""
@@ -187,40 +1226,216 @@ class AiModelCore:
         
         return response.strip()
     
+    def _configure_threads(self):
+        """Apply num_threads or the tuned thread config, recording the result."""
+        config = load_thread_config(self.thread_config) if self.thread_config else None
+        if config is not None and config.get("workers", 1) != 1:
+            # Tuned for several forked workers, each with a share of the cores
+            config = None
+        if self.num_threads:
+            source = "argument"
+        elif config is not None:
+            source = self.thread_config
+        else:
+            source = "default"
+        
+        self.thread_settings = apply_thread_settings(
+            self.num_threads or (config or {}).get("intra_op_threads"),
+            (config or {}).get("inter_op_threads")
+        )
+        self.thread_settings["source"] = source
+        if source != "default":
+            print(f"Threads: {self.thread_settings['intra_op_threads']} intra-op, "
+                  f"{self.thread_settings['inter_op_threads']} inter-op ({source})")
+    
+    def close(self):
+        """Drop the model, tokenizer and caches so their memory can be freed; the instance cannot generate afterwards."""
+        self.model = None
+        self.tokenizer = None
+        self._prefix_caches.clear()
+        self._prompt_cache.clear()
+    
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the loaded model."""
         return {
             "model_name": self.model_name,
             "adapter_path": self.adapter_path,
-            "adapter_loaded": os.path.exists(self.adapter_path),
+            "adapter_loaded": self.adapter_loaded or self.merged_from is not None,
+            "adapters_merged": self.adapters_merged or self.merged_from is not None,
+            "adapters": {name: path for name, path in self.adapters.items()},
+            "adapter_names": self.adapter_names(),
+            "adapter_reloads": self.adapter_reloads,
+            "merged_from": self.merged_from,
             "device": self.device,
+            "precision": self.precision,
+            "snapshot": self.snapshot_loaded,
+            "load_timings": self.load_timings,
+            "threads": self.thread_settings,
             "max_new_tokens": self.max_new_tokens,
             "temperature": self.temperature,
-            "top_p": self.top_p
+            "top_p": self.top_p,
+            "stop_sequences": self.stop_sequences,
+            "prefix_cache": sorted({variant for variant, _ in self._prefix_caches}),
+            "prompt_cache": self._prompt_cache.get_stats()
         }
 
 
-# Singleton instance for shared use
-_model_instance: Optional[AiModelCore] = None
+def _newest_mtime(path: str) -> float:
+    """Latest modification time of a file or of any file under a directory."""
+    if os.path.isfile(path):
+        return os.path.getmtime(path)
+    newest = os.path.getmtime(path)
+    for root, _, files in os.walk(path):
+        for name in files:
+            newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+    return newest
+
+
+def adapter_fingerprint(path: str) -> Tuple[Tuple[str, int, int], ...]:
+    """
+    Name, size and mtime of the adapter_* files at the top of an adapter directory.
+    Training checkpoints in subdirectories are left out, so only a finished save changes it.
+    """
+    if not os.path.isdir(path):
+        return ()
+    files = []
+    for name in sorted(os.listdir(path)):
+        file_path = os.path.join(path, name)
+        if name.startswith("adapter_") and os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            files.append((name, stat.st_size, stat.st_mtime_ns))
+    return tuple(files)
+
+
+class _PromptCache:
+    """Thread-safe bounded LRU cache of tokenized prompts with hit/miss counters."""
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+    
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0
+            }
+
+
+class _GenerationTimer:
+    """Streamer for model.generate that only records when the first output token appears."""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._prompt_seen = False
+    
+    def put(self, value):
+        # generate() first passes the prompt ids, then one token per step
+        if not self._prompt_seen:
+            self._prompt_seen = True
+        elif self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+    
+    def end(self):
+        if self.finished_at is None:
+            self.finished_at = time.perf_counter()
+    
+    @property
+    def prefill_seconds(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started
+    
+    @property
+    def decode_seconds(self) -> Optional[float]:
+        if self.first_token_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.first_token_at
+
+
+class _TokenStreamer:
+    """Streamer for model.generate that hands newly generated token ids to another thread."""
+    
+    def __init__(self):
+        self._queue: "queue.Queue" = queue.Queue()
+        self._prompt_seen = False
+    
+    def put(self, value):
+        # generate() first passes the prompt ids, then one token per step
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        self._queue.put(value.reshape(-1).tolist())
+    
+    def end(self):
+        self._queue.put(None)
+    
+    def fail(self, error: Exception):
+        self._queue.put(error)
+    
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
 
 
 def get_model_instance(**kwargs) -> AiModelCore:
     """
-    Get or create the singleton model instance.
+    Get or create the shared model instance for these parameters.
+    
+    Instances live in the process-wide ModelRegistry (ai_model_registry.py), one per
+    (model_name, adapter_path, precision), and are never evicted while held here.
     
     Args:
         **kwargs: Parameters for AiModelCore initialization
         
     Returns:
-        The singleton AiModelCore instance
+        The shared AiModelCore instance
+        
+    Raises:
+        ValueError: The same model is already loaded with different parameters
     """
-    global _model_instance
-    if _model_instance is None:
-        _model_instance = AiModelCore(**kwargs)
-    return _model_instance
+    from ai_model_registry import get_registry
+    return get_registry().load(kwargs)
 
 
 def reset_model_instance():
-    """Reset the singleton model instance (useful for testing)."""
-    global _model_instance
-    _model_instance = None
\ No newline at end of file
+    """Unload every shared model instance and return its memory (useful for testing)."""
+    from ai_model_registry import get_registry
+    get_registry().clear()
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+Prometheus-style metrics for the AI model.
+Small dependency-free counters, gauges and histograms recorded by AiModelCore
+and the batching scheduler, exported in the Prometheus text format by
+ai_model_server.py on /metrics.
+"""
+
+import contextlib
+import math
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+# Request and stage latencies in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Per-request decode rate in tokens/second
+RATE_BUCKETS = (1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+# Prompt and output lengths in tokens
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024)
+
+# Inference stages timed for every generation, in pipeline order
+STAGES = ("template", "tokenize", "prefill", "decode", "detokenize", "clean")
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """Base class holding one value per label combination."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, const_labels: Dict[str, str]) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        names = tuple(const_labels) + self.labelnames
+        for suffix, key, value, extra in self._samples():
+            label_names = names + tuple(name for name, _ in extra)
+            label_values = tuple(const_labels.values()) + key + tuple(v for _, v in extra)
+            lines.append(f"{self.name}{suffix}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", key, value, ()
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        """Current count for one label combination."""
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, either set directly or read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], Optional[float]]):
+        """Read the (unlabelled) value from function on every scrape; None skips the sample."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = None
+            if value is not None:
+                yield "", (), value, ()
+            return
+        yield from super()._samples()
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram with sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, list(state["counts"]), state["sum"]) for key, state in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "_bucket", key, cumulative, (("le", _format_value(bound)),)
+            yield "_sum", key, total, ()
+            yield "_count", key, cumulative, ()
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self, const_labels: Optional[Dict[str, str]] = None) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render(const_labels or {}) for metric in metrics) + "\n"
+
+
+def resident_memory_bytes() -> Optional[int]:
+    """Current resident set size of this process, or None when it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def peak_resident_memory_bytes() -> Optional[int]:
+    """Peak resident set size of this process so far, or None when it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter(
+    "ai_model_requests_total", "HTTP requests handled", ("endpoint", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "ai_model_request_duration_seconds", "HTTP request latency (full stream duration for /chat/stream)",
+    ("endpoint",))
+STAGE_SECONDS = REGISTRY.histogram(
+    "ai_model_inference_stage_seconds",
+    "Time per inference stage: " + ", ".join(STAGES) + " (batched calls are timed per batch)",
+    ("stage",))
+PROMPT_TOKENS = REGISTRY.counter(
+    "ai_model_prompt_tokens_total", "Prompt tokens processed")
+GENERATED_TOKENS = REGISTRY.counter(
+    "ai_model_generated_tokens_total", "Output tokens generated")
+PROMPT_LENGTH = REGISTRY.histogram(
+    "ai_model_prompt_tokens", "Prompt length per generation", buckets=TOKEN_BUCKETS)
+OUTPUT_LENGTH = REGISTRY.histogram(
+    "ai_model_generated_tokens", "Output length per generation", buckets=TOKEN_BUCKETS)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ai_model_decode_tokens_per_second", "Decode throughput per generate call", buckets=RATE_BUCKETS)
+QUEUE_DEPTH = REGISTRY.gauge(
+    "ai_model_queue_depth", "Requests waiting for the batching scheduler")
+IN_FLIGHT = REGISTRY.gauge(
+    "ai_model_in_flight_requests", "Generation requests admitted and not yet finished")
+ACTIVE_SEQUENCES = REGISTRY.gauge(
+    "ai_model_active_sequences", "Sequences in the scheduler's decode batch")
+ADAPTER_RELOADS = REGISTRY.counter(
+    "ai_model_adapter_reloads_total", "LoRA adapter hot reloads and rollbacks", ("adapter", "status"))
+RESIDENT_MEMORY = REGISTRY.gauge(
+    "process_resident_memory_bytes", "Resident memory size in bytes")
+RESIDENT_MEMORY.set_function(resident_memory_bytes)
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record time spent in an inference stage."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextlib.contextmanager
+def time_stage(stage: str):
+    """Record the duration of a with-block under an inference stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def record_generation(prompt_lengths: Sequence[int], output_lengths: Sequence[int],
+                      prefill_seconds: Optional[float], decode_seconds: Optional[float]):
+    """
+    Record one generate call (a single prompt or a whole batch).
+
+    Args:
+        prompt_lengths: Prompt tokens for each sequence
+        output_lengths: Output tokens for each sequence
+        prefill_seconds: Time from the start of generation to the first output token
+        decode_seconds: Time from the first output token to the last
+    """
+    for length in prompt_lengths:
+        PROMPT_LENGTH.observe(length)
+    for length in output_lengths:
+        OUTPUT_LENGTH.observe(length)
+    PROMPT_TOKENS.inc(sum(prompt_lengths))
+    GENERATED_TOKENS.inc(sum(output_lengths))
+    if prefill_seconds is not None:
+        observe_stage("prefill", prefill_seconds)
+    if decode_seconds is not None:
+        observe_stage("decode", decode_seconds)
+        # Each sequence's first token comes out of prefill; the decode phase produced the rest
+        decoded = sum(output_lengths) - len(output_lengths)
+        if decode_seconds > 0 and decoded > 0:
+            TOKENS_PER_SECOND.observe(decoded / decode_seconds)
@@ -0,0 +1,220 @@
+"""
+Pre-generated habit-suggestion pool.
+A background worker refills a pool of ready suggestions in large batches while
+the server is idle, so the common "suggest a habit" request is answered from
+memory instead of running the model.
+Used by ai_model_server.py for /chat.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Any, Callable
+
+# Same prompt as Constants.HABIT_TO_TRACK_PROMPT on the C# side
+HABIT_SUGGESTION_PROMPT = "Please suggest a habit that can be tracked"
+
+
+class SuggestionPool:
+    """Pool of unique habit suggestions refilled in the background."""
+
+    def __init__(self,
+                 model_core,
+                 prompt: str = HABIT_SUGGESTION_PROMPT,
+                 pool_size: int = 200,
+                 low_watermark: Optional[int] = None,
+                 high_watermark: Optional[int] = None,
+                 refill_batch_size: int = 16,
+                 max_clients: int = 1000,
+                 max_seen_per_client: int = 500,
+                 idle_check: Optional[Callable[[], bool]] = None):
+        """
+        Initialize the suggestion pool.
+
+        Args:
+            model_core: Loaded AiModelCore instance
+            prompt: Prompt the pool answers
+            pool_size: Maximum suggestions held
+            low_watermark: Start refilling below this size (default: a quarter of pool_size)
+            high_watermark: Stop refilling at this size (default: pool_size)
+            refill_batch_size: Prompts per generate_batch call while refilling
+            max_clients: Clients whose served suggestions are remembered
+            max_seen_per_client: Suggestions remembered per client
+            idle_check: Returns True when the model is free for background work
+        """
+        self.model_core = model_core
+        self.prompt = prompt
+        self.pool_size = pool_size
+        self.high_watermark = min(high_watermark or pool_size, pool_size)
+        self.low_watermark = min(low_watermark if low_watermark is not None else pool_size // 4,
+                                 self.high_watermark)
+        self.refill_batch_size = refill_batch_size
+        self.max_clients = max_clients
+        self.max_seen_per_client = max_seen_per_client
+        self.idle_check = idle_check
+
+        self._suggestions: deque = deque()
+        self._in_pool: set = set()
+        # client id -> served suggestions (insertion ordered so the oldest can be dropped)
+        self._seen: "OrderedDict[str, OrderedDict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        self._refilling = True
+        # Bumped by clear() so a refill batch started before it is discarded
+        self._generation = 0
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "generated": 0,
+            "duplicates_dropped": 0,
+            "refill_batches": 0,
+            "refill_seconds": 0.0
+        }
+
+    def start(self):
+        """Start the background refill worker."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="suggestion-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background refill worker."""
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        """Drop every pooled suggestion, e.g. after the model's adapters were reloaded."""
+        with self._lock:
+            self._suggestions.clear()
+            self._in_pool.clear()
+            self._refilling = True
+            self._generation += 1
+        self._wakeup.set()
+
+    def matches(self, input_text: str) -> bool:
+        """Check whether a request can be answered from the pool."""
+        return input_text.strip().lower() == self.prompt.lower()
+
+    def take(self, client_id: Optional[str] = None) -> Optional[str]:
+        """
+        Take a suggestion the client has not been served before.
+
+        Args:
+            client_id: Identifies the caller for no-repeat tracking
+
+        Returns:
+            A suggestion, or None on a miss (caller should generate instead)
+        """
+        with self._lock:
+            seen = self._seen.get(client_id) if client_id is not None else None
+            for index, suggestion in enumerate(self._suggestions):
+                if seen is not None and suggestion in seen:
+                    continue
+                del self._suggestions[index]
+                self._in_pool.discard(suggestion)
+                self._remember(client_id, suggestion)
+                self._stats["hits"] += 1
+                size = len(self._suggestions)
+                break
+            else:
+                self._stats["misses"] += 1
+                suggestion = None
+                size = len(self._suggestions)
+
+        if size < self.low_watermark:
+            self._wakeup.set()
+        return suggestion
+
+    def remember(self, client_id: Optional[str], suggestion: str):
+        """Record a suggestion served outside the pool (e.g. generated on a miss)."""
+        with self._lock:
+            self._remember(client_id, suggestion)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get pool counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._suggestions)
+            stats["clients_tracked"] = len(self._seen)
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else 0.0
+        stats["pool_size"] = self.pool_size
+        stats["low_watermark"] = self.low_watermark
+        stats["high_watermark"] = self.high_watermark
+        return stats
+
+    def _remember(self, client_id: Optional[str], suggestion: str):
+        if client_id is None:
+            return
+        seen = self._seen.get(client_id)
+        if seen is None:
+            seen = self._seen[client_id] = OrderedDict()
+            if len(self._seen) > self.max_clients:
+                self._seen.popitem(last=False)
+        else:
+            self._seen.move_to_end(client_id)
+        seen[suggestion] = None
+        if len(seen) > self.max_seen_per_client:
+            seen.popitem(last=False)
+
+    def _run(self):
+        """Refill loop with low/high watermark hysteresis."""
+        while self._running:
+            with self._lock:
+                size = len(self._suggestions)
+            if size < self.low_watermark:
+                self._refilling = True
+            elif size >= self.high_watermark:
+                self._refilling = False
+
+            # Only compete with live traffic when the pool has run dry
+            idle = self.idle_check is None or self.idle_check()
+            if self._refilling and (idle or size == 0):
+                added = self._refill(min(self.refill_batch_size, self.high_watermark - size))
+                if not added:
+                    # Back off when the model keeps failing or only repeats itself
+                    self._wakeup.wait(timeout=1.0)
+                    self._wakeup.clear()
+            else:
+                self._wakeup.wait(timeout=0.5)
+                self._wakeup.clear()
+
+    def _refill(self, count: int) -> int:
+        """Generate one batch of suggestions and add the unique ones."""
+        if count <= 0:
+            return 0
+        generation = self._generation
+        started = time.perf_counter()
+        try:
+            responses = self.model_core.generate_batch([self.prompt] * count)
+        except Exception:
+            responses = []
+        elapsed = time.perf_counter() - started
+
+        added = 0
+        with self._lock:
+            self._stats["refill_batches"] += 1
+            self._stats["refill_seconds"] += elapsed
+            if generation != self._generation:
+                return 0
+            for response in responses:
+                if not response or response.startswith("An error occurred"):
+                    continue
+                self._stats["generated"] += 1
+                if response in self._in_pool:
+                    self._stats["duplicates_dropped"] += 1
+                    continue
+                if len(self._suggestions) >= self.pool_size:
+                    break
+                self._suggestions.append(response)
+                self._in_pool.add(response)
+                added += 1
+        return added
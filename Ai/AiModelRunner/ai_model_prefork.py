@@ -0,0 +1,188 @@
+"""
+Pre-fork process supervisor for the AI model server.
+The master loads the model once, opens the listening socket and forks worker
+processes that inherit both. Read-only weights stay shared copy-on-write (or
+through the page cache for memory-mapped snapshots), every worker accepts on
+the same port, and the master restarts workers that exit or stop sending
+heartbeats. Requires os.fork (Linux).
+Used by ai_model_server.py --workers N.
+"""
+
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+import multiprocessing
+from typing import Callable, Dict, Optional
+
+
+class WorkerContext:
+    """What a forked worker receives from the supervisor."""
+
+    def __init__(self, index: int, num_workers: int, sock: socket.socket, heartbeats):
+        self.index = index
+        self.num_workers = num_workers
+        self.sock = sock
+        self._heartbeats = heartbeats
+
+    def beat(self):
+        """Report this worker as healthy."""
+        self._heartbeats[self.index] = time.monotonic()
+
+
+class PreforkSupervisor:
+    """Forks and supervises N workers sharing one listening socket."""
+
+    def __init__(self,
+                 worker_main: Callable[[WorkerContext], None],
+                 num_workers: int,
+                 host: str = "localhost",
+                 port: int = 5000,
+                 health_timeout: float = 60.0,
+                 restart_delay: float = 1.0):
+        """
+        Initialize the supervisor.
+
+        Args:
+            worker_main: Runs in each forked worker and serves requests on context.sock
+            num_workers: Number of worker processes
+            host: Address to listen on
+            port: Port shared by all workers
+            health_timeout: Seconds without a heartbeat before a worker is killed and restarted
+            restart_delay: Minimum seconds between restarts of the same worker
+        """
+        if not hasattr(os, "fork"):
+            raise RuntimeError("Multi-worker mode requires os.fork (Linux); run with --workers 1")
+
+        self.worker_main = worker_main
+        self.num_workers = num_workers
+        self.host = host
+        self.port = port
+        self.health_timeout = health_timeout
+        self.restart_delay = restart_delay
+
+        self._sock: Optional[socket.socket] = None
+        # Shared memory survives fork, so workers write heartbeats the master can read
+        self._heartbeats = multiprocessing.Array("d", num_workers, lock=False)
+        self._workers: Dict[int, int] = {}  # index -> pid
+        self._last_start: Dict[int, float] = {}
+        self._running = False
+
+    def serve_forever(self):
+        """Open the socket, fork the workers and supervise them until SIGINT/SIGTERM."""
+        self._sock = socket.create_server((self.host, self.port), backlog=128)
+        self._sock.set_inheritable(True)
+
+        # Keep the loaded model out of the collector so workers do not dirty its pages
+        gc.collect()
+        gc.freeze()
+
+        self._running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for index in range(self.num_workers):
+            self._spawn(index)
+        print(f"Supervisor {os.getpid()} serving on http://{self.host}:{self.port} "
+              f"with {self.num_workers} workers")
+        sys.stdout.flush()
+
+        try:
+            while self._running:
+                self._reap()
+                self._check_health()
+                time.sleep(1.0)
+        finally:
+            self._shutdown()
+
+    def _spawn(self, index: int):
+        # Do not restart a crashing worker in a tight loop
+        wait = self._last_start.get(index, 0.0) + self.restart_delay - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        self._heartbeats[index] = time.monotonic()
+        self._last_start[index] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker(index)
+        self._workers[index] = pid
+        print(f"Started worker {index} (pid {pid})")
+        sys.stdout.flush()
+
+    def _run_worker(self, index: int):
+        """Body of a forked worker; never returns."""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        exit_code = 0
+        try:
+            self.worker_main(WorkerContext(index, self.num_workers, self._sock, self._heartbeats))
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def _reap(self):
+        """Restart workers that have exited."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for index, worker_pid in list(self._workers.items()):
+                if worker_pid == pid:
+                    del self._workers[index]
+                    if self._running:
+                        print(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+                        self._spawn(index)
+
+    def _check_health(self):
+        """Kill workers whose heartbeat is stale; _reap restarts them."""
+        now = time.monotonic()
+        for index, pid in list(self._workers.items()):
+            if now - self._heartbeats[index] > self.health_timeout:
+                print(f"Worker {index} (pid {pid}) missed heartbeats for {self.health_timeout:.0f}s, killing")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # Avoid killing it again before it is reaped
+                self._heartbeats[index] = now
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def _shutdown(self):
+        """Terminate all workers and wait for them."""
+        print("Stopping workers...")
+        for pid in self._workers.values():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + 10.0
+        for pid in list(self._workers.values()):
+            while time.monotonic() < deadline:
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if done:
+                    break
+                time.sleep(0.1)
+            else:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        self._workers.clear()
+        if self._sock is not None:
+            self._sock.close()
@@ -0,0 +1,329 @@
+"""
+Pipelined JSON-lines protocol for the stdin/stdout integration.
+The legacy mode answers one plain line per input line, strictly in turn. After
+a {"protocol": 1} handshake the client can instead send many requests tagged
+with ids without waiting; they are decoded together by the batching scheduler
+and answered as they finish, in any order.
+
+Messages (one JSON object per line, client -> Python):
+    {"protocol": 1}                                            handshake
+    {"id": "7", "prompt": "...", "params": {...}, "adapter": "name", "timeout": 30, "stream": false}
+    {"type": "cancel", "id": "7"}
+    {"type": "exit"}                                           (plain "exit" also works)
+
+Replies (Python -> client):
+    {"type": "hello", "protocol": 1, "max_batch_size": 16}
+    {"id": "7", "status": "success", "response": "..."}
+    {"id": "7", "status": "error", "error": "...", "code": "bad_request|deadline_exceeded|cancelled|error"}
+    {"id": "7", "event": "token|done|error", ...}              for "stream": true requests
+    {"type": "exit"}
+"""
+
+import json
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError
+from typing import Any, Dict, Optional, TextIO
+
+from ai_model_core import DeadlineExceeded, validate_generation_overrides
+from ai_model_scheduler import BatchScheduler
+
+PROTOCOL_VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+
+# Per-request timeout in seconds for requests that send none (as ai_model_server.py's default)
+DEFAULT_REQUEST_TIMEOUT = 30.0
+# Longest exit waits for in-flight requests before cancelling them
+DEFAULT_EXIT_TIMEOUT = 10.0
+# Time cancelled requests get to send their own replies before exit answers for them
+CANCEL_GRACE_SECONDS = 1.0
+
+
+def parse_hello(line: str) -> Optional[Dict[str, Any]]:
+    """Return the handshake message if line is one, otherwise None."""
+    if not line.startswith("{"):
+        return None
+    try:
+        message = json.loads(line)
+    except json.JSONDecodeError:
+        return None
+    if isinstance(message, dict) and "protocol" in message and "id" not in message:
+        return message
+    return None
+
+
+def negotiate(hello: Dict[str, Any]) -> Optional[int]:
+    """Pick the highest protocol version both sides support, or None."""
+    requested = hello.get("protocol")
+    versions = requested if isinstance(requested, list) else [requested]
+    common = [v for v in versions if isinstance(v, int) and v in SUPPORTED_VERSIONS]
+    return max(common) if common else None
+
+
+class _Pending:
+    """An in-flight request: a scheduler future or a streaming thread's cancel event."""
+
+    def __init__(self, future=None, cancel_event: Optional[threading.Event] = None):
+        self.future = future
+        self.cancel_event = cancel_event
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+
+
+class ProtocolSession:
+    """Serves protocol v1 requests read from input until exit or end of input."""
+
+    def __init__(self,
+                 model_core,
+                 input_stream: Optional[TextIO] = None,
+                 output_stream: Optional[TextIO] = None,
+                 max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0,
+                 request_timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT,
+                 exit_timeout: float = DEFAULT_EXIT_TIMEOUT):
+        """
+        Initialize the session.
+
+        Args:
+            model_core: Loaded AiModelCore instance
+            input_stream: Where requests are read from (default: stdin)
+            output_stream: Where replies are written (default: stdout)
+            max_batch_size: Maximum requests decoded together
+            max_wait_ms: Time the scheduler waits for more requests before starting a batch
+            request_timeout: Default per-request timeout in seconds (None or 0: no limit)
+            exit_timeout: Longest exit waits for in-flight requests before cancelling them
+        """
+        self.model_core = model_core
+        self.input_stream = input_stream or sys.stdin
+        self.output_stream = output_stream or sys.stdout
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.request_timeout = request_timeout
+        self.exit_timeout = exit_timeout
+
+        self._write_lock = threading.Lock()
+        # Set once exit is acknowledged; replies from requests still winding down are dropped
+        self._closed = False
+        # Ids exit answered for; their own late replies are dropped
+        self._answered_at_exit = set()
+        self._pending_lock = threading.Lock()
+        self._pending: Dict[Any, _Pending] = {}
+        self._idle = threading.Condition(self._pending_lock)
+        self._scheduler: Optional[BatchScheduler] = None
+
+    def handshake(self, hello: Dict[str, Any]) -> bool:
+        """
+        Answer a handshake message.
+
+        Returns:
+            True when a version was agreed and serve() should take over the stream
+        """
+        version = negotiate(hello)
+        if version is None:
+            self._write({
+                "type": "hello",
+                "status": "error",
+                "error": f"Unsupported protocol version {hello.get('protocol')!r}",
+                "supported": list(SUPPORTED_VERSIONS)
+            })
+            return False
+        self._write({"type": "hello", "protocol": version, "max_batch_size": self.max_batch_size})
+        return True
+
+    def serve(self):
+        """Read and dispatch requests until exit or end of input."""
+        self._scheduler = BatchScheduler(self.model_core,
+                                         max_batch_size=self.max_batch_size,
+                                         max_wait_ms=self.max_wait_ms)
+        self._scheduler.start()
+        try:
+            while True:
+                line = self.input_stream.readline()
+                if not line:
+                    # Client went away: nobody is left to read the answers
+                    self._cancel_all()
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                if line.lower() == "exit":
+                    self._exit()
+                    break
+                try:
+                    message = json.loads(line)
+                except json.JSONDecodeError as e:
+                    self._reply_error(None, f"Invalid JSON: {e}", "bad_request")
+                    continue
+                if not isinstance(message, dict):
+                    self._reply_error(None, "Each message must be a JSON object", "bad_request")
+                    continue
+                if message.get("type") == "exit":
+                    self._exit()
+                    break
+                self._dispatch(message)
+        finally:
+            self._scheduler.stop()
+            self._scheduler = None
+
+    def _dispatch(self, message: Dict[str, Any]):
+        request_id = message.get("id")
+        if not isinstance(request_id, (str, int)) or isinstance(request_id, bool):
+            self._reply_error(None, "Missing request id (a string or integer)", "bad_request")
+            return
+        if message.get("type") == "cancel":
+            with self._pending_lock:
+                pending = self._pending.get(request_id)
+            if pending is not None:
+                pending.cancel()
+            return
+
+        prompt = message.get("prompt")
+        params = message.get("params") or {}
+        if not isinstance(prompt, str) or not prompt.strip():
+            self._reply_error(request_id, "No prompt provided", "bad_request")
+            return
+        if not isinstance(params, dict):
+            self._reply_error(request_id, "params must be a JSON object", "bad_request")
+            return
+        if "adapter" in message:
+            params = dict(params, adapter=message["adapter"])
+        try:
+            deadline = self._deadline(message.get("timeout"))
+            # Malformed params are answered here and never reach the shared batch
+            params = validate_generation_overrides(params)
+            self.model_core._stop_settings(**params)
+            self.model_core.resolve_adapter(params.get("adapter"))
+        except ValueError as e:
+            self._reply_error(request_id, str(e), "bad_request")
+            return
+
+        with self._pending_lock:
+            if request_id in self._pending:
+                duplicate = True
+            else:
+                duplicate = False
+                # Reserve the id before starting so replies never race the bookkeeping
+                self._pending[request_id] = _Pending()
+        if duplicate:
+            self._reply_error(request_id, f"Request id {request_id!r} is already in flight", "bad_request")
+            return
+
+        if message.get("stream"):
+            self._start_stream(request_id, prompt, params, deadline)
+        else:
+            self._submit(request_id, prompt, params, deadline)
+
+    def _submit(self, request_id, prompt: str, params: Dict[str, Any], deadline: Optional[float]):
+        try:
+            future = self._scheduler.submit(prompt, deadline=deadline, **params)
+        except Exception as e:
+            self._finish(request_id)
+            self._reply_error(request_id, str(e), "bad_request")
+            return
+        with self._pending_lock:
+            self._pending[request_id].future = future
+        future.add_done_callback(lambda f: self._on_done(request_id, f))
+
+    def _on_done(self, request_id, future):
+        try:
+            response = future.result()
+        except CancelledError:
+            self._reply_error(request_id, "Request cancelled", "cancelled")
+        except DeadlineExceeded as e:
+            self._reply_error(request_id, str(e), "deadline_exceeded")
+        except Exception as e:
+            self._reply_error(request_id, str(e), "error")
+        else:
+            self._write({"id": request_id, "status": "success", "response": response})
+        finally:
+            # Only after the reply is written, so an exit acknowledgement always comes last
+            self._finish(request_id)
+
+    def _start_stream(self, request_id, prompt: str, params: Dict[str, Any], deadline: Optional[float]):
+        cancel_event = threading.Event()
+        with self._pending_lock:
+            self._pending[request_id].cancel_event = cancel_event
+
+        def run():
+            try:
+                events = self.model_core.generate_stream(
+                    prompt, deadline=deadline, cancel_event=cancel_event, **params)
+                for event in events:
+                    self._write(dict(event, id=request_id))
+            except Exception as e:
+                self._write({"id": request_id, "event": "error", "error": str(e)})
+            finally:
+                self._finish(request_id)
+
+        threading.Thread(target=run, name=f"stream-{request_id}", daemon=True).start()
+
+    def _deadline(self, timeout) -> Optional[float]:
+        if timeout is None:
+            timeout = self.request_timeout
+        if timeout is None:
+            return None
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid timeout: {timeout!r}")
+        return time.monotonic() + timeout if timeout > 0 else None
+
+    def _finish(self, request_id):
+        with self._pending_lock:
+            self._pending.pop(request_id, None)
+            if not self._pending:
+                self._idle.notify_all()
+
+    def _exit(self):
+        """
+        Let in-flight requests finish for up to exit_timeout, cancel the rest, then acknowledge
+        the exit. Every request gets a reply before the acknowledgement.
+        """
+        if not self._wait_idle(self.exit_timeout):
+            self._cancel_all()
+            if not self._wait_idle(CANCEL_GRACE_SECONDS):
+                with self._pending_lock:
+                    remaining = list(self._pending)
+                    self._pending.clear()
+                for request_id in remaining:
+                    self._reply_error(request_id, "Cancelled at exit", "cancelled")
+                with self._write_lock:
+                    self._answered_at_exit.update(remaining)
+        with self._write_lock:
+            self._write_line(json.dumps({"type": "exit"}))
+            self._closed = True
+
+    def _wait_idle(self, timeout: float) -> bool:
+        """Wait up to timeout seconds for every pending request to finish; True once none are left."""
+        deadline = time.monotonic() + timeout
+        with self._pending_lock:
+            while self._pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def _cancel_all(self):
+        with self._pending_lock:
+            pending = list(self._pending.values())
+        for item in pending:
+            item.cancel()
+
+    def _reply_error(self, request_id, error: str, code: str):
+        self._write({"id": request_id, "status": "error", "error": error, "code": code})
+
+    def _write(self, message: Dict[str, Any]):
+        line = json.dumps(message)
+        with self._write_lock:
+            if not self._closed and message.get("id") not in self._answered_at_exit:
+                self._write_line(line)
+
+    def _write_line(self, line: str):
+        self.output_stream.write(line + "\n")
+        self.output_stream.flush()
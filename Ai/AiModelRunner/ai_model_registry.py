@@ -0,0 +1,424 @@
+"""
+Registry of loaded models.
+Keeps one AiModelCore per (model_name, adapter_path, precision), loads each on
+first use, records how much memory its weights take, and evicts the least
+recently used models when loading another would exceed the memory budget.
+Used by get_model_instance() and by ai_model_server.py to route requests by
+their `model` field.
+"""
+
+import contextlib
+import ctypes
+import gc
+import inspect
+import io
+import os
+import threading
+import time
+from typing import Optional, Dict, Any, Callable, List, Tuple
+
+from ai_model_core import AiModelCore, _import_torch
+from ai_model_metrics import resident_memory_bytes
+
+# Name of the server's main model; requests without a `model` field use it
+DEFAULT_MODEL = "default"
+
+# AiModelCore parameter defaults, so omitted and explicit defaults give the same key
+_CORE_DEFAULTS = {
+    name: parameter.default
+    for name, parameter in inspect.signature(AiModelCore.__init__).parameters.items()
+    if parameter.default is not inspect.Parameter.empty
+}
+
+
+class ModelBudgetExceeded(Exception):
+    """Raised when a model does not fit the memory budget even after evicting every idle model."""
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _normalize(options: Dict[str, Any]) -> Dict[str, Any]:
+    """AiModelCore parameters with defaults filled in and the adapter path normalized."""
+    options = dict(_CORE_DEFAULTS, **options)
+    options["adapter_path"] = os.path.normpath(options["adapter_path"])
+    return options
+
+
+def model_key(options: Dict[str, Any]) -> Tuple[str, str, str]:
+    """(model_name, adapter_path, precision) identifying the model AiModelCore(**options) loads."""
+    options = _normalize(options)
+    return options["model_name"], options["adapter_path"], options["precision"]
+
+
+def model_memory_bytes(model_core: AiModelCore) -> int:
+    """Bytes held by the model's parameters and buffers (tied weights counted once)."""
+    model = model_core.model
+    if model is None:
+        return 0
+    seen = set()
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.device.type == "meta" or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def _import_libraries():
+    """Import what every model needs, so the first int8 load's memory growth is only its own."""
+    _import_torch()
+    with contextlib.redirect_stderr(io.StringIO()):
+        import transformers  # noqa: F401
+        try:
+            import peft  # noqa: F401
+        except ImportError:
+            pass
+
+
+def release_memory():
+    """Collect freed models and hand the allocator's free pages back to the OS where supported."""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        # Not glibc
+        pass
+
+
+class _Entry:
+    """One model: its options and, while loaded, its AiModelCore."""
+
+    def __init__(self, key: Tuple[str, str, str], options: Dict[str, Any], pinned: bool):
+        self.key = key
+        self.options = options
+        self.pinned = pinned
+        self.names: List[str] = []
+        self.model_core: Optional[AiModelCore] = None
+        # Requests currently using the model; it is not evicted while above zero
+        self.in_use = 0
+        self.last_used = 0.0
+        # Measured at the last load, kept after eviction to plan the next one
+        self.memory_bytes = 0
+        self.load_seconds = 0.0
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def label(self) -> str:
+        """Registered name, or model_name for models only loaded through get_model_instance."""
+        return self.names[0] if self.names else self.key[0]
+
+
+class ModelRegistry:
+    """Lazily loaded models under a shared memory budget."""
+
+    def __init__(self,
+                 memory_budget: Optional[int] = None,
+                 on_unload: Optional[Callable[[AiModelCore], None]] = None):
+        """
+        Initialize the registry.
+
+        Args:
+            memory_budget: Bytes all loaded models may take together (None = unlimited)
+            on_unload: Called with each evicted model before it is closed, e.g. to stop its
+                scheduler; the registry lock is not held
+        """
+        self.memory_budget = memory_budget
+        self.on_unload = on_unload
+
+        self._entries: Dict[Tuple[str, str, str], _Entry] = {}
+        self._names: Dict[str, Tuple[str, str, str]] = {}
+        self._default: Optional[str] = None
+        self._lock = threading.RLock()
+        # One load at a time, so each load's memory growth is its own
+        self._load_lock = threading.Lock()
+
+    def register(self, name: str, options: Optional[Dict[str, Any]] = None, pinned: bool = False):
+        """
+        Make a model available under name without loading it.
+
+        Args:
+            name: Name requests use in their `model` field; the first one registered is the default
+            options: AiModelCore parameters
+            pinned: Never evict the model once loaded
+
+        Raises:
+            ValueError: The name is taken, or the same model is registered with different parameters
+        """
+        with self._lock:
+            if name in self._names:
+                raise ValueError(f"Model '{name}' is already registered")
+            entry = self._entry(options or {}, pinned)
+            entry.names.append(name)
+            self._names[name] = entry.key
+            if self._default is None:
+                self._default = name
+
+    def resolve(self, name: Optional[str] = None) -> str:
+        """
+        Map a request's `model` field to a registered name.
+
+        Args:
+            name: Registered name or model_name, or None for the default model
+
+        Raises:
+            ValueError: Unknown model
+        """
+        with self._lock:
+            if name is None:
+                if self._default is None:
+                    raise ValueError("No models are registered")
+                return self._default
+            if not isinstance(name, str):
+                raise ValueError("'model' must be a string")
+            if name in self._names:
+                return name
+            # Responses report model_name, so clients can send it back
+            matches = [entry.names[0] for entry in self._entries.values()
+                       if entry.key[0] == name and entry.names]
+            if len(matches) == 1:
+                return matches[0]
+            if matches:
+                raise ValueError(f"'{name}' is served as several models, choose one of: {', '.join(matches)}")
+            raise ValueError(f"Unknown model '{name}', available: {', '.join(self._names)}")
+
+    def load(self, options: Dict[str, Any]) -> AiModelCore:
+        """
+        Get the model for these AiModelCore parameters, loading it if needed. Models loaded
+        this way are pinned, since the caller may hold on to them.
+
+        Raises:
+            ValueError: The same model is already registered with different parameters
+        """
+        with self._lock:
+            entry = self._entry(options, pinned=True)
+        return self._acquire(entry, hold=False)
+
+    def get(self, name: Optional[str] = None) -> AiModelCore:
+        """
+        Get a registered model, loading it if needed, without holding it. Use acquire()
+        instead unless the model is pinned.
+
+        Raises:
+            ValueError: Unknown model
+            ModelBudgetExceeded: The model does not fit the memory budget
+        """
+        with self._lock:
+            entry = self._entries[self._names[self.resolve(name)]]
+        return self._acquire(entry, hold=False)
+
+    def acquire(self, name: Optional[str] = None) -> AiModelCore:
+        """
+        Get a registered model, loading it if needed, and keep it from being evicted
+        until release() is called.
+
+        Raises:
+            ValueError: Unknown model
+            ModelBudgetExceeded: The model does not fit the memory budget
+        """
+        with self._lock:
+            entry = self._entries[self._names[self.resolve(name)]]
+        return self._acquire(entry, hold=True)
+
+    def release(self, model_core: AiModelCore):
+        """Let a model acquired with acquire() be evicted again."""
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.model_core is model_core:
+                    entry.in_use = max(0, entry.in_use - 1)
+                    entry.last_used = time.monotonic()
+                    return
+
+    @contextlib.contextmanager
+    def use(self, name: Optional[str] = None):
+        """acquire() and release() around a block, yielding the model."""
+        model_core = self.acquire(name)
+        try:
+            yield model_core
+        finally:
+            self.release(model_core)
+
+    def unload(self, name: str) -> bool:
+        """
+        Evict a model now, unless it is in use.
+
+        Returns:
+            True when the model was loaded and is now evicted
+        """
+        evicted: List[AiModelCore] = []
+        with self._lock:
+            entry = self._entries[self._names[self.resolve(name)]]
+            if entry.model_core is None or entry.in_use:
+                return False
+            self._evict(entry, evicted)
+        self._unload(evicted)
+        return True
+
+    def clear(self):
+        """Evict every model, in use or pinned or not, and forget all registrations."""
+        evicted: List[AiModelCore] = []
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.model_core is not None:
+                    self._evict(entry, evicted)
+            self._entries.clear()
+            self._names.clear()
+            self._default = None
+        self._unload(evicted)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Loaded models, their memory and the budget."""
+        now = time.monotonic()
+        with self._lock:
+            models = {}
+            for entry in self._entries.values():
+                model_name, adapter_path, precision = entry.key
+                models[entry.names[0] if entry.names else model_name] = {
+                    "model_name": model_name,
+                    "adapter_path": adapter_path,
+                    "precision": precision,
+                    "aliases": entry.names[1:],
+                    "loaded": entry.model_core is not None,
+                    "pinned": entry.pinned,
+                    "in_use": entry.in_use,
+                    "memory_bytes": entry.memory_bytes,
+                    "load_seconds": entry.load_seconds,
+                    "idle_seconds": now - entry.last_used if entry.model_core is not None else None,
+                    "loads": entry.loads,
+                    "evictions": entry.evictions
+                }
+            return {
+                "default": self._default,
+                "memory_budget_bytes": self.memory_budget,
+                "memory_used_bytes": self._memory_used(),
+                "process_resident_bytes": resident_memory_bytes(),
+                "models": models
+            }
+
+    def _entry(self, options: Dict[str, Any], pinned: bool) -> _Entry:
+        """Find or create the entry for options; call with _lock held."""
+        key = model_key(options)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry(key, dict(options), pinned)
+        elif _normalize(entry.options) != _normalize(options):
+            registered, requested = _normalize(entry.options), _normalize(options)
+            differing = sorted(name for name in registered if registered[name] != requested[name])
+            raise ValueError(f"{key[0]} ({key[2]}, adapters {key[1]}) is already registered with "
+                             f"different {', '.join(differing)}")
+        entry.pinned = entry.pinned or pinned
+        return entry
+
+    def _acquire(self, entry: _Entry, hold: bool) -> AiModelCore:
+        with self._lock:
+            if entry.model_core is not None:
+                return self._touch(entry, hold)
+
+        with self._load_lock:
+            evicted: List[AiModelCore] = []
+            try:
+                with self._lock:
+                    if entry.model_core is not None:
+                        # Loaded by another request while this one waited
+                        return self._touch(entry, hold)
+                    # Sized by its last load; a first load is checked once it is measured
+                    self._make_room(entry, entry.memory_bytes, evicted)
+            finally:
+                # Before loading, so the evicted models' memory is free again
+                self._unload(evicted)
+
+            started = time.perf_counter()
+            _import_libraries()
+            rss_before = resident_memory_bytes()
+            model_core = AiModelCore(**entry.options)
+            rss_after = resident_memory_bytes()
+            measured = model_memory_bytes(model_core)
+            if model_core.precision == "int8" and rss_before is not None and rss_after is not None:
+                # Dynamic quantization packs the weights outside the parameters
+                measured = max(measured, rss_after - rss_before)
+
+            evicted.clear()
+            try:
+                with self._lock:
+                    entry.model_core = model_core
+                    entry.memory_bytes = measured
+                    entry.load_seconds = time.perf_counter() - started
+                    entry.loads += 1
+                    try:
+                        self._make_room(entry, 0, evicted)
+                    except ModelBudgetExceeded:
+                        self._evict(entry, evicted)
+                        raise
+                    budget = f"{self.memory_budget / 2**20:.0f} MB budget" if self.memory_budget else "no budget"
+                    print(f"Loaded model '{entry.label}' ({measured / 2**20:.0f} MB, "
+                          f"{self._memory_used() / 2**20:.0f} MB of {budget} in use)")
+                    return self._touch(entry, hold)
+            finally:
+                self._unload(evicted)
+
+    def _touch(self, entry: _Entry, hold: bool) -> AiModelCore:
+        if hold:
+            entry.in_use += 1
+        entry.last_used = time.monotonic()
+        return entry.model_core
+
+    def _make_room(self, entry: _Entry, extra_bytes: int, evicted: List[AiModelCore]):
+        """
+        Evict least recently used idle models until entry fits the budget; call with _lock held.
+
+        Args:
+            entry: Model being loaded (never evicted here)
+            extra_bytes: Memory entry will add that is not counted yet
+            evicted: Collects the evicted models for _unload(), also when this raises
+        """
+        if not self.memory_budget:
+            return
+        while self._memory_used() + extra_bytes > self.memory_budget:
+            idle = [other for other in self._entries.values()
+                    if other is not entry and other.model_core is not None
+                    and not other.pinned and not other.in_use]
+            if not idle:
+                raise ModelBudgetExceeded(
+                    f"Model '{entry.label}' needs {(self._memory_used() + extra_bytes) / 2**20:.1f} MB with the models "
+                    f"in use, over the {self.memory_budget / 2**20:.1f} MB budget")
+            self._evict(min(idle, key=lambda other: other.last_used), evicted)
+
+    def _evict(self, entry: _Entry, evicted: List[AiModelCore]):
+        """Detach one model and add it to evicted; call with _lock held, then _unload() without it."""
+        evicted.append(entry.model_core)
+        entry.model_core = None
+        entry.in_use = 0
+        entry.evictions += 1
+        print(f"Unloaded model '{entry.label}' ({entry.memory_bytes / 2**20:.0f} MB)")
+
+    def _unload(self, evicted: List[AiModelCore]):
+        """
+        Stop and close evicted models. Called without _lock: on_unload joins the model's
+        scheduler thread, which must not block, or wait on, every other registry call.
+        """
+        for model_core in evicted:
+            if self.on_unload is not None:
+                self.on_unload(model_core)
+            model_core.close()
+        if evicted:
+            release_memory()
+
+    def _memory_used(self) -> int:
+        return sum(entry.memory_bytes for entry in self._entries.values() if entry.model_core is not None)
+
+
+# Shared by get_model_instance() and the server
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """Get the process-wide model registry."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
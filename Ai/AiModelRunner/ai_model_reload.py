@@ -0,0 +1,102 @@
+"""
+Adapter directory watcher for hot reloads.
+Polls the directories of the loaded LoRA adapters and, once simple_train.py or
+qlora_train.py has finished writing new adapter files there, reloads them in the
+background with AiModelCore.reload_adapter (validated, then swapped in between
+requests; the old weights keep serving if the new ones fail).
+Used by ai_model_server.py --watch-adapters.
+"""
+
+import threading
+from typing import Optional, Dict, Any, Callable, Tuple
+
+from ai_model_core import AdapterReloadError, adapter_fingerprint
+
+
+class AdapterWatcher:
+    """Background thread reloading adapters whose files changed on disk."""
+
+    def __init__(self,
+                 model_core,
+                 interval: float = 10.0,
+                 on_reload: Optional[Callable[[str], None]] = None):
+        """
+        Initialize the watcher.
+
+        Args:
+            model_core: Loaded AiModelCore instance
+            interval: Seconds between polls; changed files must also stay unchanged for one
+                interval before they are loaded, so a save in progress is not picked up
+            on_reload: Called with the adapter name after each successful reload
+        """
+        self.model_core = model_core
+        self.interval = interval
+        self.on_reload = on_reload
+
+        # Adapter name -> fingerprint seen changed at the last poll, waiting to settle
+        self._pending: Dict[str, Tuple] = {}
+        # Adapter name -> fingerprint whose reload failed; retried once the files change again
+        self._failed: Dict[str, Tuple] = {}
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._stats = {
+            "polls": 0,
+            "reloads": 0,
+            "failures": 0
+        }
+
+    def start(self):
+        """Start the watcher thread."""
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="adapter-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the watcher thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get watcher counters."""
+        stats = dict(self._stats)
+        stats["interval"] = self.interval
+        stats["pending"] = sorted(self._pending)
+        return stats
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        """Check every adapter once, reloading those whose files changed and have settled."""
+        self._stats["polls"] += 1
+        for name, path in list(self.model_core.adapters.items()):
+            fingerprint = adapter_fingerprint(path)
+            # Compared with what the core loaded, so a worker forked with old weights catches up
+            if (not fingerprint or fingerprint == self.model_core.adapter_fingerprints.get(name)
+                    or fingerprint == self._failed.get(name)):
+                self._pending.pop(name, None)
+                continue
+            if self._pending.get(name) != fingerprint:
+                # Still being written, or changed since the last poll
+                self._pending[name] = fingerprint
+                continue
+            del self._pending[name]
+
+            print(f"Adapter files for '{name}' changed at {path}")
+            try:
+                self.model_core.reload_adapter(name)
+            except (AdapterReloadError, ValueError, OSError) as e:
+                self._failed[name] = fingerprint
+                self._stats["failures"] += 1
+                print(f"Keeping the current '{name}' adapter: {e}")
+                continue
+            self._failed.pop(name, None)
+            self._stats["reloads"] += 1
+            if self.on_reload is not None:
+                self.on_reload(name)
@@ -0,0 +1,546 @@
+"""
+Continuous batching scheduler for the AI model.
+Queues incoming prompts and decodes them together as one left-padded batch.
+New sequences are admitted and finished ones retired between decode steps,
+so concurrent callers share every forward pass instead of taking turns.
+Admission reuses the core's cached chat-template prefixes, so only each
+prompt's suffix is prefilled.
+Used by ai_model_server.py for /chat.
+"""
+
+import copy
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Optional, Dict, Any, List, Tuple
+
+import torch
+
+from ai_model_core import DeadlineExceeded, validate_generation_overrides
+from ai_model_metrics import time_stage, record_generation
+from ai_model_stopping import StopSequenceMatcher, truncate_at_stop
+
+
+class _Sequence:
+    """State for a single generation request."""
+
+    def __init__(self, input_text: str, params: Dict[str, Any], future: Future):
+        self.input_text = input_text
+        self.deadline = params.pop("deadline", None)
+        self.cancel_event = params.pop("cancel_event", None)
+        self.params = params
+        self.future = future
+        self.generated: List[int] = []
+        self.enqueued_at = time.perf_counter()
+        # Filled in at admission, for metrics
+        self.prompt_tokens = 0
+        self.prefill_seconds = 0.0
+        self.first_token_at = 0.0
+        self.stop: Optional[StopSequenceMatcher] = None
+        self.stop_strings: List[str] = []
+        # Resolved adapter name; sequences with different adapters share the batch. Fixed at
+        # submit, so an adapter reload never switches a sequence that is already decoding
+        self.adapter: Optional[str] = None
+        # Until the sequence ends, the core keeps the adapter's weights (see acquire_adapter)
+        self.holds_adapter = False
+
+    def abandoned(self) -> bool:
+        """True once the caller cancelled, gave up or ran past its deadline."""
+        if self.future.cancelled():
+            return True
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+def _cache_layers(cache) -> List[Any]:
+    """Return per-layer cache objects exposing keys/values tensors."""
+    if hasattr(cache, "layers"):
+        return list(cache.layers)
+    # Older transformers keep parallel key/value lists on the cache itself
+    return [_LegacyLayer(cache, i) for i in range(len(cache.key_cache))]
+
+
+class _LegacyLayer:
+    """Adapter giving pre-4.56 DynamicCache the per-layer keys/values interface."""
+
+    def __init__(self, cache, index: int):
+        self._cache = cache
+        self._index = index
+
+    @property
+    def keys(self):
+        return self._cache.key_cache[self._index]
+
+    @keys.setter
+    def keys(self, value):
+        self._cache.key_cache[self._index] = value
+
+    @property
+    def values(self):
+        return self._cache.value_cache[self._index]
+
+    @values.setter
+    def values(self, value):
+        self._cache.value_cache[self._index] = value
+
+
+def _set_layer(layer, keys, values):
+    """Replace the tensors of a cache layer, keeping its length bookkeeping in sync."""
+    layer.keys = keys
+    layer.values = values
+    if hasattr(layer, "cumulative_length"):
+        layer.cumulative_length = keys.shape[-2]
+
+
+def _left_pad(tensor, length: int, dim: int, value=0):
+    """Pad a tensor on the left of `dim` up to `length` (with zeros by default)."""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_full(shape, value), tensor], dim=dim)
+
+
+def _sample(logits, temperature, top_p, do_sample):
+    """Pick the next token per row with per-row temperature, top_p and sampling flag."""
+    greedy = logits.argmax(dim=-1)
+    probs = torch.softmax(logits / temperature.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    # Drop tokens outside the nucleus, always keeping the most likely one
+    outside = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p.unsqueeze(-1)
+    sorted_probs = sorted_probs.masked_fill(outside, 0.0)
+    choice = torch.multinomial(sorted_probs, num_samples=1)
+    sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+    return torch.where(do_sample, sampled, greedy)
+
+
+class BatchScheduler:
+    """Continuous batching scheduler that owns the model's decode loop."""
+
+    def __init__(self,
+                 model_core,
+                 max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0,
+                 max_input_length: int = 512):
+        """
+        Initialize the scheduler.
+
+        Args:
+            model_core: Loaded AiModelCore instance
+            max_batch_size: Maximum sequences decoded together
+            max_wait_ms: Time to wait for more requests before starting an idle batch
+            max_input_length: Prompt truncation length (matches generate_response)
+        """
+        self.model_core = model_core
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_input_length = max_input_length
+
+        self._queue: "queue.Queue[_Sequence]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+        # Updated every loop iteration; lets supervisors detect a stuck decode loop
+        self.last_tick = time.monotonic()
+
+        # Active batch state, touched only by the scheduler thread
+        self._active: List[_Sequence] = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+        self._stop_token_ids = self._collect_stop_token_ids()
+
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "requests_completed": 0,
+            "requests_failed": 0,
+            "requests_abandoned": 0,
+            "decode_steps": 0,
+            "decoded_sequences": 0,
+            "max_batch_size_seen": 0
+        }
+
+    def _collect_stop_token_ids(self) -> set:
+        """EOS ids from the tokenizer and the model's generation config."""
+        ids = set()
+        eos = self.model_core.tokenizer.eos_token_id
+        if eos is not None:
+            ids.add(eos)
+        gen_config = getattr(self.model_core.model, "generation_config", None)
+        config_eos = getattr(gen_config, "eos_token_id", None)
+        if isinstance(config_eos, int):
+            ids.add(config_eos)
+        elif config_eos:
+            ids.update(config_eos)
+        return ids
+
+    def start(self):
+        """Start the background decode loop."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the decode loop and fail anything still pending."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_all(RuntimeError("Scheduler stopped"))
+
+    def submit(self, input_text: str, **kwargs) -> Future:
+        """
+        Queue a prompt for generation.
+
+        Args:
+            input_text: The input prompt
+            **kwargs: Override default generation parameters, plus an optional
+                `deadline` (time.monotonic() value) and `cancel_event`
+
+        Returns:
+            Future resolving to the cleaned response text. Cancelling it, or letting
+            the deadline pass, drops the sequence from the batch at the next step.
+
+        Raises:
+            ValueError: An override is invalid (see validate_generation_overrides)
+        """
+        if not self._running:
+            raise RuntimeError("Scheduler is not running")
+        future: Future = Future()
+        # Invalid overrides raise here instead of failing the whole batch later
+        seq = _Sequence(input_text, validate_generation_overrides(kwargs), future)
+        seq.stop_strings, stop_token_ids = self.model_core._stop_settings(**seq.params)
+        seq.stop = StopSequenceMatcher(self.model_core.tokenizer, seq.stop_strings, stop_token_ids)
+        seq.adapter = self.model_core.acquire_adapter(seq.params.get("adapter"))
+        seq.holds_adapter = True
+        self._queue.put(seq)
+        return future
+
+    def generate(self, input_text: str, timeout: Optional[float] = None, **kwargs) -> str:
+        """
+        Queue a prompt and block until its response is ready.
+
+        Raises:
+            DeadlineExceeded: No response within timeout or before kwargs["deadline"]
+        """
+        deadline = kwargs.get("deadline")
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0.0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        future = self.submit(input_text, **kwargs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise DeadlineExceeded()
+
+    def is_idle(self) -> bool:
+        """True when nothing is queued or being decoded."""
+        return self._queue.empty() and not self._active
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get scheduler counters."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        steps = stats["decode_steps"]
+        stats["average_batch_size"] = stats["decoded_sequences"] / steps if steps else 0.0
+        stats["queue_depth"] = self._queue.qsize()
+        stats["active_sequences"] = len(self._active)
+        stats["max_batch_size"] = self.max_batch_size
+        return stats
+
+    def _run(self):
+        """Scheduler loop: admit, decode one step, retire."""
+        while self._running:
+            self.last_tick = time.monotonic()
+            try:
+                new = self._collect_new()
+                if new:
+                    try:
+                        self._admit(new)
+                    except Exception as e:
+                        # The active batch is untouched until the merge, so only the new sequences fail
+                        self._fail_sequences(new, e)
+                if self._active:
+                    self._retire()
+                if self._active:
+                    self._step()
+                    self._retire()
+            except Exception as e:
+                self._fail_active(e)
+
+    def _collect_new(self) -> List[_Sequence]:
+        """Pull queued requests that fit in the batch."""
+        capacity = self.max_batch_size - len(self._active)
+        new: List[_Sequence] = []
+        if capacity <= 0:
+            return new
+
+        if not self._active:
+            # Idle: block for the first request, then give others a moment to join
+            try:
+                new.append(self._queue.get(timeout=0.1))
+            except queue.Empty:
+                return new
+            deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+            while len(new) < capacity:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    new.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+        while len(new) < capacity:
+            try:
+                new.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Never spend a prefill on requests nobody is waiting for
+        live = []
+        for seq in new:
+            if seq.abandoned():
+                self._abandon(seq)
+            else:
+                live.append(seq)
+        return live
+
+    def _admit(self, new: List[_Sequence]):
+        """Prefill new sequences and merge them into the active batch."""
+        core = self.model_core
+        # Tokenized prompts come from the core's cache
+        prompts = [core.tokenize_prompt(seq.input_text, self.max_input_length) for seq in new]
+        # Rows starting with a precomputed chat-template prefix only prefill the rest
+        prefixes = [core._match_prefix_cache(variant, ids, seq.adapter)
+                    for (variant, ids, _), seq in zip(prompts, new)]
+        skip = [len(prefix[0]) if prefix is not None else 0 for prefix in prefixes]
+        rows = [{name: tensor[:, count:] for name, tensor in row.items()}
+                for (_, _, row), count in zip(prompts, skip)]
+
+        # Left-pad the suffixes into one batch
+        length = max(row["input_ids"].shape[1] for row in rows)
+        input_ids = torch.cat([
+            _left_pad(row["input_ids"], length, 1, core.tokenizer.pad_token_id) for row in rows])
+        attention_mask = torch.cat([_left_pad(row["attention_mask"], length, 1) for row in rows])
+        cache = self._prefix_cache_batch(prefixes)
+        if cache is not None:
+            # Cache columns come first: each row's prefix, left-padded to the longest one
+            width = max(skip)
+            prefix_mask = torch.cat([_left_pad(attention_mask.new_ones((1, count)), width, 1) for count in skip])
+            attention_mask = torch.cat([prefix_mask, attention_mask], dim=1)
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)[:, -length:]
+
+        started = time.perf_counter()
+        with torch.no_grad(), core._use_adapters([seq.adapter for seq in new]):
+            outputs = core.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True
+            )
+        next_tokens = self._pick_tokens(new, outputs.logits[:, -1, :])
+        finished = time.perf_counter()
+        for seq, length in zip(new, attention_mask.sum(dim=1).tolist()):
+            seq.prompt_tokens = length
+            seq.prefill_seconds = finished - started
+            seq.first_token_at = finished
+
+        if not self._active:
+            self._active = new
+            self._cache = outputs.past_key_values
+            self._attention_mask = attention_mask
+            self._next_tokens = next_tokens
+        else:
+            self._merge(new, outputs.past_key_values, attention_mask, next_tokens)
+
+        for seq, token in zip(new, next_tokens.tolist()):
+            seq.generated.append(token)
+        self._record_step(len(new), decode=False)
+
+    def _prefix_cache_batch(self, prefixes: List[Optional[Tuple[List[int], Any]]]):
+        """
+        A fresh KV-cache holding each row's cached prefix, left-padded to the longest one
+        (all padding for rows without a prefix), or None when no row has a prefix.
+        """
+        matched = [prefix for prefix in prefixes if prefix is not None]
+        if not matched:
+            return None
+        width = max(len(prefix_ids) for prefix_ids, _ in matched)
+        # The shared prefix caches are only read; the copy gives a cache object of the model's type to fill
+        cache = copy.deepcopy(matched[0][1])
+        row_layers = [_cache_layers(prefix[1]) if prefix is not None else None for prefix in prefixes]
+        for index, layer in enumerate(_cache_layers(cache)):
+            keys, values = [], []
+            for layers in row_layers:
+                if layers is None:
+                    keys.append(layer.keys.new_zeros(layer.keys.shape[:-2] + (width,) + layer.keys.shape[-1:]))
+                    values.append(layer.values.new_zeros(
+                        layer.values.shape[:-2] + (width,) + layer.values.shape[-1:]))
+                else:
+                    keys.append(_left_pad(layers[index].keys, width, -2))
+                    values.append(_left_pad(layers[index].values, width, -2))
+            _set_layer(layer, torch.cat(keys, dim=0), torch.cat(values, dim=0))
+        return cache
+
+    def _merge(self, new: List[_Sequence], cache, attention_mask, next_tokens):
+        """Append prefilled sequences to the active batch, left-padding to a common length."""
+        length = max(self._attention_mask.shape[1], attention_mask.shape[1])
+        # Build every merged tensor before replacing any, so a failure leaves the batch as it was
+        merged = []
+        for active_layer, new_layer in zip(_cache_layers(self._cache), _cache_layers(cache)):
+            keys = torch.cat([_left_pad(active_layer.keys, length, -2),
+                              _left_pad(new_layer.keys, length, -2)], dim=0)
+            values = torch.cat([_left_pad(active_layer.values, length, -2),
+                                _left_pad(new_layer.values, length, -2)], dim=0)
+            merged.append((active_layer, keys, values))
+        for active_layer, keys, values in merged:
+            _set_layer(active_layer, keys, values)
+        self._attention_mask = torch.cat([_left_pad(self._attention_mask, length, 1),
+                                          _left_pad(attention_mask, length, 1)], dim=0)
+        self._next_tokens = torch.cat([self._next_tokens, next_tokens], dim=0)
+        self._active = self._active + new
+
+    def _step(self):
+        """Run one decode step for every active sequence."""
+        model = self.model_core.model
+        ones = self._attention_mask.new_ones((self._attention_mask.shape[0], 1))
+        self._attention_mask = torch.cat([self._attention_mask, ones], dim=1)
+        position_ids = self._attention_mask.long().sum(dim=1, keepdim=True) - 1
+
+        with torch.no_grad(), self.model_core._use_adapters([seq.adapter for seq in self._active]):
+            outputs = model(
+                input_ids=self._next_tokens.unsqueeze(-1),
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                use_cache=True
+            )
+        self._cache = outputs.past_key_values
+        self._next_tokens = self._pick_tokens(self._active, outputs.logits[:, -1, :])
+
+        for seq, token in zip(self._active, self._next_tokens.tolist()):
+            seq.generated.append(token)
+        self._record_step(len(self._active), decode=True)
+
+    def _pick_tokens(self, seqs: List[_Sequence], logits):
+        """Choose next tokens using each sequence's own generation parameters."""
+        core = self.model_core
+        device = logits.device
+        temperature = torch.tensor(
+            [float(s.params.get("temperature", core.temperature)) for s in seqs], device=device)
+        top_p = torch.tensor(
+            [float(s.params.get("top_p", core.top_p)) for s in seqs], device=device)
+        do_sample = torch.tensor(
+            [bool(s.params.get("do_sample", True)) for s in seqs], device=device)
+        return _sample(logits.float(), temperature, top_p, do_sample)
+
+    def _is_finished(self, seq: _Sequence) -> bool:
+        max_new_tokens = int(seq.params.get("max_new_tokens", self.model_core.max_new_tokens))
+        if seq.generated and seq.generated[-1] in self._stop_token_ids:
+            return True
+        if len(seq.generated) >= max_new_tokens:
+            return True
+        # Stop strings end just this sequence; the rest of the batch keeps decoding
+        return seq.stop is not None and seq.stop.should_stop(seq.generated)
+
+    def _retire(self):
+        """Resolve finished sequences and drop them from the batch."""
+        keep = []
+        for index, seq in enumerate(self._active):
+            if seq.abandoned():
+                self._abandon(seq)
+            elif self._is_finished(seq):
+                self._complete(seq)
+            else:
+                keep.append(index)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        # Trim left padding columns that no remaining sequence needs
+        offset = int((self._attention_mask.cumsum(dim=1) == 0).sum(dim=1).min())
+        self._attention_mask = self._attention_mask[:, offset:]
+        for layer in _cache_layers(self._cache):
+            _set_layer(layer,
+                       layer.keys.index_select(0, index)[:, :, offset:, :],
+                       layer.values.index_select(0, index)[:, :, offset:, :])
+        self._active = [self._active[i] for i in keep]
+
+    def _complete(self, seq: _Sequence):
+        self._release_adapter(seq)
+        core = self.model_core
+        decode_seconds = time.perf_counter() - seq.first_token_at
+        with time_stage("detokenize"):
+            text = core.tokenizer.decode(seq.generated, skip_special_tokens=True)
+            text = truncate_at_stop(text, seq.stop_strings).strip()
+        with time_stage("clean"):
+            response = core._clean_response(text)
+        if not seq.future.done():
+            seq.future.set_result(response)
+        record_generation([seq.prompt_tokens], [len(seq.generated)], seq.prefill_seconds, decode_seconds)
+        with self._stats_lock:
+            self._stats["requests_completed"] += 1
+
+    def _abandon(self, seq: _Sequence):
+        self._release_adapter(seq)
+        if not seq.future.done():
+            seq.future.set_exception(DeadlineExceeded())
+        with self._stats_lock:
+            self._stats["requests_abandoned"] += 1
+
+    def _release_adapter(self, seq: _Sequence):
+        # A sequence can reach more than one of the exits after a failure mid-retire
+        if seq.holds_adapter:
+            seq.holds_adapter = False
+            self.model_core.release_adapter(seq.adapter)
+
+    def _record_step(self, batch_size: int, decode: bool):
+        with self._stats_lock:
+            if decode:
+                self._stats["decode_steps"] += 1
+                self._stats["decoded_sequences"] += batch_size
+            self._stats["max_batch_size_seen"] = max(self._stats["max_batch_size_seen"], batch_size)
+
+    def _reset(self):
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _fail_active(self, error: Exception):
+        """Fail every in-flight sequence after a model error and start a fresh batch."""
+        self._fail_sequences(self._active, error)
+        self._reset()
+
+    def _fail_sequences(self, seqs: List[_Sequence], error: Exception):
+        for seq in seqs:
+            self._release_adapter(seq)
+            if not seq.future.done():
+                seq.future.set_exception(error)
+        with self._stats_lock:
+            self._stats["requests_failed"] += len(seqs)
+
+    def _fail_all(self, error: Exception):
+        self._fail_active(error)
+        while True:
+            try:
+                seq = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self._release_adapter(seq)
+            if not seq.future.done():
+                seq.future.set_exception(error)
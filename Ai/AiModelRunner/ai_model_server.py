@@ -5,30 +5,245 @@ Uses the shared ai_model_core for model functionality.
 
 import os
 import sys
-from flask import Flask, request, jsonify
+import argparse
+import hmac
+import json
+import random
+import threading
+import time
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 
 # Import the shared model core
-from ai_model_core import get_model_instance
+from ai_model_core import (
+    DeadlineExceeded,
+    AdapterReloadError,
+    DEFAULT_ADAPTER,
+    PRECISIONS,
+    validate_generation_overrides
+)
+from ai_model_admission import AdmissionController, QueueFullError
+import ai_model_metrics as metrics
+from ai_model_scheduler import BatchScheduler
+from ai_model_pool import SuggestionPool
+from ai_model_registry import get_registry, ModelBudgetExceeded, DEFAULT_MODEL
+from ai_model_reload import AdapterWatcher
+from ai_model_prefork import PreforkSupervisor
+from ai_model_threads import (
+    DEFAULT_THREAD_CONFIG,
+    available_cores,
+    load_thread_config,
+    apply_thread_settings,
+    worker_cpus,
+    pin_to_cpus
+)
 
 # Create Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for cross-origin requests
 
-# Initialize the model (singleton - loaded once)
-print("Initializing AI Model for Flask server...")
-model_core = get_model_instance()
+# Model and scheduler are created by init_server() before the app starts
+model_core = None
+scheduler = None
+# Models requests can pick with 'model'; model_core is its pinned default
+registry = None
+# Model -> its batching scheduler; models other than the default get theirs on first use
+schedulers = {}
+schedulers_lock = threading.Lock()
+# BatchScheduler arguments, None when batching is disabled
+scheduler_options = None
+suggestion_pool = None
+admission = None
+adapter_watcher = None
+# Seconds a request may take when it does not send its own timeout (0 = no limit)
+default_timeout = 30.0
+# Index of this process in multi-worker mode
+worker_index = None
+# Required in X-Admin-Token by the /admin endpoints; without one only local clients may use them
+admin_token = None
+
+
+def init_server(model_options: dict = None, models: dict = None, memory_budget: int = None, **service_options):
+    """Load the default model, register the others, and start the batching scheduler and the suggestion pool."""
+    load_model(model_options, models, memory_budget)
+    start_services(**service_options)
+
+
+def load_model(model_options: dict = None, models: dict = None, memory_budget: int = None):
+    """
+    Load the default model and register the models loaded on first use.
+    
+    Args:
+        model_options: AiModelCore parameters of the default model
+        models: Name -> AiModelCore parameters of further models requests can pick
+        memory_budget: Bytes all loaded models may take together (None = unlimited)
+    """
+    global model_core, registry
+    print("Initializing AI Model for Flask server...")
+    registry = get_registry()
+    registry.memory_budget = memory_budget
+    registry.on_unload = model_unloaded
+    registry.register(DEFAULT_MODEL, model_options or {}, pinned=True)
+    for name, options in (models or {}).items():
+        registry.register(name, options)
+    model_core = registry.get(DEFAULT_MODEL)
+
+
+def start_services(batching: bool = True, max_batch_size: int = 16, max_wait_ms: float = 5.0,
+                   pool: bool = True, pool_size: int = 200, pool_low_watermark: int = None,
+                   pool_high_watermark: int = None, pool_batch_size: int = 16,
+                   max_queue_depth: int = 64, request_timeout: float = 30.0, watch_adapters: float = 0.0):
+    """Set up admission control and start the batching scheduler, suggestion pool and adapter watcher threads."""
+    global scheduler, scheduler_options, suggestion_pool, admission, adapter_watcher, default_timeout
+    admission = AdmissionController(max_queue_depth=max_queue_depth)
+    default_timeout = request_timeout
+    metrics.IN_FLIGHT.set_function(lambda: admission.get_stats()["in_flight"])
+    
+    if batching:
+        scheduler_options = dict(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        scheduler = scheduler_for(model_core)
+        metrics.QUEUE_DEPTH.set_function(lambda: scheduler.get_stats()["queue_depth"])
+        metrics.ACTIVE_SEQUENCES.set_function(lambda: scheduler.get_stats()["active_sequences"])
+    
+    if pool:
+        suggestion_pool = SuggestionPool(
+            model_core,
+            pool_size=pool_size,
+            low_watermark=pool_low_watermark,
+            high_watermark=pool_high_watermark,
+            refill_batch_size=pool_batch_size,
+            idle_check=scheduler.is_idle if scheduler is not None else None
+        )
+        suggestion_pool.start()
+    
+    if watch_adapters > 0:
+        adapter_watcher = AdapterWatcher(model_core, interval=watch_adapters, on_reload=adapter_reloaded)
+        adapter_watcher.start()
+
+
+def scheduler_for(core):
+    """The batching scheduler of a model, started on its first request (None without batching)."""
+    if scheduler_options is None:
+        return None
+    with schedulers_lock:
+        core_scheduler = schedulers.get(core)
+        if core_scheduler is None:
+            core_scheduler = schedulers[core] = BatchScheduler(core, **scheduler_options)
+            core_scheduler.start()
+        return core_scheduler
+
+
+def model_unloaded(core):
+    """Stop the scheduler of a model the registry evicts."""
+    with schedulers_lock:
+        core_scheduler = schedulers.pop(core, None)
+    if core_scheduler is not None:
+        core_scheduler.stop()
+
+
+def adapter_reloaded(name):
+    """Drop pooled suggestions generated with the default adapter's old weights."""
+    if name == DEFAULT_ADAPTER and suggestion_pool is not None:
+        suggestion_pool.clear()
+
+
+def get_generation_overrides(data):
+    """
+    Collect optional generation parameter overrides from a request body.
+    
+    Raises:
+        ValueError: A numeric override is invalid (answered with 400 before it reaches a batch)
+    """
+    gen_params = {}
+    if 'temperature' in data:
+        gen_params['temperature'] = data['temperature']
+    if 'max_new_tokens' in data:
+        gen_params['max_new_tokens'] = data['max_new_tokens']
+    if 'top_p' in data:
+        gen_params['top_p'] = data['top_p']
+    if 'stop' in data:
+        gen_params['stop'] = data['stop']
+    if 'stop_token_ids' in data:
+        gen_params['stop_token_ids'] = data['stop_token_ids']
+    if 'adapter' in data:
+        gen_params['adapter'] = data['adapter']
+    return validate_generation_overrides(gen_params)
+
+
+def get_deadline(data):
+    """
+    Absolute time.monotonic() deadline for a request.
+    
+    Taken from the body's 'timeout' field or the X-Request-Timeout header (seconds),
+    falling back to the server default. Returns None when there is no limit.
+    """
+    timeout = data.get('timeout', request.headers.get('X-Request-Timeout', default_timeout))
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise ValueError("'timeout' must be a number of seconds")
+    if timeout <= 0:
+        return None
+    return time.monotonic() + timeout
+
+
+def endpoint_label():
+    """Route pattern for metrics labels, so unknown paths do not create new series."""
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """Count every request; streamed responses record their duration when the stream closes"""
+    endpoint = endpoint_label()
+    metrics.REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if not response.is_streamed and "request_started" in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+
+@app.errorhandler(QueueFullError)
+def queue_full(e):
+    """Reject quickly when the request queue is full"""
+    response = jsonify({"error": str(e)})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(ModelBudgetExceeded)
+def model_budget_exceeded(e):
+    """The requested model does not fit the memory budget while the other models are busy"""
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    """The request's deadline passed before generation finished"""
+    return jsonify({"error": str(e)}), 504
 
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
     model_info = model_core.get_model_info()
-    return jsonify({
+    health = {
         "status": "ready",
         "model": model_info["model_name"],
         "adapter_loaded": model_info["adapter_loaded"]
-    })
+    }
+    if worker_index is not None:
+        health["worker"] = worker_index
+        health["pid"] = os.getpid()
+    return jsonify(health)
 
 
 @app.route('/chat', methods=['POST'])
@@ -36,53 +251,503 @@ def chat():
     """Chat endpoint that processes messages and returns AI responses"""
     try:
         data = request.get_json()
-        if not data or 'message' not in data:
+        if not isinstance(data, dict) or 'message' not in data:
             return jsonify({"error": "Missing 'message' field"}), 400
         
         message = data['message']
-        if not message.strip():
+        if not isinstance(message, str) or not message.strip():
             return jsonify({"error": "Message cannot be empty"}), 400
         
-        # Optional: Allow client to override generation parameters
-        gen_params = {}
-        if 'temperature' in data:
-            gen_params['temperature'] = data['temperature']
-        if 'max_new_tokens' in data:
-            gen_params['max_new_tokens'] = data['max_new_tokens']
-        if 'top_p' in data:
-            gen_params['top_p'] = data['top_p']
+        try:
+            # Optional: Allow client to override generation parameters
+            gen_params = get_generation_overrides(data)
+            deadline = get_deadline(data)
+            model_name = registry.resolve(data.get('model'))
+            allow_pool = data.get('pool', True)
+            if not isinstance(allow_pool, bool):
+                raise ValueError("'pool' must be true or false")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Answer the habit-suggestion prompt from the pre-generated pool when possible;
+        # "pool": false asks for a freshly generated answer (e.g. load tests measuring inference)
+        use_pool = (suggestion_pool is not None and allow_pool and model_name == DEFAULT_MODEL
+                    and not gen_params and suggestion_pool.matches(message))
+        client_id = data.get('client_id') or request.remote_addr
+        response = suggestion_pool.take(client_id) if use_pool else None
+        pooled = response is not None
         
-        # Generate response using the model core
-        response = model_core.generate_response(message, **gen_params)
+        with registry.use(model_name) as core:
+            try:
+                # Malformed stop settings are answered here and never reach the shared batch
+                core._stop_settings(**gen_params)
+                core.resolve_adapter(gen_params.get('adapter'))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            
+            if response is None:
+                # Generate response, sharing decode steps with concurrent requests when batching
+                with admission.admit():
+                    core_scheduler = scheduler_for(core)
+                    if core_scheduler is not None:
+                        response = core_scheduler.generate(message, deadline=deadline, **gen_params)
+                    else:
+                        response = core.generate_response(message, deadline=deadline, **gen_params)
+                if use_pool:
+                    suggestion_pool.remember(client_id, response)
         
         return jsonify({
             "response": response,
-            "model": model_core.model_name,
+            "model": core.model_name,
+            "pooled": pooled,
             "status": "success"
         })
         
+    except (QueueFullError, DeadlineExceeded, ModelBudgetExceeded):
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming chat endpoint that sends tokens as Server-Sent Events while they are decoded"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'message' not in data:
+        return jsonify({"error": "Missing 'message' field"}), 400
+    
+    message = data['message']
+    if not isinstance(message, str) or not message.strip():
+        return jsonify({"error": "Message cannot be empty"}), 400
+    
+    try:
+        gen_params = get_generation_overrides(data)
+        gen_params['deadline'] = get_deadline(data)
+        model_name = registry.resolve(data.get('model'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Held until the stream closes so the model is not evicted under it
+    core = registry.acquire(model_name)
+    try:
+        core._stop_settings(**gen_params)
+        core.resolve_adapter(gen_params.get('adapter'))
+        admission.acquire()
+    except ValueError as e:
+        registry.release(core)
+        return jsonify({"error": str(e)}), 400
+    except QueueFullError:
+        registry.release(core)
+        raise
+    started = time.perf_counter()
+    # Set when the client disconnects so generation stops at the next token
+    cancel_event = threading.Event()
+    
+    def events():
+        try:
+            for event in core.generate_stream(message, cancel_event=cancel_event, **gen_params):
+                name = event.pop("event")
+                if name == "done":
+                    event["model"] = core.model_name
+                    event["status"] = "success"
+                yield f"event: {name}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            cancel_event.set()
+    
+    def release():
+        cancel_event.set()
+        admission.release(time.perf_counter() - started)
+        registry.release(core)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="/chat/stream")
+    
+    response = Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Runs even when the client goes away before the first event is sent
+    response.call_on_close(release)
+    return response
+
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    """Batch chat endpoint that generates responses for a list of messages in one pass"""
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict) or 'messages' not in data:
+            return jsonify({"error": "Missing 'messages' field"}), 400
+        
+        messages = data['messages']
+        if not isinstance(messages, list) or not messages:
+            return jsonify({"error": "'messages' must be a non-empty list"}), 400
+        if any(not isinstance(m, str) or not m.strip() for m in messages):
+            return jsonify({"error": "Messages cannot be empty"}), 400
+        
+        try:
+            gen_params = get_generation_overrides(data)
+            if 'batch_size' in data:
+                batch_size = data['batch_size']
+                # JSON true/false would otherwise pass as 1 and 0
+                if isinstance(batch_size, bool) or not isinstance(batch_size, int) or batch_size < 1:
+                    raise ValueError("'batch_size' must be a positive integer")
+                gen_params['batch_size'] = batch_size
+            gen_params['deadline'] = get_deadline(data)
+            model_name = registry.resolve(data.get('model'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        with registry.use(model_name) as core:
+            try:
+                # Malformed stop settings are answered here and never reach the shared batch
+                core._stop_settings(**gen_params)
+                core.resolve_adapter(gen_params.get('adapter'))
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+            with admission.admit():
+                responses = core.generate_batch(messages, **gen_params)
+        
+        return jsonify({
+            "responses": responses,
+            "model": core.model_name,
+            "status": "success"
+        })
+        
+    except (QueueFullError, DeadlineExceeded, ModelBudgetExceeded):
+        raise
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def check_admin():
+    """Error response for callers not allowed to use the /admin endpoints, else None."""
+    if admin_token:
+        allowed = hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token)
+    else:
+        allowed = request.remote_addr in ('127.0.0.1', '::1')
+    if not allowed:
+        return jsonify({"error": "Admin endpoints need X-Admin-Token or a local client"}), 403
+    if worker_index is not None:
+        # The request reaches one worker, and each worker holds its own adapter weights
+        return jsonify({"error": "With --workers, reload adapters with --watch-adapters"}), 409
+    return None
+
+
+def get_admin_adapter(data):
+    """Adapter name from an /admin request body, defaulting to adapter_path's."""
+    name = data.get('adapter', DEFAULT_ADAPTER)
+    if not isinstance(name, str):
+        raise ValueError("'adapter' must be a string")
+    return name
+
+
+@app.route('/admin/adapters/reload', methods=['POST'])
+def reload_adapter():
+    """Load new weights for an adapter in this request's thread and swap them in once validated"""
+    denied = check_admin()
+    if denied is not None:
+        return denied
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        name = get_admin_adapter(data)
+        path = data.get('path')
+        if path is not None and not isinstance(path, str):
+            raise ValueError("'path' must be a string")
+        result = model_core.reload_adapter(name, path)
+    except (ValueError, FileNotFoundError) as e:
+        return jsonify({"error": str(e)}), 400
+    except AdapterReloadError as e:
+        # The previous weights are still being served
+        return jsonify({"error": str(e), "path": model_core.adapters.get(name)}), 422
+    
+    adapter_reloaded(name)
+    return jsonify(dict(result, status="success"))
+
+
+@app.route('/admin/adapters/rollback', methods=['POST'])
+def rollback_adapter():
+    """Swap an adapter back to the weights its last reload replaced"""
+    denied = check_admin()
+    if denied is not None:
+        return denied
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        name = get_admin_adapter(data)
+        result = model_core.rollback_adapter(name)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    adapter_reloaded(name)
+    return jsonify(dict(result, status="success"))
+
+
 @app.route('/model-info', methods=['GET'])
 def model_info():
     """Get information about the loaded model"""
-    return jsonify(model_core.get_model_info())
+    info = model_core.get_model_info()
+    info["admission"] = admission.get_stats()
+    if scheduler is not None:
+        info["scheduler"] = scheduler.get_stats()
+    if suggestion_pool is not None:
+        info["suggestion_pool"] = suggestion_pool.get_stats()
+    if adapter_watcher is not None:
+        info["adapter_watcher"] = adapter_watcher.get_stats()
+    info["models"] = registry.get_stats()
+    return jsonify(info)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics: request counts and latency, per-stage inference timings, tokens, queue and memory"""
+    const_labels = {"worker": str(worker_index)} if worker_index is not None else None
+    return Response(metrics.REGISTRY.render(const_labels), mimetype="text/plain; version=0.0.4")
+
+
+def run_worker(context, service_options: dict, threads_per_worker: int, health_timeout: float,
+               inter_op_threads: int = None, pin: bool = False):
+    """Serve requests in a forked worker that shares the master's model weights."""
+    global worker_index
+    import torch
+    from werkzeug.serving import make_server
+    
+    worker_index = context.index
+    
+    # Split the cores between workers and give each its own sampling stream
+    cpus = None
+    if pin:
+        cpus = worker_cpus(context.index, threads_per_worker)
+        if not pin_to_cpus(cpus):
+            cpus = None
+    apply_thread_settings(threads_per_worker, inter_op_threads)
+    seed = int.from_bytes(os.urandom(4), "little")
+    torch.manual_seed(seed)
+    random.seed(seed)
+    
+    start_services(**service_options)
+    
+    def heartbeat():
+        while True:
+            # A decode loop stuck for longer than the health timeout stops the heartbeat
+            if scheduler is None or time.monotonic() - scheduler.last_tick < health_timeout:
+                context.beat()
+            time.sleep(1.0)
+    
+    threading.Thread(target=heartbeat, name="worker-heartbeat", daemon=True).start()
+    
+    server = make_server(context.sock.getsockname()[0], context.sock.getsockname()[1], app,
+                         threaded=True, fd=context.sock.fileno())
+    print(f"Worker {context.index} (pid {os.getpid()}) ready with {threads_per_worker} threads"
+          f"{' on cpus ' + ','.join(map(str, cpus)) if cpus else ''}")
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+def parse_adapters(specs):
+    """Turn NAME=PATH arguments into an adapter dict."""
+    adapters = {}
+    for spec in specs:
+        name, sep, path = spec.partition("=")
+        if not sep or not name or not path:
+            raise SystemExit(f"Invalid adapter '{spec}', expected NAME=PATH")
+        adapters[name] = path
+    return adapters
+
+
+def parse_models(specs, base_options):
+    """
+    Turn NAME=MODEL[,adapter=PATH][,precision=P] arguments into AiModelCore parameters.
+    Models run without LoRA adapters unless adapter= is given.
+    """
+    models = {}
+    for spec in specs:
+        name, sep, rest = spec.partition("=")
+        model, *settings = rest.split(",")
+        if not sep or not name or not model:
+            raise SystemExit(f"Invalid model '{spec}', expected NAME=MODEL[,adapter=PATH][,precision=P]")
+        if name == DEFAULT_MODEL:
+            raise SystemExit(f"Model name '{DEFAULT_MODEL}' is reserved for the main model")
+        options = {
+            "model_name": model,
+            "adapter_path": "./no_adapter",
+            "snapshot_dir": None,
+            "thread_config": base_options.get("thread_config")
+        }
+        for setting in settings:
+            key, _, value = setting.partition("=")
+            if key == "adapter" and value:
+                options["adapter_path"] = value
+            elif key == "precision" and value in PRECISIONS:
+                options["precision"] = value
+            else:
+                raise SystemExit(f"Invalid setting '{setting}' for model '{name}', "
+                                 f"expected adapter=PATH or precision={'|'.join(PRECISIONS)}")
+        models[name] = options
+    return models
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="AI Model Flask server")
+    parser.add_argument("--host", default="localhost", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes forked after loading the model once (Linux only)")
+    parser.add_argument("--threads-per-worker", type=int, default=None,
+                        help="Intra-op threads per worker (default: the thread config, else available cores / workers)")
+    parser.add_argument("--pin-workers", action="store_true",
+                        help="Pin each worker to its own block of cores (Linux only)")
+    parser.add_argument("--thread-config", default=DEFAULT_THREAD_CONFIG,
+                        help="Tuned thread counts and batch size written by tune_threads.py, used when present")
+    parser.add_argument("--worker-health-timeout", type=float, default=60.0,
+                        help="Seconds without a heartbeat before a worker is restarted")
+    parser.add_argument("--stub", action="store_true",
+                        help="Serve the tiny random stand-in model (tiny_model.py) instead of the real weights")
+    parser.add_argument("--tiny-model-dir", default=None,
+                        help="Where --stub builds and caches the tiny model (default: ./tiny_model)")
+    parser.add_argument("--model", default=None,
+                        help="Model name or path, e.g. a checkpoint written by merge_adapters.py")
+    parser.add_argument("--adapter", default=None,
+                        help="Path to LoRA adapters")
+    parser.add_argument("--adapters", nargs="+", default=[], metavar="NAME=PATH",
+                        help="More LoRA adapters served on the same base weights; requests pick one with 'adapter'")
+    parser.add_argument("--merge-adapters", action="store_true",
+                        help="Merge LoRA adapters into the base weights at load time")
+    parser.add_argument("--models", nargs="+", default=[], metavar="NAME=MODEL[,adapter=PATH][,precision=P]",
+                        help="More models requests can pick with 'model', loaded on first use")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="GB",
+                        help="RAM all loaded models may take together; least recently used ones are unloaded "
+                             "to stay under it (per worker with --workers)")
+    parser.add_argument("--watch-adapters", type=float, nargs="?", const=10.0, default=0.0, metavar="SECONDS",
+                        help="Reload adapters whose files change on disk, polling every SECONDS (default 10)")
+    parser.add_argument("--admin-token", default=os.environ.get("AI_MODEL_ADMIN_TOKEN"),
+                        help="Token required in X-Admin-Token by /admin endpoints "
+                             "(default: $AI_MODEL_ADMIN_TOKEN; without one only local clients may use them)")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32",
+                        help="Weight precision (int8 = dynamic quantization of Linear layers)")
+    parser.add_argument("--no-batching", action="store_true",
+                        help="Generate each request on its own instead of using the batching scheduler")
+    parser.add_argument("--max-batch-size", type=int, default=None,
+                        help="Maximum sequences decoded together (default: the thread config, else 16)")
+    parser.add_argument("--batch-wait-ms", type=float, default=5.0,
+                        help="Time to wait for more requests before starting an idle batch")
+    parser.add_argument("--no-suggestion-pool", action="store_true",
+                        help="Generate every habit suggestion on demand instead of from the pool")
+    parser.add_argument("--pool-size", type=int, default=200,
+                        help="Maximum pre-generated habit suggestions held")
+    parser.add_argument("--pool-low-watermark", type=int, default=None,
+                        help="Refill the pool when it drops below this size (default: pool size / 4)")
+    parser.add_argument("--pool-high-watermark", type=int, default=None,
+                        help="Stop refilling once the pool reaches this size (default: pool size)")
+    parser.add_argument("--pool-batch-size", type=int, default=16,
+                        help="Suggestions generated per background batch")
+    parser.add_argument("--max-queue-depth", type=int, default=64,
+                        help="Generation requests queued or running before new ones get 429 (0 = unlimited)")
+    parser.add_argument("--request-timeout", type=float, default=30.0,
+                        help="Default request deadline in seconds when the client sends none (0 = no limit)")
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = parse_args()
+    model_options = {"merge_adapters": args.merge_adapters, "precision": args.precision}
+    # A config tuned for a different worker count splits the cores differently; ignore it
+    tuned = load_thread_config(args.thread_config) or {}
+    if tuned.get("workers", 1) != args.workers:
+        tuned = {}
+    max_batch_size = args.max_batch_size or tuned.get("max_batch_size", 16)
+    if args.workers > 1:
+        # Workers set their own thread counts after the fork
+        model_options["thread_config"] = None
+    else:
+        model_options["thread_config"] = args.thread_config
+        if args.threads_per_worker:
+            model_options["num_threads"] = args.threads_per_worker
+    if args.model:
+        model_options["model_name"] = args.model
+    if args.adapter:
+        model_options["adapter_path"] = args.adapter
+    if args.adapters:
+        model_options["adapters"] = parse_adapters(args.adapters)
+    if args.stub:
+        from tiny_model import build_tiny_model, DEFAULT_TINY_MODEL_DIR
+        
+        # Real server code paths, but with a model small enough for any laptop
+        tiny = build_tiny_model(args.tiny_model_dir or DEFAULT_TINY_MODEL_DIR)
+        model_options["model_name"] = tiny["model_path"]
+        model_options["adapter_path"] = tiny["adapter_path"] or "./no_adapter"
+        model_options["snapshot_dir"] = None
+    models = parse_models(args.models, model_options)
+    memory_budget = int(args.memory_budget * 2**30) if args.memory_budget else None
+    
+    service_options = dict(
+        batching=not args.no_batching,
+        max_batch_size=max_batch_size,
+        max_wait_ms=args.batch_wait_ms,
+        pool=not args.no_suggestion_pool,
+        pool_size=args.pool_size,
+        pool_low_watermark=args.pool_low_watermark,
+        pool_high_watermark=args.pool_high_watermark,
+        pool_batch_size=args.pool_batch_size,
+        max_queue_depth=args.max_queue_depth,
+        request_timeout=args.request_timeout,
+        watch_adapters=args.watch_adapters
+    )
+    admin_token = args.admin_token
+    
+    if args.workers > 1:
+        import torch
+        
+        # The master never runs the model multi-threaded, so forked workers start
+        # with a clean OpenMP state; each worker sets its own thread count
+        torch.set_num_threads(1)
+        load_model(model_options, models, memory_budget)
+        
+        threads_per_worker = (args.threads_per_worker or tuned.get("intra_op_threads")
+                              or max(1, available_cores() // args.workers))
+        pin = args.pin_workers or bool(tuned.get("pin_workers"))
+        supervisor = PreforkSupervisor(
+            lambda context: run_worker(context, service_options, threads_per_worker,
+                                       args.worker_health_timeout,
+                                       inter_op_threads=tuned.get("inter_op_threads"), pin=pin),
+            num_workers=args.workers,
+            host=args.host,
+            port=args.port,
+            health_timeout=args.worker_health_timeout
+        )
+        supervisor.serve_forever()
+        sys.exit(0)
+    
+    init_server(model_options=model_options, models=models, memory_budget=memory_budget, **service_options)
+    
     print("AI Model Server starting...")
     model_info = model_core.get_model_info()
     print(f"Model: {model_info['model_name']}")
-    print(f"LoRA adapters: {'Loaded' if model_info['adapter_loaded'] else 'Not found'}")
-    print(f"Device: {model_info['device']}")
-    print("\nServer will be available at: http://localhost:5000")
+    print(f"LoRA adapters: {'Loaded' if model_info['adapter_loaded'] else 'Not found'}"
+          f"{' (merged)' if model_info['adapters_merged'] else ''}")
+    if len(model_info['adapters']) > 1:
+        print(f"Adapters: {', '.join(model_info['adapter_names'])}")
+    print(f"Device: {model_info['device']} ({model_info['precision']})")
+    if models:
+        print(f"More models (loaded on first use): {', '.join(models)}"
+              f"{', budget ' + str(args.memory_budget) + ' GB' if memory_budget else ''}")
+    print(f"Batching: {'max ' + str(max_batch_size) + ' sequences' if scheduler else 'Disabled'}")
+    print(f"Suggestion pool: {str(args.pool_size) + ' suggestions' if suggestion_pool else 'Disabled'}")
+    if adapter_watcher is not None:
+        print(f"Watching adapter files every {args.watch_adapters:g}s")
+    print(f"Queue depth: {args.max_queue_depth or 'unlimited'}, "
+          f"default timeout: {str(args.request_timeout) + 's' if args.request_timeout > 0 else 'none'}")
+    base_url = f"http://{args.host}:{args.port}"
+    print(f"\nServer will be available at: {base_url}")
     print("Endpoints:")
-    print("  - Health check: GET http://localhost:5000/health")
-    print("  - Chat: POST http://localhost:5000/chat")
-    print("  - Model info: GET http://localhost:5000/model-info")
+    print(f"  - Health check: GET {base_url}/health")
+    print(f"  - Chat: POST {base_url}/chat")
+    print(f"  - Streaming chat: POST {base_url}/chat/stream")
+    print(f"  - Batch chat: POST {base_url}/chat/batch")
+    print(f"  - Model info: GET {base_url}/model-info")
+    print(f"  - Metrics: GET {base_url}/metrics")
+    print(f"  - Reload adapters: POST {base_url}/admin/adapters/reload")
     print("\nPress Ctrl+C to stop the server")
     
     # Start the Flask server
-    app.run(host='localhost', port=5000, debug=False, threaded=True)
\ No newline at end of file
+    app.run(host=args.host, port=args.port, debug=False, threaded=True)
\ No newline at end of file
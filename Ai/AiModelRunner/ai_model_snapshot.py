@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Compile a ready-to-run model snapshot for fast cold starts.
+Loads the base model once through from_pretrained, merges the LoRA adapters and
+stores the resulting weights in a single file that AiModelCore maps lazily with
+torch.load(mmap=True). Later starts of ai_model_server.py, AiModelServiceRunner.py
+and ai_model_test_wrapper.py pick the snapshot up automatically from ./model_snapshot.
+
+Usage:
+    python ai_model_snapshot.py
+    python ai_model_snapshot.py --precision bfloat16 --output ./model_snapshot
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+
+from ai_model_core import (
+    AiModelCore,
+    PRECISIONS,
+    DEFAULT_SNAPSHOT_DIR,
+    SNAPSHOT_MANIFEST,
+    SNAPSHOT_WEIGHTS
+)
+
+# Bump when the snapshot layout changes
+SNAPSHOT_VERSION = 1
+
+
+def _extra_tensors(model, state_keys) -> dict:
+    """Tensors a freshly built model needs that are not part of its state dict."""
+    extras = {}
+    for module_name, module in model.named_modules():
+        candidates = list(module._buffers.items())
+        candidates += [(k, v) for k, v in vars(module).items() if isinstance(v, torch.Tensor)]
+        for attribute, value in candidates:
+            key = f"{module_name}.{attribute}" if module_name else attribute
+            if value is not None and key not in state_keys:
+                extras[key] = value
+    return extras
+
+
+def compile_snapshot(output_dir: str, model_name: str, adapter_path: str, precision: str = "float32"):
+    """Load, merge and write the snapshot for the given configuration."""
+    from transformers.dynamic_module_utils import custom_object_save
+    
+    # int8 is applied at load time; its packed weights are not memory-mappable
+    dtype = "bfloat16" if precision == "bfloat16" else "float32"
+    model_core = AiModelCore(
+        model_name=model_name,
+        adapter_path=adapter_path,
+        prefix_cache=False,
+        merge_adapters=True,
+        precision=dtype,
+        snapshot_dir=None
+    )
+    model = model_core.model
+    
+    print(f"\nWriting snapshot to {output_dir}...")
+    os.makedirs(output_dir, exist_ok=True)
+    state_dict = model.state_dict()
+    torch.save(
+        {"state_dict": state_dict, "extra_tensors": _extra_tensors(model, set(state_dict))},
+        os.path.join(output_dir, SNAPSHOT_WEIGHTS)
+    )
+    model.config.save_pretrained(output_dir)
+    model.generation_config.save_pretrained(output_dir)
+    model_core.tokenizer.save_pretrained(output_dir)
+    
+    # Remote-code models (Phi-3.5) need their modeling files next to the config
+    if getattr(model, "_auto_class", None) is not None:
+        custom_object_save(model, output_dir, config=model.config)
+    
+    adapter = os.path.abspath(adapter_path) if model_core.adapter_loaded else None
+    with open(os.path.join(output_dir, SNAPSHOT_MANIFEST), "w") as f:
+        json.dump({
+            "version": SNAPSHOT_VERSION,
+            "model_name": model_name,
+            "adapter_path": adapter,
+            "dtype": dtype,
+            "torch_version": torch.__version__,
+            "created": time.time()
+        }, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile a memory-mapped model snapshot")
+    parser.add_argument("--model", default="microsoft/Phi-3.5-mini-instruct", help="Base model name or path")
+    parser.add_argument("--adapter", default="./fine_tuned_phi_habits", help="Path to LoRA adapters")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32",
+                        help="Precision the snapshot will be served with")
+    parser.add_argument("--output", default=DEFAULT_SNAPSHOT_DIR, help="Snapshot directory")
+    args = parser.parse_args()
+    
+    started = time.perf_counter()
+    compile_snapshot(args.output, args.model, args.adapter, args.precision)
+    print(f"\n✅ Snapshot compiled in {time.perf_counter() - started:.1f}s: {args.output}")
+    
+    # Time a cold load through the snapshot path
+    print("\nVerifying snapshot load...")
+    model_core = AiModelCore(
+        model_name=args.model,
+        adapter_path=args.adapter,
+        precision=args.precision,
+        snapshot_dir=args.output
+    )
+    if model_core.snapshot_loaded is None:
+        print("❌ Snapshot was not picked up")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
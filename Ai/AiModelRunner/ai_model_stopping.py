@@ -0,0 +1,107 @@
+"""
+Generation-time stopping criteria shared by AiModelCore and the batching scheduler.
+"""
+
+import threading
+import time
+from typing import Optional, List, Sequence
+
+import torch
+# StoppingCriteriaList is imported from here by AiModelCore
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+
+class DeadlineStoppingCriteria(StoppingCriteria):
+    """Stops every sequence once the request deadline passes or the request is cancelled."""
+
+    def __init__(self, deadline: Optional[float] = None, cancel_event: Optional[threading.Event] = None):
+        """
+        Args:
+            deadline: time.monotonic() value after which generation is abandoned
+            cancel_event: Set by the caller (e.g. on client disconnect) to abandon generation
+        """
+        self.deadline = deadline
+        self.cancel_event = cancel_event
+
+    def expired(self) -> bool:
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.expired(), dtype=torch.bool, device=input_ids.device)
+
+
+class StopSequenceMatcher:
+    """
+    Incremental stop-string / stop-token check for one sequence.
+    Only the last few generated tokens are decoded each step, and whitespace
+    before the first visible text never matches (the response is stripped anyway).
+    """
+
+    def __init__(self, tokenizer, stop_strings: Sequence[str], stop_token_ids: Sequence[int] = ()):
+        self.tokenizer = tokenizer
+        self.stop_strings = [s for s in stop_strings if s]
+        self.stop_token_ids = set(stop_token_ids)
+        # Enough tokens to cover the longest stop string even at one character per token
+        self.window = max((len(s) for s in self.stop_strings), default=0) + 2
+        # Index of the token holding the first non-whitespace text
+        self._content_start: Optional[int] = None
+
+    def should_stop(self, generated: List[int]) -> bool:
+        """Check the sequence after its newest token was appended."""
+        if not generated:
+            return False
+        if generated[-1] in self.stop_token_ids:
+            return True
+        if not self.stop_strings:
+            return False
+
+        if self._content_start is None:
+            tail = self.tokenizer.decode(generated[-self.window:], skip_special_tokens=True)
+            if not tail.strip():
+                return False
+            # Everything before this token was whitespace, which the response drops anyway
+            self._content_start = len(generated) - 1
+            tail = tail.lstrip()
+        else:
+            start = max(self._content_start, len(generated) - self.window)
+            tail = self.tokenizer.decode(generated[start:], skip_special_tokens=True)
+            if start == self._content_start:
+                tail = tail.lstrip()
+        return any(stop in tail for stop in self.stop_strings)
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Stops each row of a (batched) generate call independently at a stop string or stop token."""
+
+    def __init__(self, tokenizer, stop_strings: Sequence[str], stop_token_ids: Sequence[int] = ()):
+        self.tokenizer = tokenizer
+        self.stop_strings = list(stop_strings)
+        self.stop_token_ids = list(stop_token_ids)
+        self._prompt_length: Optional[int] = None
+        self._matchers: List[StopSequenceMatcher] = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self._prompt_length is None:
+            # First call comes right after the first new token
+            self._prompt_length = input_ids.shape[1] - 1
+            self._matchers = [StopSequenceMatcher(self.tokenizer, self.stop_strings, self.stop_token_ids)
+                              for _ in range(input_ids.shape[0])]
+
+        generated = input_ids[:, self._prompt_length:].tolist()
+        done = [matcher.should_stop(row) for matcher, row in zip(self._matchers, generated)]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def truncate_at_stop(text: str, stop_strings: Sequence[str]) -> str:
+    """Cut text at the first stop string that follows some non-whitespace text."""
+    content_start = len(text) - len(text.lstrip())
+    cut = len(text)
+    for stop in stop_strings:
+        if not stop:
+            continue
+        index = text.find(stop, content_start)
+        if index != -1:
+            cut = min(cut, index)
+    return text[:cut]
@@ -10,6 +10,7 @@ import warnings
 
 # Import the shared model core
 from ai_model_core import get_model_instance
+from ai_model_protocol import ProtocolSession, parse_hello
 
 
 def main():
@@ -40,26 +41,65 @@ def main():
                     sys.stdout.flush()
                     break
                 
-                # Check for JSON formatted input (for advanced test scenarios)
-                if input_line.startswith("{"):
+                # Protocol handshake: pipelined requests with ids, answered out of order
+                hello = parse_hello(input_line)
+                if hello is not None:
+                    session = ProtocolSession(model_core)
+                    if session.handshake(hello):
+                        session.serve()
+                        break
+                    continue
+                
+                # JSON array of prompts: generate them all in one batch
+                if input_line.startswith("["):
                     try:
-                        data = json.loads(input_line)
-                        prompt = data.get("prompt", "")
-                        params = data.get("params", {})
+                        prompts = json.loads(input_line)
+                        if not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+                            raise ValueError("Batch input must be a JSON array of prompt strings")
                         
-                        # Generate response with custom parameters
-                        response = model_core.generate_response(prompt, **params)
+                        responses = model_core.generate_batch(prompts)
                         
-                        # Return JSON response
                         result = {
                             "status": "success",
-                            "response": response
+                            "responses": responses
                         }
                         print(json.dumps(result))
                     except json.JSONDecodeError:
                         # Treat as regular text if JSON parsing fails
                         response = model_core.generate_response(input_line)
                         print(response)
+                
+                # Check for JSON formatted input (for advanced test scenarios)
+                elif input_line.startswith("{"):
+                    try:
+                        data = json.loads(input_line)
+                        params = data.get("params", {})
+                        if "adapter" in data:
+                            params["adapter"] = data["adapter"]
+                        
+                        if "prompts" in data:
+                            # Batch of prompts with shared custom parameters
+                            responses = model_core.generate_batch(data["prompts"], **params)
+                            result = {
+                                "status": "success",
+                                "responses": responses
+                            }
+                        else:
+                            prompt = data.get("prompt", "")
+                            
+                            # Generate response with custom parameters
+                            response = model_core.generate_response(prompt, **params)
+                            
+                            # Return JSON response
+                            result = {
+                                "status": "success",
+                                "response": response
+                            }
+                        print(json.dumps(result))
+                    except json.JSONDecodeError:
+                        # Treat as regular text if JSON parsing fails
+                        response = model_core.generate_response(input_line)
+                        print(response)
                 else:
                     # Regular text input
                     response = model_core.generate_response(input_line)
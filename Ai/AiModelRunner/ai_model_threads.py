@@ -0,0 +1,111 @@
+"""
+CPU thread settings for inference.
+Loads the configuration written by tune_threads.py, applies the torch intra-op
+and inter-op thread counts, and pins forked server workers to their own cores.
+Used by AiModelCore at startup and by ai_model_server.py for its workers.
+"""
+
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_THREAD_CONFIG = "./thread_config.json"
+
+# Bump when the config layout changes
+THREAD_CONFIG_VERSION = 1
+
+
+def available_cpus() -> List[int]:
+    """CPU ids this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_cores() -> int:
+    """CPU cores this process may run on."""
+    return len(available_cpus())
+
+
+def load_thread_config(path: Optional[str] = DEFAULT_THREAD_CONFIG) -> Optional[Dict[str, Any]]:
+    """
+    Load a tuned thread config.
+
+    Returns:
+        The config, or None when there is none, it is unreadable, or it was tuned on a
+        machine with a different number of cores
+    """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring thread config {path}: {e}")
+        return None
+    if config.get("version") != THREAD_CONFIG_VERSION:
+        print(f"Ignoring thread config {path}: written by a different version")
+        return None
+    cores = available_cores()
+    if config.get("cpu_count") != cores:
+        print(f"Ignoring thread config {path}: tuned for {config.get('cpu_count')} cores, "
+              f"this process has {cores}")
+        return None
+    return config
+
+
+def save_thread_config(config: Dict[str, Any], path: str = DEFAULT_THREAD_CONFIG,
+                       cpu_count: Optional[int] = None):
+    """
+    Write a thread config, stamping the version, core count and time.
+
+    Args:
+        cpu_count: Cores the server will start with; defaults to this process's, which
+            is too few once the caller has pinned itself to one worker's share
+    """
+    config = dict(config, version=THREAD_CONFIG_VERSION,
+                  cpu_count=cpu_count if cpu_count is not None else available_cores(),
+                  timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    with open(path, "w") as f:
+        json.dump(config, f, indent=2)
+
+
+def apply_thread_settings(intra_op_threads: Optional[int] = None,
+                          inter_op_threads: Optional[int] = None) -> Dict[str, int]:
+    """
+    Set torch thread counts; None leaves a setting unchanged.
+
+    Returns:
+        The thread counts now in effect
+    """
+    from ai_model_core import _import_torch
+    torch = _import_torch()
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads and inter_op_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Only allowed before the first inter-op parallel work in this process
+            print(f"Could not set inter-op threads to {inter_op_threads}: already in use")
+    return {"intra_op_threads": torch.get_num_threads(), "inter_op_threads": torch.get_num_interop_threads()}
+
+
+def worker_cpus(index: int, threads_per_worker: int, cpus: Optional[List[int]] = None) -> List[int]:
+    """
+    CPUs for one worker: consecutive blocks of threads_per_worker ids, wrapping around
+    when the workers need more cores than there are.
+    """
+    cpus = cpus or available_cpus()
+    count = max(1, min(threads_per_worker, len(cpus)))
+    start = (index * count) % len(cpus)
+    return [cpus[(start + offset) % len(cpus)] for offset in range(count)]
+
+
+def pin_to_cpus(cpus: List[int]) -> bool:
+    """Restrict this process to cpus; False where CPU affinity is not supported."""
+    if not hasattr(os, "sched_setaffinity"):
+        return False
+    os.sched_setaffinity(0, cpus)
+    return True
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Offline batch inference over a JSONL file of prompts.
+Reads prompts a window at a time, sorts each window by prompt length so
+batches need little padding, and runs them through AiModelCore.generate_batch
+in its own process, away from the serving workers. Results are appended to
+an output JSONL as each batch finishes and a checkpoint is kept next to it,
+so a killed job picks up where it stopped when run again.
+
+Input lines are JSON objects with a "prompt" (see --prompt-field) and
+optionally an "id" and per-record generation "params"; a bare JSON string is
+also accepted as the prompt. Each output line holds the input line number,
+the id and either the "response" or an "error".
+
+Usage:
+    python batch_infer.py prompts.jsonl results.jsonl --batch-size 16
+    python batch_infer.py prompts.jsonl results.jsonl --restart
+    python batch_infer.py prompts.jsonl results.jsonl --stub   # tiny stand-in model
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+from ai_model_core import AiModelCore, PRECISIONS, ERROR_PREFIX
+from ai_model_metrics import PROMPT_TOKENS, GENERATED_TOKENS
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+class _Record:
+    """One input line waiting for generation."""
+
+    def __init__(self, line: int, record_id: Any, prompt: str, params: Dict[str, Any]):
+        self.line = line
+        self.id = record_id
+        self.prompt = prompt
+        self.params = params
+        self.length = 0
+
+
+def _parse_line(raw: bytes, line: int, prompt_field: str) -> Tuple[Optional[_Record], Optional[Dict[str, Any]]]:
+    """Parse an input line into a record, or into an error result for the output."""
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        return None, {"line": line, "id": None, "error": f"Invalid JSON: {e}"}
+
+    if isinstance(data, str):
+        data = {prompt_field: data}
+    if not isinstance(data, dict):
+        return None, {"line": line, "id": None, "error": "Each line must be a JSON object or string"}
+
+    record_id = data.get("id", line)
+    prompt = data.get(prompt_field)
+    params = data.get("params") or {}
+    if not isinstance(prompt, str) or not prompt.strip():
+        return None, {"line": line, "id": record_id, "error": f"No {prompt_field!r} provided"}
+    if not isinstance(params, dict):
+        return None, {"line": line, "id": record_id, "error": "params must be a JSON object"}
+    return _Record(line, record_id, prompt, params), None
+
+
+def _count_lines(path: str) -> int:
+    count = 0
+    last = b"\n"
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+            last = block[-1:]
+    # A final line without a newline still counts
+    return count + (last != b"\n")
+
+
+class BatchInferenceJob:
+    """Runs one input file through the model with checkpointing."""
+
+    def __init__(self,
+                 model_core: AiModelCore,
+                 input_path: str,
+                 output_path: str,
+                 batch_size: int = 16,
+                 window_size: int = 512,
+                 prompt_field: str = "prompt",
+                 include_prompt: bool = False,
+                 default_params: Optional[Dict[str, Any]] = None,
+                 report_every: float = 10.0):
+        """
+        Initialize the job.
+
+        Args:
+            model_core: Loaded AiModelCore instance
+            input_path: JSONL file of prompts
+            output_path: JSONL file results are appended to
+            batch_size: Prompts per generate call
+            window_size: Input lines read and length-sorted together
+            prompt_field: Key holding the prompt in each input object
+            include_prompt: Copy the prompt into each output line
+            default_params: Generation parameters for records without their own
+            report_every: Seconds between progress lines
+        """
+        self.model_core = model_core
+        self.input_path = input_path
+        self.output_path = output_path
+        self.checkpoint_path = output_path + CHECKPOINT_SUFFIX
+        self.batch_size = batch_size
+        self.window_size = max(window_size, batch_size)
+        self.prompt_field = prompt_field
+        self.include_prompt = include_prompt
+        self.default_params = default_params or {}
+        self.report_every = report_every
+
+        self.stats = {"completed": 0, "errors": 0, "prompt_tokens": 0, "generated_tokens": 0,
+                      "elapsed_seconds": 0.0}
+        self._lines_done = 0
+        self._input_offset = 0
+        self._output_offset = 0
+        self._done_lines = set()
+        self._total_lines = 0
+        self._last_report = 0.0
+
+    def run(self, restart: bool = False) -> Dict[str, Any]:
+        """
+        Process the whole input, resuming from the checkpoint unless restart is set.
+
+        Returns:
+            Final stats (completed, errors, prompt/generated tokens, elapsed seconds, throughput)
+        """
+        self._prepare(restart)
+        self._total_lines = _count_lines(self.input_path)
+        started = time.perf_counter()
+        previous_elapsed = self.stats["elapsed_seconds"]
+        self._last_report = started
+
+        with open(self.input_path, "rb") as source, open(self.output_path, "ab") as sink:
+            source.seek(self._input_offset)
+            line = self._lines_done
+            while True:
+                window, errors = [], []
+                while len(window) + len(errors) < self.window_size:
+                    raw = source.readline()
+                    if not raw:
+                        break
+                    if raw.strip() and line not in self._done_lines:
+                        record, error = _parse_line(raw, line, self.prompt_field)
+                        if record is not None:
+                            window.append(record)
+                        else:
+                            errors.append(error)
+                    line += 1
+                if not window and not errors:
+                    break
+
+                self._write(sink, errors)
+                self.stats["errors"] += len(errors)
+                for batch in self._batches(window):
+                    self._write(sink, self._generate(batch))
+                    self.stats["elapsed_seconds"] = previous_elapsed + time.perf_counter() - started
+                    self._report()
+
+                # Every line before here now has a result in the output
+                self._lines_done = line
+                self._input_offset = source.tell()
+                self._output_offset = sink.tell()
+                self._done_lines = {n for n in self._done_lines if n >= line}
+                self.stats["elapsed_seconds"] = previous_elapsed + time.perf_counter() - started
+                self._save_checkpoint(finished=False)
+
+        self._save_checkpoint(finished=True)
+        return self._summary()
+
+    def _prepare(self, restart: bool):
+        """Load the checkpoint and recover results written after it, or start fresh."""
+        checkpoint = None
+        if not restart and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, "r") as f:
+                checkpoint = json.load(f)
+            if (checkpoint.get("version") != CHECKPOINT_VERSION
+                    or checkpoint.get("input") != os.path.abspath(self.input_path)):
+                raise ValueError(f"{self.checkpoint_path} belongs to a different input; pass --restart to start over")
+            if os.path.getsize(self.input_path) < checkpoint["input_offset"]:
+                raise ValueError(f"{self.input_path} is shorter than when the checkpoint was written; "
+                                 "pass --restart to start over")
+        elif not restart and os.path.exists(self.output_path) and os.path.getsize(self.output_path) > 0:
+            raise ValueError(f"{self.output_path} exists without a checkpoint; pass --restart to overwrite it")
+
+        if checkpoint is None:
+            open(self.output_path, "wb").close()
+            return
+
+        self._lines_done = checkpoint["lines_done"]
+        self._input_offset = checkpoint["input_offset"]
+        self._output_offset = checkpoint["output_offset"]
+        self.stats.update(checkpoint["stats"])
+
+        # Results written after the last checkpoint still count; a torn last line does not
+        with open(self.output_path, "r+b") as f:
+            f.seek(self._output_offset)
+            tail = f.read()
+            complete = tail[:tail.rfind(b"\n") + 1]
+            f.truncate(self._output_offset + len(complete))
+        for raw in complete.splitlines():
+            result = json.loads(raw)
+            self._done_lines.add(result["line"])
+            self.stats["errors" if "error" in result else "completed"] += 1
+        print(f"Resuming at line {self._lines_done:,} ({len(self._done_lines)} later lines already done)")
+
+    def _batches(self, window: List[_Record]) -> List[List[_Record]]:
+        """Group records with the same params and split each group into length-sorted batches."""
+        if not window:
+            return []
+        lengths = self.model_core.tokenizer([r.prompt for r in window], add_special_tokens=False)["input_ids"]
+        for record, ids in zip(window, lengths):
+            record.length = len(ids)
+
+        groups: Dict[str, List[_Record]] = {}
+        for record in window:
+            record.params = dict(self.default_params, **record.params)
+            key = json.dumps(record.params, sort_keys=True)
+            groups.setdefault(key, []).append(record)
+
+        batches = []
+        for records in groups.values():
+            records.sort(key=lambda r: r.length)
+            batches.extend(records[start:start + self.batch_size]
+                           for start in range(0, len(records), self.batch_size))
+        return batches
+
+    def _generate(self, batch: List[_Record]) -> List[Dict[str, Any]]:
+        params = batch[0].params
+        prompt_tokens = PROMPT_TOKENS.get()
+        generated_tokens = GENERATED_TOKENS.get()
+        try:
+            responses = self.model_core.generate_batch([r.prompt for r in batch], **params)
+        except Exception as e:
+            responses = [f"{ERROR_PREFIX} {e}"] * len(batch)
+        self.stats["prompt_tokens"] += int(PROMPT_TOKENS.get() - prompt_tokens)
+        self.stats["generated_tokens"] += int(GENERATED_TOKENS.get() - generated_tokens)
+
+        results = []
+        for record, response in zip(batch, responses):
+            result = {"line": record.line, "id": record.id}
+            if self.include_prompt:
+                result["prompt"] = record.prompt
+            if response.startswith(ERROR_PREFIX):
+                result["error"] = response[len(ERROR_PREFIX):].strip()
+                self.stats["errors"] += 1
+            else:
+                result["response"] = response
+                self.stats["completed"] += 1
+            results.append(result)
+        return results
+
+    def _write(self, sink, results: List[Dict[str, Any]]):
+        if not results:
+            return
+        sink.write(b"".join(json.dumps(result).encode("utf-8") + b"\n" for result in results))
+        sink.flush()
+
+    def _save_checkpoint(self, finished: bool):
+        checkpoint = {
+            "version": CHECKPOINT_VERSION,
+            "input": os.path.abspath(self.input_path),
+            "lines_done": self._lines_done,
+            "input_offset": self._input_offset,
+            "output_offset": self._output_offset,
+            "finished": finished,
+            "stats": self.stats
+        }
+        # Write then rename so a kill never leaves a half-written checkpoint
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(checkpoint, f, indent=2)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def _summary(self) -> Dict[str, Any]:
+        summary = dict(self.stats)
+        elapsed = summary["elapsed_seconds"]
+        done = summary["completed"] + summary["errors"]
+        summary["prompts_per_second"] = done / elapsed if elapsed else 0.0
+        summary["tokens_per_second"] = summary["generated_tokens"] / elapsed if elapsed else 0.0
+        return summary
+
+    def _report(self):
+        now = time.perf_counter()
+        if now - self._last_report < self.report_every:
+            return
+        self._last_report = now
+        summary = self._summary()
+        done = summary["completed"] + summary["errors"]
+        remaining = max(self._total_lines - done, 0)
+        eta = remaining / summary["prompts_per_second"] if summary["prompts_per_second"] else 0.0
+        print(f"[{done:,}/{self._total_lines:,}] {summary['prompts_per_second']:.1f} prompts/s, "
+              f"{summary['tokens_per_second']:.1f} tokens/s, {summary['errors']} errors, ETA {eta:.0f}s")
+        sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline batch inference over a JSONL file of prompts")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file for the results (checkpoint kept alongside)")
+    parser.add_argument("--batch-size", type=int, default=16, help="Prompts per generate call")
+    parser.add_argument("--window-size", type=int, default=512,
+                        help="Input lines read and length-sorted together (also the checkpoint interval)")
+    parser.add_argument("--prompt-field", default="prompt", help="Key holding the prompt in each input line")
+    parser.add_argument("--include-prompt", action="store_true", help="Copy the prompt into each output line")
+    parser.add_argument("--max-new-tokens", type=int, default=None)
+    parser.add_argument("--temperature", type=float, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--greedy", action="store_true", help="Disable sampling for reproducible output")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and overwrite the output")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Intra-op threads, overriding ./thread_config.json (default: the config, else all cores; "
+                             "lower it to leave cores for serving)")
+    parser.add_argument("--stub", action="store_true",
+                        help="Use the tiny random stand-in model (tiny_model.py) instead of the real weights")
+    parser.add_argument("--model", default=None, help="Model name or path")
+    parser.add_argument("--adapter", default=None, help="Path to LoRA adapters")
+    parser.add_argument("--merge-adapters", action="store_true", help="Merge adapters at load time")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        print(f"❌ Input file not found: {args.input}")
+        sys.exit(1)
+
+    model_options = {"merge_adapters": args.merge_adapters, "precision": args.precision}
+    if args.threads:
+        # Applied by AiModelCore, taking precedence over ./thread_config.json
+        model_options["num_threads"] = args.threads
+    if args.model:
+        model_options["model_name"] = args.model
+    if args.adapter:
+        model_options["adapter_path"] = args.adapter
+    if args.stub:
+        from tiny_model import build_tiny_model
+
+        tiny = build_tiny_model()
+        model_options["model_name"] = tiny["model_path"]
+        model_options["adapter_path"] = tiny["adapter_path"] or "./no_adapter"
+        model_options["snapshot_dir"] = None
+
+    default_params = {}
+    if args.max_new_tokens is not None:
+        default_params["max_new_tokens"] = args.max_new_tokens
+    if args.temperature is not None:
+        default_params["temperature"] = args.temperature
+    if args.top_p is not None:
+        default_params["top_p"] = args.top_p
+    if args.greedy:
+        default_params["do_sample"] = False
+
+    model_core = AiModelCore(**model_options)
+    job = BatchInferenceJob(
+        model_core,
+        args.input,
+        args.output,
+        batch_size=args.batch_size,
+        window_size=args.window_size,
+        prompt_field=args.prompt_field,
+        include_prompt=args.include_prompt,
+        default_params=default_params,
+        report_every=args.report_every
+    )
+    try:
+        summary = job.run(restart=args.restart)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    print(f"\n✅ {summary['completed']:,} responses, {summary['errors']:,} errors written to {args.output}")
+    print(f"   {summary['prompts_per_second']:.1f} prompts/s, {summary['tokens_per_second']:.1f} tokens/s "
+          f"over {summary['elapsed_seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Offline micro-benchmark for AiModelCore.
+Runs against the tiny random stand-in model from tiny_model.py by default, so
+it needs no network or model download. Measures load time, single-prompt
+latency, batched throughput across batch sizes and thread counts, and peak
+memory. Writes the results as JSON and compares them with a saved baseline.
+
+Usage:
+    python benchmark.py --save-baseline
+    python benchmark.py --baseline benchmark_baseline.json --fail-on-regression
+    python benchmark.py --model microsoft/Phi-3.5-mini-instruct --adapter ./fine_tuned_phi_habits
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+from typing import Dict, Any, List, Optional
+
+import torch
+import transformers
+
+from ai_model_core import AiModelCore, PRECISIONS, ERROR_PREFIX, SAMPLE_PROMPTS
+from ai_model_metrics import resident_memory_bytes, peak_resident_memory_bytes
+from tiny_model import build_tiny_model, DEFAULT_TINY_MODEL_DIR
+
+DEFAULT_OUTPUT = "benchmark_results.json"
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process so far."""
+    peak = peak_resident_memory_bytes()
+    return peak / (1024 * 1024) if peak is not None else None
+
+
+def current_rss_mb() -> Optional[float]:
+    rss = resident_memory_bytes()
+    return rss / (1024 * 1024) if rss is not None else None
+
+
+def generation_params(max_new_tokens: int) -> Dict[str, Any]:
+    """
+    Greedy decoding of exactly max_new_tokens tokens so every run does the same work.
+    min_new_tokens only holds back EOS, so stop strings are turned off as well.
+    """
+    return {"max_new_tokens": max_new_tokens, "min_new_tokens": max_new_tokens, "do_sample": False, "stop": []}
+
+
+def check_responses(responses: List[str]) -> List[str]:
+    """
+    Raise on a failed generation; AiModelCore returns errors as response text, which
+    would otherwise time as a very fast run.
+    """
+    for response in responses:
+        if response.startswith(ERROR_PREFIX):
+            raise RuntimeError(f"Generation failed during the benchmark: {response}")
+    return responses
+
+
+def bench_single(model_core: AiModelCore, repeats: int, max_new_tokens: int) -> Dict[str, Any]:
+    """Latency of generate_response for one prompt."""
+    params = generation_params(max_new_tokens)
+    check_responses([model_core.generate_response(SAMPLE_PROMPTS[0], **params)])  # warm-up
+
+    latencies = []
+    for i in range(repeats):
+        started = time.perf_counter()
+        response = model_core.generate_response(SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)], **params)
+        latencies.append(time.perf_counter() - started)
+        check_responses([response])
+
+    p50 = statistics.median(latencies)
+    return {
+        "latency_p50": p50,
+        "latency_mean": statistics.mean(latencies),
+        "latency_min": min(latencies),
+        "tokens_per_second": max_new_tokens / p50
+    }
+
+
+def bench_batch(model_core: AiModelCore, batch_size: int, repeats: int, max_new_tokens: int) -> Dict[str, Any]:
+    """Throughput of generate_batch for one batch size."""
+    params = generation_params(max_new_tokens)
+    prompts = [SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)] for i in range(batch_size)]
+    check_responses(model_core.generate_batch(prompts, **params))  # warm-up
+
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        responses = model_core.generate_batch(prompts, **params)
+        timings.append(time.perf_counter() - started)
+        check_responses(responses)
+
+    seconds = statistics.median(timings)
+    return {
+        "batch_size": batch_size,
+        "seconds": seconds,
+        "tokens_per_second": batch_size * max_new_tokens / seconds,
+        "prompts_per_second": batch_size / seconds
+    }
+
+
+def flatten(results: Dict[str, Any]) -> Dict[str, float]:
+    """Comparable metrics keyed by name; names ending in tokens_per_second are higher-is-better."""
+    flat = {
+        "load_seconds": results["load_seconds"],
+        "single.latency_p50": results["single"]["latency_p50"],
+        "single.tokens_per_second": results["single"]["tokens_per_second"]
+    }
+    for run in results["batch"]:
+        flat[f"batch.threads{run['threads']}.size{run['batch_size']}.tokens_per_second"] = run["tokens_per_second"]
+    if results.get("peak_rss_mb") is not None:
+        flat["peak_rss_mb"] = results["peak_rss_mb"]
+    return flat
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """Relative change of every metric present in both runs; positive change is an improvement."""
+    current = flatten(results)
+    previous = flatten(baseline["results"])
+    rows = []
+    for name, value in current.items():
+        if name not in previous or not previous[name]:
+            continue
+        higher_is_better = name.endswith("per_second")
+        change = (value - previous[name]) / previous[name]
+        if not higher_is_better:
+            change = -change
+        rows.append({
+            "metric": name,
+            "baseline": previous[name],
+            "current": value,
+            "change": change,
+            "regression": change < -tolerance
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline AiModelCore micro-benchmark")
+    parser.add_argument("--model", default=None,
+                        help="Model name or path (default: tiny random model, built if needed)")
+    parser.add_argument("--adapter", default=None, help="Path to LoRA adapters")
+    parser.add_argument("--tiny-model-dir", default=DEFAULT_TINY_MODEL_DIR,
+                        help="Where the tiny model is built and cached")
+    parser.add_argument("--merge-adapters", action="store_true", help="Merge adapters at load time")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="Intra-op thread counts to test (default: 1 and all cores)")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Write results as JSON")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline results to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Also save these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative slowdown counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help="Exit with an error when any metric regresses beyond the tolerance")
+    args = parser.parse_args()
+
+    model_name, adapter_path = args.model, args.adapter
+    if model_name is None:
+        marker = build_tiny_model(args.tiny_model_dir)
+        model_name = marker["model_path"]
+        adapter_path = adapter_path or marker["adapter_path"]
+    adapter_path = adapter_path or os.path.join(model_name, "no_adapter")
+
+    cores = os.cpu_count() or 1
+    thread_counts = args.threads or sorted({1, cores})
+
+    print(f"Benchmarking {model_name} ({args.precision}) on {cores} cores...")
+    rss_before = current_rss_mb()
+    started = time.perf_counter()
+    model_core = AiModelCore(
+        model_name=model_name,
+        adapter_path=adapter_path,
+        merge_adapters=args.merge_adapters,
+        precision=args.precision,
+        snapshot_dir=None,
+        stop_sequences=()  # Rows must not end early; tokens/s assumes max_new_tokens per row
+    )
+    load_seconds = time.perf_counter() - started
+    rss_loaded = current_rss_mb()
+
+    torch.set_num_threads(max(thread_counts))
+    print("\nSingle prompt...")
+    single = bench_single(model_core, args.repeats, args.max_new_tokens)
+    print(f"  p50 {single['latency_p50'] * 1000:.1f} ms, {single['tokens_per_second']:.1f} tokens/s")
+
+    batch_runs = []
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            run = bench_batch(model_core, batch_size, args.repeats, args.max_new_tokens)
+            run["threads"] = threads
+            batch_runs.append(run)
+            print(f"  threads {threads:>3}  batch {batch_size:>3}: {run['tokens_per_second']:>9.1f} tokens/s "
+                  f"({run['seconds'] * 1000:.1f} ms)")
+
+    results = {
+        "load_seconds": load_seconds,
+        "load_timings": model_core.load_timings,
+        "single": single,
+        "batch": batch_runs,
+        "model_rss_mb": rss_loaded - rss_before if rss_loaded is not None and rss_before is not None else None,
+        "peak_rss_mb": peak_rss_mb()
+    }
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": cores
+        },
+        "config": {
+            "model": model_name,
+            "adapter": adapter_path if model_core.adapter_loaded else None,
+            "merge_adapters": args.merge_adapters,
+            "precision": args.precision,
+            "max_new_tokens": args.max_new_tokens,
+            "repeats": args.repeats
+        },
+        "results": results
+    }
+
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print(f"\n⚠️  Baseline {args.baseline} was recorded with a different configuration")
+        report["comparison"] = compare(results, baseline, args.tolerance)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    print(f"Load {load_seconds:.2f}s, peak RSS {results['peak_rss_mb'] or 0:.0f} MB")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if "comparison" in report:
+        print(f"\n{'Metric':<45} {'Baseline':>12} {'Current':>12} {'Change':>9}")
+        for row in report["comparison"]:
+            flag = "  ❌" if row["regression"] else ""
+            print(f"{row['metric']:<45} {row['baseline']:>12.4f} {row['current']:>12.4f} "
+                  f"{row['change']:>+9.1%}{flag}")
+        regressions = [row["metric"] for row in report["comparison"] if row["regression"]]
+        if regressions:
+            print(f"\n❌ {len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print(f"\n✅ No regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
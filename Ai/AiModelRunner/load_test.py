@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+HTTP load generator for ai_model_server.py.
+Drives /chat, /chat/batch or /chat/stream either closed-loop (a fixed number
+of clients sending back-to-back requests) or open-loop (Poisson arrivals at a
+fixed rate). It reports latency percentiles, throughput, and error, timeout
+and rejection rates. With --sweep it runs several concurrency levels in turn
+to produce a saturation curve.
+
+Run the server with --stub to load-test without the real model weights:
+    python ai_model_server.py --stub
+    python load_test.py --concurrency 8 --duration 30
+    python load_test.py --sweep 1 2 4 8 16 --duration 20 --output load_report.json
+    python load_test.py --rate 5 --concurrency 32 --endpoint stream
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+import http.client
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+
+# (prompt, weight): mostly the production habit prompt, plus the prompts used by the C# tests.
+# /chat answers the bare habit prompt from the suggestion pool, so LoadGenerator sends
+# "pool": false unless told otherwise; the latencies then measure generation
+DEFAULT_PROMPT_MIX = [
+    ("Please suggest a habit that can be tracked", 0.7),
+    ("Suggest a morning habit", 0.05),
+    ("Suggest an evening habit", 0.05),
+    ("Suggest a weekend habit", 0.05),
+    ("Can you tell me about yourself?", 0.05),
+    ("Can you tell me one good joke?", 0.05),
+    ("Can you tell me something smart?", 0.05),
+]
+
+ENDPOINTS = {"chat": "/chat", "batch": "/chat/batch", "stream": "/chat/stream"}
+
+
+def load_prompt_mix(path: Optional[str]) -> List[Tuple[str, float]]:
+    """
+    Read a prompt mix: a JSON list of strings or [prompt, weight] pairs, or one prompt per line.
+    """
+    if path is None:
+        return DEFAULT_PROMPT_MIX
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    try:
+        items = json.loads(text)
+    except json.JSONDecodeError:
+        items = [line.strip() for line in text.splitlines() if line.strip()]
+    mix = []
+    for item in items:
+        if isinstance(item, str):
+            mix.append((item, 1.0))
+        else:
+            mix.append((item[0], float(item[1])))
+    return mix
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoadGenerator:
+    """Sends requests and collects per-request outcomes."""
+
+    def __init__(self,
+                 base_url: str,
+                 endpoint: str = "chat",
+                 prompt_mix: List[Tuple[str, float]] = None,
+                 gen_params: Dict[str, Any] = None,
+                 batch_size: int = 4,
+                 timeout: float = 30.0,
+                 seed: Optional[int] = None,
+                 bypass_pool: bool = True):
+        """
+        Initialize the generator.
+
+        Args:
+            base_url: Server address, e.g. http://localhost:5000
+            endpoint: 'chat', 'batch' or 'stream'
+            prompt_mix: (prompt, weight) pairs to sample requests from
+            gen_params: Generation overrides sent with every request (temperature, max_new_tokens, top_p)
+            batch_size: Messages per /chat/batch request
+            timeout: Client-side timeout in seconds (also sent as the request deadline)
+            seed: Seed for prompt sampling and arrivals
+            bypass_pool: Keep /chat from answering with pre-generated habit suggestions
+        """
+        self.url = base_url.rstrip("/") + ENDPOINTS[endpoint]
+        self.endpoint = endpoint
+        self.prompts = [prompt for prompt, _ in (prompt_mix or DEFAULT_PROMPT_MIX)]
+        self.weights = [weight for _, weight in (prompt_mix or DEFAULT_PROMPT_MIX)]
+        self.gen_params = gen_params or {}
+        self.bypass_pool = bypass_pool
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    def _sample_prompts(self, count: int) -> List[str]:
+        with self._random_lock:
+            return self.random.choices(self.prompts, weights=self.weights, k=count)
+
+    def _body(self) -> Dict[str, Any]:
+        body = dict(self.gen_params)
+        body["timeout"] = self.timeout
+        if self.bypass_pool and self.endpoint == "chat":
+            body["pool"] = False
+        if self.endpoint == "batch":
+            body["messages"] = self._sample_prompts(self.batch_size)
+        else:
+            body["message"] = self._sample_prompts(1)[0]
+        return body
+
+    def send(self) -> Dict[str, Any]:
+        """Send one request and describe its outcome."""
+        data = json.dumps(self._body()).encode("utf-8")
+        req = urllib.request.Request(self.url, data=data, headers={"Content-Type": "application/json"})
+        result = {"started": time.perf_counter(), "status": None, "error": None, "ttft": None, "pooled": False}
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                result["status"] = response.status
+                if self.endpoint == "stream":
+                    self._read_stream(response, result)
+                else:
+                    body = json.loads(response.read())
+                    result["pooled"] = bool(body.get("pooled"))
+        except urllib.error.HTTPError as e:
+            result["status"] = e.code
+            result["error"] = f"HTTP {e.code}"
+        except (TimeoutError, OSError) as e:
+            timed_out = isinstance(e, TimeoutError) or "timed out" in str(e)
+            result["error"] = "timeout" if timed_out else type(e).__name__
+        except (http.client.HTTPException, ValueError) as e:
+            # Truncated or malformed bodies (IncompleteRead, JSONDecodeError) count as failed requests
+            result["error"] = type(e).__name__
+        result["latency"] = time.perf_counter() - result["started"]
+        return result
+
+    def _read_stream(self, response, result: Dict[str, Any]):
+        """Consume Server-Sent Events, noting the first token and any error event."""
+        event = None
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+                if event == "token" and result["ttft"] is None:
+                    result["ttft"] = time.perf_counter() - result["started"]
+            elif line.startswith("data: ") and event == "error":
+                payload = json.loads(line[len("data: "):])
+                result["error"] = "timeout" if payload.get("deadline_exceeded") else "stream error"
+
+    def run(self, duration: float, concurrency: int, rate: Optional[float] = None,
+            warmup: float = 0.0) -> Dict[str, Any]:
+        """
+        Generate load for duration seconds and summarize it.
+
+        Args:
+            duration: Measured seconds (requests started in this window are counted)
+            concurrency: Closed loop: number of clients. Open loop: maximum requests in flight
+            rate: Open-loop arrival rate in requests/second (closed loop when None)
+            warmup: Seconds of unmeasured load before the measured window
+        """
+        results: List[Dict[str, Any]] = []
+        lock = threading.Lock()
+        start = time.perf_counter()
+        measure_from = start + warmup
+        stop_at = measure_from + duration
+
+        def record(result):
+            if result["started"] >= measure_from:
+                with lock:
+                    results.append(result)
+
+        if rate is None:
+            def client():
+                while time.perf_counter() < stop_at:
+                    record(self.send())
+
+            threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        else:
+            dropped = 0
+            in_flight = threading.Semaphore(concurrency)
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                next_arrival = start
+                while next_arrival < stop_at:
+                    delay = next_arrival - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    if in_flight.acquire(blocking=False):
+                        def task():
+                            try:
+                                record(self.send())
+                            finally:
+                                in_flight.release()
+                        pool.submit(task)
+                    elif next_arrival >= measure_from:
+                        # The generator itself is saturated; count it rather than queue silently
+                        dropped += 1
+                    with self._random_lock:
+                        next_arrival += self.random.expovariate(rate)
+
+        elapsed = max(time.perf_counter(), stop_at) - measure_from
+        summary = summarize(results, elapsed)
+        summary["concurrency"] = concurrency
+        summary["rate"] = rate
+        if rate is not None:
+            summary["client_dropped"] = dropped
+        return summary
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    """Latency percentiles, throughput and error rates for a set of request outcomes."""
+    ok = [r for r in results if r["error"] is None and r["status"] == 200]
+    latencies = [r["latency"] for r in ok]
+    ttfts = [r["ttft"] for r in ok if r["ttft"] is not None]
+    count = len(results)
+
+    def rate_of(predicate) -> float:
+        return sum(1 for r in results if predicate(r)) / count if count else 0.0
+
+    summary = {
+        "requests": count,
+        "succeeded": len(ok),
+        "duration": elapsed,
+        "throughput": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+        "error_rate": rate_of(lambda r: r["error"] is not None),
+        "timeout_rate": rate_of(lambda r: r["error"] == "timeout" or r["status"] == 504),
+        "rejected_rate": rate_of(lambda r: r["status"] in (429, 503)),
+        # Answered from the suggestion pool rather than generated
+        "pooled_rate": sum(1 for r in ok if r.get("pooled")) / len(ok) if ok else 0.0
+    }
+    if ttfts:
+        summary["ttft_p50"] = percentile(ttfts, 50)
+        summary["ttft_p99"] = percentile(ttfts, 99)
+    return summary
+
+
+def format_ms(value: Optional[float]) -> str:
+    return f"{value * 1000:.0f}" if value is not None else "-"
+
+
+def print_table(rows: List[Dict[str, Any]]):
+    print(f"\n{'Conc':>5} {'Rate':>6} {'Reqs':>6} {'Req/s':>7} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} "
+          f"{'Errors':>7} {'Timeout':>8} {'429/503':>8} {'Pooled':>7}")
+    for row in rows:
+        rate = f"{row['rate']:.1f}" if row["rate"] is not None else "-"
+        print(f"{row['concurrency']:>5} {rate:>6} {row['requests']:>6} {row['throughput']:>7.2f} "
+              f"{format_ms(row['latency_p50']):>8} {format_ms(row['latency_p90']):>8} "
+              f"{format_ms(row['latency_p99']):>8} {row['error_rate']:>7.1%} {row['timeout_rate']:>8.1%} "
+              f"{row['rejected_rate']:>8.1%} {row['pooled_rate']:>7.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the AI model server")
+    parser.add_argument("--url", default="http://localhost:5000", help="Server base URL")
+    parser.add_argument("--endpoint", choices=sorted(ENDPOINTS), default="chat")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Closed-loop clients, or maximum in-flight requests with --rate")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Open-loop Poisson arrival rate in requests/second")
+    parser.add_argument("--sweep", type=int, nargs="+", default=None,
+                        help="Concurrency levels to run one after another (saturation curve)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Unmeasured seconds before each run")
+    parser.add_argument("--prompts", default=None,
+                        help="Prompt mix file: JSON list of prompts or [prompt, weight] pairs, or one prompt per line")
+    parser.add_argument("--batch-size", type=int, default=4, help="Messages per request for --endpoint batch")
+    parser.add_argument("--temperature", type=float, default=None)
+    parser.add_argument("--max-new-tokens", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--timeout", type=float, default=30.0, help="Client timeout and request deadline (seconds)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--allow-pool", action="store_true",
+                        help="Let /chat answer the habit prompt from the suggestion pool, as in production")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    gen_params = {}
+    if args.temperature is not None:
+        gen_params["temperature"] = args.temperature
+    if args.max_new_tokens is not None:
+        gen_params["max_new_tokens"] = args.max_new_tokens
+    if args.top_p is not None:
+        gen_params["top_p"] = args.top_p
+
+    try:
+        with urllib.request.urlopen(args.url.rstrip("/") + "/health", timeout=10) as response:
+            health = json.loads(response.read())
+    except OSError as e:
+        print(f"❌ Server at {args.url} is not reachable: {e}")
+        sys.exit(1)
+    print(f"Server ready: {health.get('model')}")
+
+    generator = LoadGenerator(
+        args.url,
+        endpoint=args.endpoint,
+        prompt_mix=load_prompt_mix(args.prompts),
+        gen_params=gen_params,
+        batch_size=args.batch_size,
+        timeout=args.timeout,
+        seed=args.seed,
+        bypass_pool=not args.allow_pool
+    )
+
+    rows = []
+    for concurrency in args.sweep or [args.concurrency]:
+        mode = f"{args.rate} req/s open loop, max {concurrency} in flight" if args.rate else \
+            f"{concurrency} closed-loop clients"
+        print(f"Running {args.endpoint} with {mode} for {args.duration:.0f}s...")
+        rows.append(generator.run(args.duration, concurrency, rate=args.rate, warmup=args.warmup))
+        print_table(rows[-1:])
+
+    if len(rows) > 1:
+        print("\nSaturation curve:")
+        print_table(rows)
+        best = max(rows, key=lambda row: row["throughput"])
+        print(f"\nPeak throughput {best['throughput']:.2f} req/s at concurrency {best['concurrency']}")
+
+    if args.output:
+        report = {
+            "url": args.url,
+            "endpoint": args.endpoint,
+            "server": health,
+            "gen_params": gen_params,
+            "pool_bypassed": not args.allow_pool,
+            "runs": rows
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
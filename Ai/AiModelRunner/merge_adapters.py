@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Merge trained LoRA adapters into the base model and save a standalone checkpoint.
+The output loads directly with AiModelCore(model_name=<output_dir>) without peft,
+and decodes at the speed of the plain base model.
+
+Usage:
+    python merge_adapters.py --adapter ./fine_tuned_phi_habits --output ./merged_phi_habits
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from ai_model_core import AiModelCore, MERGED_ADAPTER_FILE
+
+# Configuration
+MODEL_NAME = "microsoft/Phi-3.5-mini-instruct"
+ADAPTER_DIR = "./fine_tuned_phi_habits"
+OUTPUT_DIR = "./merged_phi_habits"
+
+
+def merge_and_save(model_name: str, adapter_path: str, output_dir: str):
+    """Load base model plus adapters, merge them and write a safetensors checkpoint."""
+    if not os.path.exists(adapter_path):
+        raise FileNotFoundError(f"No LoRA adapters found at {adapter_path}")
+    
+    model_core = AiModelCore(
+        model_name=model_name,
+        adapter_path=adapter_path,
+        prefix_cache=False,
+        merge_adapters=True
+    )
+    
+    print(f"\nSaving merged checkpoint to {output_dir}...")
+    os.makedirs(output_dir, exist_ok=True)
+    model_core.model.save_pretrained(output_dir, safe_serialization=True)
+    model_core.tokenizer.save_pretrained(output_dir)
+    
+    # Marks the checkpoint so AiModelCore does not stack the adapters on top again
+    with open(os.path.join(output_dir, MERGED_ADAPTER_FILE), "w") as f:
+        json.dump({
+            "base_model": model_name,
+            "adapter_path": os.path.abspath(adapter_path)
+        }, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge LoRA adapters into the base model")
+    parser.add_argument("--model", default=MODEL_NAME, help="Base model name or path")
+    parser.add_argument("--adapter", default=ADAPTER_DIR, help="Directory with trained LoRA adapters")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="Directory for the merged checkpoint")
+    args = parser.parse_args()
+    
+    try:
+        merge_and_save(args.model, args.adapter, args.output)
+    except FileNotFoundError as e:
+        print(f"\n❌ {e}")
+        sys.exit(1)
+    
+    print(f"\n✅ Merged checkpoint saved to {args.output}")
+    print(f"Serve it with: AiModelCore(model_name=\"{args.output}\")")
+
+
+if __name__ == "__main__":
+    main()
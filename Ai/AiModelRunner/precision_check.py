@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Accuracy check for reduced-precision inference modes.
+Runs a fixed prompt set through AiModelCore in float32 and in each requested
+precision, then compares greedy outputs and next-token distributions.
+
+Usage:
+    python precision_check.py --precisions bfloat16 int8
+    python precision_check.py --model ./merged_phi_habits --output precision_report.json
+"""
+
+import gc
+import sys
+import json
+import argparse
+from typing import Dict, Any, List
+
+import torch
+
+from ai_model_core import AiModelCore, PRECISIONS, SAMPLE_PROMPTS
+
+
+def run_prompts(model_core: AiModelCore, prompts: List[str], max_new_tokens: int) -> List[Dict[str, Any]]:
+    """Collect next-token log-probabilities and greedy generations for each prompt."""
+    results = []
+    for prompt in prompts:
+        inputs = model_core.tokenizer(model_core.build_prompt(prompt), return_tensors="pt")
+        inputs = {k: v.to(model_core.model.device) for k, v in inputs.items()}
+        with torch.no_grad():
+            logits = model_core.model(**inputs).logits[0, -1].float()
+            outputs = model_core.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                pad_token_id=model_core.tokenizer.pad_token_id,
+                eos_token_id=model_core.tokenizer.eos_token_id
+            )
+        token_ids = outputs[0][inputs["input_ids"].shape[1]:].tolist()
+        text = model_core.tokenizer.decode(token_ids, skip_special_tokens=True).strip()
+        results.append({
+            "log_probs": torch.log_softmax(logits, dim=-1).cpu(),
+            "token_ids": token_ids,
+            "response": model_core._clean_response(text)
+        })
+    return results
+
+
+def compare(reference: List[Dict[str, Any]], candidate: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Summarize how closely candidate outputs follow the float32 reference."""
+    kl_values = []
+    top1_matches = 0
+    tokens_matched = 0
+    tokens_total = 0
+    exact_matches = 0
+    for ref, cand in zip(reference, candidate):
+        ref_probs = ref["log_probs"].exp()
+        kl_values.append(float((ref_probs * (ref["log_probs"] - cand["log_probs"])).sum()))
+        top1_matches += int(ref["log_probs"].argmax() == cand["log_probs"].argmax())
+
+        # Greedy tokens agree up to the first divergence
+        agreed = 0
+        for a, b in zip(ref["token_ids"], cand["token_ids"]):
+            if a != b:
+                break
+            agreed += 1
+        tokens_matched += agreed
+        tokens_total += max(len(ref["token_ids"]), 1)
+        exact_matches += int(ref["response"] == cand["response"])
+
+    count = len(reference)
+    return {
+        "mean_kl": sum(kl_values) / count,
+        "max_kl": max(kl_values),
+        "top1_agreement": top1_matches / count,
+        "greedy_token_agreement": tokens_matched / tokens_total,
+        "exact_response_match": exact_matches / count
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare reduced-precision outputs against float32")
+    parser.add_argument("--model", default="microsoft/Phi-3.5-mini-instruct", help="Model name or path")
+    parser.add_argument("--adapter", default="./fine_tuned_phi_habits", help="Path to LoRA adapters")
+    parser.add_argument("--merge-adapters", action="store_true", help="Merge adapters before comparing")
+    parser.add_argument("--precisions", nargs="+", default=["bfloat16", "int8"],
+                        choices=[p for p in PRECISIONS if p != "float32"])
+    parser.add_argument("--max-new-tokens", type=int, default=15)
+    parser.add_argument("--min-agreement", type=float, default=0.8,
+                        help="Fail when greedy token agreement falls below this")
+    parser.add_argument("--output", default=None, help="Write the report as JSON")
+    args = parser.parse_args()
+
+    report = {"prompts": SAMPLE_PROMPTS, "precisions": {}}
+    reference = None
+    failed = []
+
+    # Models are loaded one at a time so only a single copy of the weights is resident
+    for precision in ["float32"] + args.precisions:
+        print(f"\n=== {precision} ===")
+        model_core = AiModelCore(
+            model_name=args.model,
+            adapter_path=args.adapter,
+            merge_adapters=args.merge_adapters,
+            prefix_cache=False,
+            precision=precision
+        )
+        results = run_prompts(model_core, SAMPLE_PROMPTS, args.max_new_tokens)
+        del model_core
+        gc.collect()
+
+        if reference is None:
+            reference = results
+            continue
+
+        metrics = compare(reference, results)
+        metrics["responses"] = [r["response"] for r in results]
+        report["precisions"][precision] = metrics
+        if metrics["greedy_token_agreement"] < args.min_agreement:
+            failed.append(precision)
+
+    report["float32_responses"] = [r["response"] for r in reference]
+
+    print(f"\n{'Precision':<10} {'Mean KL':>10} {'Max KL':>10} {'Top-1':>8} {'Tokens':>8} {'Exact':>8}")
+    for precision, metrics in report["precisions"].items():
+        print(f"{precision:<10} {metrics['mean_kl']:>10.5f} {metrics['max_kl']:>10.5f} "
+              f"{metrics['top1_agreement']:>8.2%} {metrics['greedy_token_agreement']:>8.2%} "
+              f"{metrics['exact_response_match']:>8.2%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if failed:
+        print(f"\n❌ Greedy token agreement below {args.min_agreement:.0%} for: {', '.join(failed)}")
+        sys.exit(1)
+    print("\n✅ All precisions within tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,13 @@ from peft import LoraConfig, get_peft_model, TaskType
 from trl import SFTTrainer, DataCollatorForCompletionOnlyLM
 import torch
 import json
+import argparse
+import os
 import random
 
+from training_data import load_tokenized, write_jsonl, DEFAULT_DATA_CACHE
+from training_metrics import TrainingMetricsCallback, format_summary, DEFAULT_METRICS_FILE
+
 # Model configuration
 MODEL_NAME = "microsoft/Phi-3.5-mini-instruct"
 MODEL_REVISION = "main"  # Pin to specific revision for consistency
@@ -152,6 +157,14 @@ def scan_model_files():
     return len(suspicious_files) == 0
 
 def main():
+    parser = argparse.ArgumentParser(description="QLoRA fine-tuning for habit suggestions")
+    parser.add_argument("--data", nargs="+", metavar="PATH",
+                        help="JSONL files or directories of them to train on instead of generated examples")
+    parser.add_argument("--data-cache", default=DEFAULT_DATA_CACHE, help="Directory for the tokenized --data")
+    parser.add_argument("--metrics-file", default=os.path.join(OUTPUT_DIR, DEFAULT_METRICS_FILE),
+                        help="Per-step throughput and memory JSONL")
+    args = parser.parse_args()
+    
     print("Loading model and tokenizer...")
     
     # Security warning
@@ -228,14 +241,20 @@ def main():
             param.requires_grad_(True)
     
     # Load and prepare data
-    print("Generating training data...")
-    train_data = load_training_data(tokenizer)
-    
-    # Save training data for inspection
-    with open("high_quality_habit_data.json", "w") as f:
-        json.dump(train_data, f, indent=2)
-    
-    dataset = Dataset.from_list(train_data)
+    if args.data:
+        # Deduplicated and tokenized on the first run, memory-mapped from the cache after that;
+        # SFTTrainer skips its own tokenization for datasets that already have input_ids
+        dataset = load_tokenized(args.data, tokenizer, cache_dir=args.data_cache)
+    else:
+        print("Generating training data...")
+        train_data = load_training_data(tokenizer)
+        
+        # Save training data for inspection, plus a JSONL copy that can be passed back in with --data
+        with open("high_quality_habit_data.json", "w") as f:
+            json.dump(train_data, f, indent=2)
+        write_jsonl("high_quality_habit_data.jsonl", train_data)
+        
+        dataset = Dataset.from_list(train_data)
     
     # Training arguments optimized for LoRA compatibility
     training_args = TrainingArguments(
@@ -258,6 +277,8 @@ def main():
         report_to=["none"],
     )
     
+    metrics = TrainingMetricsCallback(args.metrics_file, run_info={"model": MODEL_NAME})
+    
     # Create trainer with latest API (simplified)
     trainer = SFTTrainer(
         model=model,
@@ -265,11 +286,14 @@ def main():
         train_dataset=dataset,
         processing_class=tokenizer,
         peft_config=peft_config,
+        callbacks=[metrics],
     )
     
     # Start training
     print("Starting training...")
     trainer.train()
+    print(format_summary(metrics.summary()))
+    print(f"Per-step metrics written to {args.metrics_file}")
     
     # Save the model
     print("Saving model...")
@@ -4,8 +4,12 @@ Simplified training script using standard Trainer instead of SFTTrainer.
 More compatible across different library versions.
 """
 
+import argparse
+import inspect
 import os
 import sys
+import shutil
+import tempfile
 import torch
 import warnings
 from transformers import (
@@ -13,12 +17,25 @@ from transformers import (
     AutoTokenizer,
     Trainer,
     TrainingArguments,
-    DataCollatorForLanguageModeling
+    DataCollatorForLanguageModeling,
+    set_seed
 )
 from datasets import Dataset
 from peft import LoraConfig, get_peft_model, TaskType
 import random
 
+from training_data import load_tokenized, DEFAULT_DATA_CACHE
+from training_metrics import TrainingMetricsCallback, format_summary, DEFAULT_METRICS_FILE
+from training_distributed import (
+    setup_distributed,
+    cleanup_distributed,
+    is_main_process,
+    print_main,
+    main_process_first,
+    broadcast_object,
+    gradient_bytes
+)
+
 # SECURITY: Enable all security warnings
 warnings.filterwarnings("default", category=UserWarning, module="transformers")
 
@@ -26,11 +43,138 @@ warnings.filterwarnings("default", category=UserWarning, module="transformers")
 MODEL_NAME = "microsoft/Phi-3.5-mini-instruct"
 OUTPUT_DIR = "./fine_tuned_phi_habits"
 CACHE_DIR = "./model_cache"
+# Same shuffle, split and LoRA initialization in every process and every run
+SEED = 42
+
+# How prepare_dataset lays out examples: several per row, padded per batch, or padded to max_length
+PACKING_MODES = ["pack", "dynamic", "pad"]
+# Examples per optimizer step in every mode, so the learning rate and schedule still fit
+EXAMPLES_PER_STEP = 8
+# Examples packed at a time; rows are filled first-fit within each window
+PACK_WINDOW = 1000
+
+def pack_sequences(sequences, max_length, pad_token_id=None):
+    """
+    Concatenate token sequences into rows of at most max_length tokens (first fit, in order).
+    
+    Position ids restart at every sequence, which makes the model attend only within a
+    sequence (see PackedCollator). Each sequence's first token gets no label so nothing is
+    predicted across a boundary, and pad tokens get none, as DataCollatorForLanguageModeling does.
+    """
+    rows = []
+    for ids in sequences:
+        ids = list(ids)[:max_length]
+        row = next((row for row in rows if len(row["input_ids"]) + len(ids) <= max_length), None)
+        if row is None:
+            row = {"input_ids": [], "position_ids": [], "labels": []}
+            rows.append(row)
+        row["input_ids"] += ids
+        row["position_ids"] += range(len(ids))
+        row["labels"] += [-100] + [-100 if token == pad_token_id else token for token in ids[1:]]
+    return rows
+
+def pack_batch(batch, max_length, pad_token_id):
+    """Dataset.map function packing one window of examples with pack_sequences."""
+    rows = pack_sequences(batch["input_ids"], max_length, pad_token_id)
+    return {name: [row[name] for row in rows] for name in ("input_ids", "position_ids", "labels")}
+
+class PackedCollator:
+    """
+    Batch packed rows, padding them to the longest in the batch.
+    
+    No attention_mask is sent: the model then builds a block-diagonal causal mask from the
+    restarting position ids (transformers 5 models; check with packing_supported).
+    """
+    
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+    
+    def __call__(self, features):
+        longest = max(len(feature["input_ids"]) for feature in features)
+        batch = {"input_ids": [], "position_ids": [], "labels": []}
+        for feature in features:
+            padding = longest - len(feature["input_ids"])
+            batch["input_ids"].append(list(feature["input_ids"]) + [self.pad_token_id] * padding)
+            # Repeated zeros start a new sequence per pad token, so padding never joins the last one
+            batch["position_ids"].append(list(feature["position_ids"]) + [0] * padding)
+            batch["labels"].append(list(feature["labels"]) + [-100] * padding)
+        return {name: torch.tensor(values) for name, values in batch.items()}
+
+def packed_examples(inputs):
+    """
+    Examples in a PackedCollator batch: positions 0 followed by 1. Padding restarts at 0 on every
+    token, and a one-token example has no label, so neither is counted.
+    """
+    positions = inputs["position_ids"]
+    return int(((positions[:, :-1] == 0) & (positions[:, 1:] == 1)).sum())
 
-def prepare_dataset(tokenizer):
-    """Prepare training data"""
-    print("\nPreparing training data...")
+def packing_supported(model, tokenizer):
+    """
+    Check that the model keeps packed sequences apart: the second of two sequences in one row
+    must give the same logits as it does alone. Models that build their causal mask without
+    looking at position_ids (older transformers, remote modeling code) let it see the first one.
+    """
+    first = tokenizer("Walk ten thousand steps every day")["input_ids"]
+    second = tokenizer("Drink eight glasses of water daily")["input_ids"]
+    device = next(model.parameters()).device
+    input_ids = torch.tensor([first + second], device=device)
+    position_ids = torch.tensor([list(range(len(first))) + list(range(len(second)))], device=device)
     
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            packed = model(input_ids=input_ids, position_ids=position_ids, use_cache=False).logits[0, len(first):]
+            alone = model(input_ids=torch.tensor([second], device=device), use_cache=False).logits[0]
+    finally:
+        model.train(was_training)
+    return torch.allclose(packed.float(), alone.float(), rtol=1e-2, atol=1e-2)
+
+def count_tokens(dataset, batch_size):
+    """
+    Real and processed (real plus padding) tokens in one epoch over dataset.
+    Batches are padded to their longest row and formed in length order, as length-grouped
+    sampling does; exact for fixed-length rows and for batches of one.
+    """
+    lengths = []
+    real = 0
+    # Streamed, so datasets memory-mapped from the data cache are not loaded whole
+    with dataset.formatted_as(None):
+        for batch in dataset.iter(batch_size=PACK_WINDOW):
+            lengths.extend(len(ids) for ids in batch["input_ids"])
+            if "attention_mask" in batch:
+                real += sum(sum(mask) for mask in batch["attention_mask"])
+            else:
+                real += sum(len(ids) for ids in batch["input_ids"])
+    lengths.sort()
+    processed = sum(max(lengths[i:i + batch_size]) * len(lengths[i:i + batch_size])
+                    for i in range(0, len(lengths), batch_size))
+    return real, processed
+
+def batch_layout(mode, train_dataset, world_size=1):
+    """
+    (per-device batch size, gradient accumulation steps) giving about EXAMPLES_PER_STEP examples
+    per optimizer step across all world_size processes.
+    """
+    per_process = EXAMPLES_PER_STEP / world_size
+    if mode == "pack":
+        # Every example starts at position 0
+        examples = sum(positions.count(0) for batch in train_dataset.iter(batch_size=PACK_WINDOW)
+                       for positions in batch["position_ids"])
+        examples_per_row = examples / max(1, len(train_dataset))
+        return 1, max(1, round(per_process / examples_per_row))
+    if mode == "dynamic":
+        return max(1, round(per_process)), 1
+    return 1, max(1, round(per_process))
+
+def length_grouping():
+    """TrainingArguments option batching examples of similar length (renamed in transformers 5)."""
+    if "train_sampling_strategy" in inspect.signature(TrainingArguments).parameters:
+        return {"train_sampling_strategy": "group_by_length"}
+    return {"group_by_length": True}
+
+def habit_examples(tokenizer):
+    """Built-in training examples: the habit prompt answered with each habit, 20 times over."""
     # Habit templates
     habits = [
         "Walk ten thousand steps every day",
@@ -64,82 +208,166 @@ def prepare_dataset(tokenizer):
             examples.append({"text": text})
     
     random.shuffle(examples)
+    return examples
+
+def prepare_dataset(tokenizer, mode="pack", max_length=256, data=None, cache_dir=DEFAULT_DATA_CACHE):
+    """
+    Prepare training data.
+    
+    Args:
+        tokenizer: Tokenizer of the model being trained
+        mode: "pack" concatenates examples into rows of up to max_length tokens, "dynamic" leaves
+            them unpadded for the collator to pad each batch, "pad" pads each one to max_length
+        max_length: Longest row ("pack") or example ("dynamic", "pad") in tokens
+        data: JSONL files or directories to train on (see training_data.py); None for the built-in examples
+        cache_dir: Directory for the tokenized JSONL data
+    
+    Returns:
+        DatasetDict with "train" and "test" splits
+    """
+    print_main("\nPreparing training data...")
     
-    # Tokenize dataset
-    def tokenize_function(examples):
-        # Process each text individually to avoid nested list issues
-        tokenized = tokenizer(
-            examples["text"],
-            truncation=True,
-            padding="max_length",
-            max_length=256
+    if data:
+        # Deduplicated and tokenized on the first run, memory-mapped from the cache after that
+        tokenized_dataset = load_tokenized(data, tokenizer, max_length=max_length, cache_dir=cache_dir)
+    else:
+        # Tokenize dataset
+        def tokenize_function(examples):
+            # Process each text individually to avoid nested list issues
+            tokenized = tokenizer(
+                examples["text"],
+                truncation=True,
+                max_length=max_length
+            )
+            return {"input_ids": tokenized["input_ids"]}
+        
+        # Create and process dataset
+        dataset = Dataset.from_list(habit_examples(tokenizer))
+        tokenized_dataset = dataset.map(
+            tokenize_function, 
+            batched=True,
+            remove_columns=["text"]  # Remove the text column after tokenization
         )
-        # Copy input_ids to labels
-        tokenized["labels"] = tokenized["input_ids"].copy()
-        return tokenized
-    
-    # Create and process dataset
-    dataset = Dataset.from_list(examples)
-    tokenized_dataset = dataset.map(
-        tokenize_function, 
-        batched=True,
-        remove_columns=["text"]  # Remove the text column after tokenization
-    )
     
-    # Set format for PyTorch
-    tokenized_dataset.set_format("torch", columns=["input_ids", "attention_mask", "labels"])
+    if mode == "pad":
+        def pad_function(examples):
+            padded = tokenizer.pad({"input_ids": examples["input_ids"]}, padding="max_length", max_length=max_length)
+            # Copy input_ids to labels
+            return {"input_ids": padded["input_ids"], "attention_mask": padded["attention_mask"],
+                    "labels": [list(ids) for ids in padded["input_ids"]]}
+        
+        tokenized_dataset = tokenized_dataset.map(pad_function, batched=True)
+        # Set format for PyTorch
+        tokenized_dataset.set_format("torch", columns=["input_ids", "attention_mask", "labels"])
     
     # Split into train/eval
     split = tokenized_dataset.train_test_split(test_size=0.1, seed=42)
     
-    print(f"Training examples: {len(split['train'])}")
-    print(f"Evaluation examples: {len(split['test'])}")
+    print_main(f"Training examples: {len(split['train'])}")
+    print_main(f"Evaluation examples: {len(split['test'])}")
+    
+    if mode == "pack":
+        # Packed per split, so evaluation examples never share a row with training ones
+        for name in split:
+            split[name] = split[name].map(
+                pack_batch,
+                fn_kwargs={"max_length": max_length, "pad_token_id": tokenizer.pad_token_id},
+                batched=True,
+                batch_size=PACK_WINDOW,
+                remove_columns=split[name].column_names
+            )
+        print_main(f"Packed into {len(split['train'])} training rows of up to {max_length} tokens")
     
     return split
 
 def main():
-    print("\n" + "=" * 50)
-    print("SIMPLIFIED HABIT MODEL TRAINING")
-    print("=" * 50)
+    parser = argparse.ArgumentParser(description="Fine-tune LoRA adapters for habit suggestions")
+    parser.add_argument("--model", default=MODEL_NAME, help="Base model name or path")
+    parser.add_argument("--output", default=OUTPUT_DIR, help="Directory for the trained adapters")
+    parser.add_argument("--packing", choices=PACKING_MODES, default="pack",
+                        help="pack: several examples per row (default); dynamic: pad each batch of similar-length "
+                             "examples to its longest; pad: pad every example to --max-length")
+    parser.add_argument("--max-length", type=int, default=256, help="Tokens per packed row or padded example")
+    parser.add_argument("--data", nargs="+", metavar="PATH",
+                        help="JSONL files or directories of them to train on instead of the built-in habit examples")
+    parser.add_argument("--data-cache", default=DEFAULT_DATA_CACHE, help="Directory for the tokenized --data")
+    parser.add_argument("--metrics-file", default=None,
+                        help=f"Per-step throughput and memory JSONL (default: {DEFAULT_METRICS_FILE} in --output)")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Train the tiny local model (tiny_model.py) for --benchmark-steps steps without "
+                             "evaluating or saving, and print a throughput summary")
+    parser.add_argument("--benchmark-steps", type=int, default=20, help="Optimizer steps in --benchmark mode")
+    parser.add_argument("--logging-steps", type=int, default=10, help="Optimizer steps between logged losses")
+    parser.add_argument("--learning-rate", type=float, default=5e-5, help="Peak learning rate")
+    args = parser.parse_args()
+    output_dir = args.output
+    model_name = args.model
+    
+    # Set when started by training_distributed.py (torchrun); None for a single process
+    distributed = setup_distributed()
+    world_size = distributed["world_size"] if distributed else 1
+    # Data-parallel training runs on CPU cores, over gloo
+    on_gpu = torch.cuda.is_available() and not distributed
+    set_seed(SEED)
     
+    print_main("\n" + "=" * 50)
+    print_main("SIMPLIFIED HABIT MODEL TRAINING")
+    print_main("=" * 50)
+    if distributed:
+        print_main(f"Data parallel: {world_size} processes, {distributed['local_world_size']} on this host "
+                   f"with {distributed['threads']} threads each")
+    
+    if args.benchmark:
+        from tiny_model import build_tiny_model, DEFAULT_TINY_MODEL_DIR
+        
+        # Same training code paths in seconds, with no download; nothing is kept
+        with main_process_first():
+            model_name = build_tiny_model(DEFAULT_TINY_MODEL_DIR, with_adapter=False)["model_path"]
+        output_dir = tempfile.mkdtemp(prefix="simple_train_benchmark_")
     # Check if output exists
-    if os.path.exists(OUTPUT_DIR):
-        response = input(f"\n{OUTPUT_DIR} already exists. Delete and retrain? (y/n): ")
-        if response.lower() != 'y':
-            print("Exiting.")
+    elif os.path.exists(output_dir):
+        # Only the first process asks; the others follow its answer
+        response = input(f"\n{output_dir} already exists. Delete and retrain? (y/n): ") if is_main_process() else None
+        if broadcast_object(response).lower() != 'y':
+            print_main("Exiting.")
+            cleanup_distributed()
             return
-        import shutil
-        shutil.rmtree(OUTPUT_DIR)
+        if is_main_process():
+            shutil.rmtree(output_dir)
+    metrics_file = args.metrics_file or (None if args.benchmark else os.path.join(output_dir, DEFAULT_METRICS_FILE))
     
     # Load tokenizer
-    print("\nLoading tokenizer...")
-    tokenizer = AutoTokenizer.from_pretrained(
-        MODEL_NAME,
-        cache_dir=CACHE_DIR,
-        trust_remote_code=True,
-        code_revision=None
-    )
+    print_main("\nLoading tokenizer...")
+    # Downloaded once per host
+    with main_process_first():
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_name,
+            cache_dir=CACHE_DIR,
+            trust_remote_code=True,
+            code_revision=None
+        )
     
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
         tokenizer.pad_token_id = tokenizer.eos_token_id
     
     # Load model
-    print("Loading model...")
-    print("This may take a while if downloading for the first time...")
-    
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        cache_dir=CACHE_DIR,
-        torch_dtype=torch.float32 if not torch.cuda.is_available() else torch.float16,
-        device_map="auto",
-        trust_remote_code=True,
-        code_revision=None,
-        low_cpu_mem_usage=True
-    )
+    print_main("Loading model...")
+    print_main("This may take a while if downloading for the first time...")
+    
+    with main_process_first():
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            cache_dir=CACHE_DIR,
+            torch_dtype=torch.float16 if on_gpu else torch.float32,
+            device_map="auto" if not distributed else None,  # Each process holds a full copy
+            trust_remote_code=True,
+            code_revision=None,
+            low_cpu_mem_usage=True
+        )
     
     # Apply LoRA
-    print("\nApplying LoRA configuration...")
+    print_main("\nApplying LoRA configuration...")
     lora_config = LoraConfig(
         task_type=TaskType.CAUSAL_LM,
         r=8,
@@ -150,39 +378,84 @@ def main():
     )
     
     model = get_peft_model(model, lora_config)
-    model.print_trainable_parameters()
+    if is_main_process():
+        model.print_trainable_parameters()
+    if distributed:
+        print_main(f"All-reducing {gradient_bytes(model) / (1024 * 1024):.1f} MB of LoRA gradients per optimizer step")
+    # A cache built during the forward pass would also disable the packed-sequence mask
+    model.config.use_cache = False
+    
+    mode = args.packing
+    if mode == "pack" and not packing_supported(model, tokenizer):
+        print_main("This model does not keep packed examples apart; using --packing dynamic instead")
+        mode = "dynamic"
     
     # Prepare dataset
-    dataset = prepare_dataset(tokenizer)
+    # Every process prepares the whole dataset (from the data cache after the first); the Trainer
+    # gives each one its own shard
+    with main_process_first():
+        dataset = prepare_dataset(tokenizer, mode=mode, max_length=args.max_length,
+                                  data=args.data, cache_dir=args.data_cache)
+    
+    batch_size, accumulation_steps = batch_layout(mode, dataset["train"], world_size)
+    real_tokens, processed_tokens = count_tokens(dataset["train"], batch_size)
+    print_main(f"Padding: {1 - real_tokens / processed_tokens:.1%} of {processed_tokens} tokens per epoch "
+               f"(batch size {batch_size}, accumulation {accumulation_steps}, {world_size} process(es))")
     
     # Training arguments
     training_args = TrainingArguments(
-        output_dir=OUTPUT_DIR,
+        output_dir=output_dir,
         num_train_epochs=3,
-        per_device_train_batch_size=1,  # Small batch size for CPU
-        per_device_eval_batch_size=1,
-        gradient_accumulation_steps=8,
+        max_steps=args.benchmark_steps if args.benchmark else -1,
+        per_device_train_batch_size=batch_size,  # Rows of several examples, or one example at a time on CPU
+        per_device_eval_batch_size=batch_size,
+        gradient_accumulation_steps=accumulation_steps,
         warmup_steps=100,
-        logging_steps=10,
-        save_strategy="epoch",
-        eval_strategy="epoch",
+        logging_steps=args.logging_steps,
+        save_strategy="no" if args.benchmark else "epoch",
+        eval_strategy="no" if args.benchmark else "epoch",
         save_total_limit=2,
-        load_best_model_at_end=True,
+        load_best_model_at_end=not args.benchmark,
         metric_for_best_model="loss",
         greater_is_better=False,
         report_to="none",
         optim="adamw_torch",
-        learning_rate=5e-5,
-        fp16=torch.cuda.is_available(),
+        learning_rate=args.learning_rate,
+        seed=SEED,
+        fp16=on_gpu,
+        use_cpu=bool(distributed),
+        ddp_backend="gloo" if distributed else None,
+        ddp_find_unused_parameters=False,  # Every LoRA parameter gets a gradient each step
         push_to_hub=False,
         remove_unused_columns=False,
+        **(length_grouping() if mode == "dynamic" else {}),
     )
     
-    # Data collator - simplified version
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,  # Causal LM, not masked LM
-        pad_to_multiple_of=None  # Remove padding to multiple to avoid issues
+    if mode == "pack":
+        data_collator = PackedCollator(tokenizer.pad_token_id)
+    else:
+        # Data collator - simplified version; pads each batch to its longest example
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,  # Causal LM, not masked LM
+            pad_to_multiple_of=None  # Remove padding to multiple to avoid issues
+        )
+    
+    metrics = TrainingMetricsCallback(
+        metrics_file,
+        # The first steps pay for lazy allocations and data-loader start-up
+        warmup_steps=2 if args.benchmark else 1,
+        run_info={
+            "model": model_name,
+            "packing": mode,
+            "batch_size": batch_size,
+            "gradient_accumulation_steps": accumulation_steps,
+            "max_length": args.max_length,
+            "world_size": world_size,
+            "torch_threads": torch.get_num_threads()
+        },
+        # Packed rows hold several examples; count those, so samples/sec compares across modes
+        count_examples=packed_examples if mode == "pack" else None
     )
     
     # Create trainer
@@ -192,19 +465,42 @@ def main():
         train_dataset=dataset["train"],
         eval_dataset=dataset["test"],
         data_collator=data_collator,
+        processing_class=tokenizer,  # Lets the Trainer tell padding apart when counting tokens
+        callbacks=[metrics],
     )
     
     # Train
-    print("\nStarting training...")
-    print("This will take 10-20 minutes on CPU...")
-    trainer.train()
+    print_main("\nStarting training...")
+    if mode == "pad" and not args.benchmark:
+        print_main("This will take 10-20 minutes on CPU...")
+    train_result = trainer.train()
+    
+    if args.benchmark:
+        print_main(f"\nBenchmark: {args.benchmark_steps} steps on the tiny model, --packing {mode}, "
+                   f"{world_size} process(es) of {torch.get_num_threads()} threads")
+        print_main(format_summary(metrics.summary()))
+        if metrics_file:
+            print_main(f"Per-step metrics written to {metrics_file}")
+        shutil.rmtree(output_dir, ignore_errors=True)
+        cleanup_distributed()
+        return
+    
+    runtime = train_result.metrics["train_runtime"]
+    # Runtime includes the per-epoch evaluation
+    print_main(f"Effective throughput: {real_tokens * training_args.num_train_epochs / runtime:.0f} real tokens/sec "
+               f"({runtime:.0f}s, {1 - real_tokens / processed_tokens:.1%} padding)")
     
-    # Save model
-    print("\nSaving model...")
+    # Save model (the Trainer writes from the first process only)
+    print_main("\nSaving model...")
     trainer.save_model()
-    tokenizer.save_pretrained(OUTPUT_DIR)
+    if not is_main_process():
+        cleanup_distributed()
+        return
+    tokenizer.save_pretrained(output_dir)
     
-    print(f"\n✅ Training complete! Model saved to {OUTPUT_DIR}")
+    print(f"\n✅ Training complete! Model saved to {output_dir}")
+    print(format_summary(metrics.summary()))
+    print(f"Per-step metrics written to {metrics_file}")
     
     # Test the model
     print("\nTesting the fine-tuned model...")
@@ -225,6 +521,7 @@ def main():
     
     response = tokenizer.decode(outputs[0][len(inputs['input_ids'][0]):], skip_special_tokens=True)
     print(f"Sample output: {response}")
+    cleanup_distributed()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
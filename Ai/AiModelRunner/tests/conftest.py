@@ -0,0 +1,9 @@
+"""
+The runner's modules import each other by bare name (they are run as scripts from
+Ai/AiModelRunner), so the tests put that directory on sys.path.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+"""Tests for the bounded request queue (ai_model_admission.py)."""
+
+import pytest
+
+from ai_model_admission import AdmissionController, QueueFullError
+
+
+def test_rejects_past_max_queue_depth():
+    admission = AdmissionController(max_queue_depth=2)
+    admission.acquire()
+    admission.acquire()
+    with pytest.raises(QueueFullError):
+        admission.acquire()
+
+    stats = admission.get_stats()
+    assert stats["in_flight"] == 2
+    assert stats["admitted"] == 2
+    assert stats["rejected"] == 1
+
+
+def test_release_frees_a_slot():
+    admission = AdmissionController(max_queue_depth=1)
+    admission.acquire()
+    admission.release(0.5)
+    admission.acquire()
+    assert admission.get_stats()["completed"] == 1
+
+
+def test_zero_depth_is_unlimited():
+    admission = AdmissionController(max_queue_depth=0)
+    for _ in range(1000):
+        admission.acquire()
+    assert admission.get_stats()["in_flight"] == 1000
+
+
+def test_admit_releases_on_error():
+    admission = AdmissionController(max_queue_depth=1)
+    with pytest.raises(RuntimeError):
+        with admission.admit():
+            assert admission.get_stats()["in_flight"] == 1
+            raise RuntimeError("generation failed")
+    stats = admission.get_stats()
+    assert stats["in_flight"] == 0
+    assert stats["completed"] == 1
+
+
+def test_retry_after_defaults_to_minimum():
+    admission = AdmissionController(max_queue_depth=1, min_retry_after=3)
+    admission.acquire()
+    with pytest.raises(QueueFullError) as raised:
+        admission.acquire()
+    assert raised.value.retry_after == 3
+
+
+def test_retry_after_follows_average_latency():
+    admission = AdmissionController(max_queue_depth=1, min_retry_after=1)
+    # The first latency seeds the average, later ones move it by a tenth
+    admission.acquire()
+    admission.release(4.2)
+    admission.acquire()
+    admission.release(14.2)
+    assert admission.get_stats()["average_latency"] == pytest.approx(5.2)
+
+    admission.acquire()
+    with pytest.raises(QueueFullError) as raised:
+        admission.acquire()
+    # Rounded up to whole seconds
+    assert raised.value.retry_after == 6
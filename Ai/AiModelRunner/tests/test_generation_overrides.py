@@ -0,0 +1,43 @@
+"""Tests for validate_generation_overrides (ai_model_core.py)."""
+
+import pytest
+
+from ai_model_core import validate_generation_overrides
+
+
+def test_coerces_numbers():
+    params = validate_generation_overrides({"temperature": "0.5", "top_p": 1, "max_new_tokens": "12"})
+    assert params == {"temperature": 0.5, "top_p": 1.0, "max_new_tokens": 12}
+    assert isinstance(params["max_new_tokens"], int)
+
+
+def test_integral_float_max_new_tokens():
+    assert validate_generation_overrides({"max_new_tokens": 8.0})["max_new_tokens"] == 8
+
+
+def test_leaves_other_params_and_input_alone():
+    original = {"temperature": "0.7", "stop": ["."], "adapter": "v2"}
+    params = validate_generation_overrides(original)
+    assert params == {"temperature": 0.7, "stop": ["."], "adapter": "v2"}
+    assert original["temperature"] == "0.7"
+
+
+@pytest.mark.parametrize("name, value", [
+    ("temperature", 0),
+    ("temperature", -1),
+    ("temperature", float("inf")),
+    ("temperature", "hot"),
+    ("temperature", None),
+    ("top_p", 0),
+    ("top_p", 1.5),
+    ("max_new_tokens", 0),
+    ("max_new_tokens", 2.5),
+    ("max_new_tokens", "ten"),
+    ("max_new_tokens", float("inf")),
+    # JSON true/false would otherwise pass as 1 and 0
+    ("max_new_tokens", True),
+    ("temperature", False),
+])
+def test_rejects_invalid_values(name, value):
+    with pytest.raises(ValueError, match=name):
+        validate_generation_overrides({name: value})
@@ -0,0 +1,95 @@
+"""Tests for sequence packing and batch layout (simple_train.py)."""
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+datasets = pytest.importorskip("datasets")
+
+from simple_train import (  # noqa: E402
+    EXAMPLES_PER_STEP,
+    PackedCollator,
+    batch_layout,
+    pack_batch,
+    pack_sequences,
+    packed_examples
+)
+
+PAD = 0
+
+
+def test_packs_first_fit_in_order():
+    rows = pack_sequences([[1, 2, 3], [4, 5], [6, 7, 8, 9], [10]], max_length=5, pad_token_id=PAD)
+    assert [row["input_ids"] for row in rows] == [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]]
+
+
+def test_position_ids_restart_at_every_sequence():
+    rows = pack_sequences([[1, 2, 3], [4, 5]], max_length=8, pad_token_id=PAD)
+    assert rows[0]["position_ids"] == [0, 1, 2, 0, 1]
+
+
+def test_no_label_across_boundaries_or_on_padding():
+    rows = pack_sequences([[1, 2, 3], [4, PAD, 5]], max_length=8, pad_token_id=PAD)
+    # Each sequence's first token is not predicted from the previous sequence
+    assert rows[0]["labels"] == [-100, 2, 3, -100, -100, 5]
+
+
+def test_truncates_long_sequences():
+    rows = pack_sequences([list(range(1, 8))], max_length=5, pad_token_id=PAD)
+    assert rows[0]["input_ids"] == [1, 2, 3, 4, 5]
+    assert rows[0]["position_ids"] == [0, 1, 2, 3, 4]
+
+
+def test_pack_batch_returns_columns():
+    packed = pack_batch({"input_ids": [[1, 2], [3, 4]]}, max_length=4, pad_token_id=PAD)
+    assert packed == {"input_ids": [[1, 2, 3, 4]], "position_ids": [[0, 1, 0, 1]], "labels": [[-100, 2, -100, 4]]}
+
+
+def test_collator_pads_to_longest_row():
+    collator = PackedCollator(PAD)
+    batch = collator([
+        {"input_ids": [1, 2, 3], "position_ids": [0, 1, 0], "labels": [-100, 2, -100]},
+        {"input_ids": [4], "position_ids": [0], "labels": [-100]}
+    ])
+    assert set(batch) == {"input_ids", "position_ids", "labels"}
+    assert batch["input_ids"].tolist() == [[1, 2, 3], [4, PAD, PAD]]
+    # Padding restarts positions on every token so it never joins the last sequence
+    assert batch["position_ids"].tolist() == [[0, 1, 0], [0, 0, 0]]
+    assert batch["labels"].tolist() == [[-100, 2, -100], [-100, -100, -100]]
+
+
+def test_packed_examples_skips_padding_and_single_tokens():
+    collator = PackedCollator(PAD)
+    batch = collator([
+        {"input_ids": [1, 2, 3, 4, 5], "position_ids": [0, 1, 0, 1, 0], "labels": [-100, 2, -100, 4, -100]},
+        {"input_ids": [6, 7], "position_ids": [0, 1], "labels": [-100, 7]}
+    ])
+    assert packed_examples(batch) == 3
+
+
+@pytest.mark.parametrize("world_size, expected", [
+    (1, (EXAMPLES_PER_STEP, 1)),
+    (2, (EXAMPLES_PER_STEP // 2, 1)),
+    (4 * EXAMPLES_PER_STEP, (1, 1)),
+])
+def test_batch_layout_dynamic(world_size, expected):
+    assert batch_layout("dynamic", None, world_size) == expected
+
+
+@pytest.mark.parametrize("world_size, expected", [
+    (1, (1, EXAMPLES_PER_STEP)),
+    (2, (1, EXAMPLES_PER_STEP // 2)),
+])
+def test_batch_layout_pad(world_size, expected):
+    assert batch_layout("pad", None, world_size) == expected
+
+
+def test_batch_layout_pack_counts_examples_per_row():
+    # Two examples per row on average
+    dataset = datasets.Dataset.from_list([
+        {"position_ids": [0, 1, 0, 1]},
+        {"position_ids": [0, 1, 2, 0]}
+    ])
+    assert batch_layout("pack", dataset) == (1, EXAMPLES_PER_STEP // 2)
+    assert batch_layout("pack", dataset, world_size=2) == (1, EXAMPLES_PER_STEP // 4)
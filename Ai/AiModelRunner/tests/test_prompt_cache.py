@@ -0,0 +1,54 @@
+"""Tests for the tokenized-prompt LRU cache (ai_model_core._PromptCache)."""
+
+from ai_model_core import _PromptCache
+
+
+def test_get_counts_hits_and_misses():
+    cache = _PromptCache(max_entries=4)
+    assert cache.get("a") is None
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["hit_rate"] == 0.5
+
+
+def test_evicts_least_recently_used():
+    cache = _PromptCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Reading "a" makes "b" the oldest
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get_stats()["entries"] == 2
+
+
+def test_put_refreshes_existing_key():
+    cache = _PromptCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.put("a", 10)
+    cache.put("c", 3)
+    assert cache.get("a") == 10
+    assert cache.get("b") is None
+
+
+def test_zero_entries_disables_caching():
+    cache = _PromptCache(max_entries=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_clear_keeps_counters():
+    cache = _PromptCache(max_entries=2)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.clear()
+    assert cache.get("a") is None
+    stats = cache.get_stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (0, 1, 1)
@@ -0,0 +1,94 @@
+"""Tests for stop-sequence matching (ai_model_stopping.py)."""
+
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from ai_model_stopping import (  # noqa: E402
+    DeadlineStoppingCriteria,
+    StopSequenceCriteria,
+    StopSequenceMatcher,
+    truncate_at_stop
+)
+
+WALK, DAILY, NEWLINE, E, ND, EOS = range(6)
+
+
+class PieceTokenizer:
+    """Decodes each token id to a fixed piece of text."""
+
+    pieces = {WALK: "Walk", DAILY: " daily", NEWLINE: "\n", E: "E", ND: "ND", EOS: "<eos>"}
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(self.pieces[token] for token in ids)
+
+
+def feed(matcher, tokens):
+    """should_stop after each token, in order (the matcher keeps state between calls)."""
+    return [matcher.should_stop(tokens[:count]) for count in range(1, len(tokens) + 1)]
+
+
+def test_stops_at_newline_after_text():
+    matcher = StopSequenceMatcher(PieceTokenizer(), ["\n"])
+    assert feed(matcher, [WALK, DAILY, NEWLINE]) == [False, False, True]
+
+
+def test_leading_whitespace_never_matches():
+    matcher = StopSequenceMatcher(PieceTokenizer(), ["\n"])
+    assert feed(matcher, [NEWLINE, NEWLINE, WALK, NEWLINE]) == [False, False, False, True]
+
+
+def test_matches_across_token_boundaries():
+    matcher = StopSequenceMatcher(PieceTokenizer(), ["END"])
+    assert feed(matcher, [WALK, E, ND]) == [False, False, True]
+
+
+def test_matches_after_many_tokens():
+    matcher = StopSequenceMatcher(PieceTokenizer(), ["END"])
+    tokens = [WALK] + [DAILY] * 20 + [E, ND]
+    assert feed(matcher, tokens) == [False] * (len(tokens) - 1) + [True]
+
+
+def test_stop_token_ids():
+    matcher = StopSequenceMatcher(PieceTokenizer(), [], stop_token_ids=[EOS])
+    assert feed(matcher, [WALK, NEWLINE, EOS]) == [False, False, True]
+
+
+def test_empty_stop_strings_are_ignored():
+    matcher = StopSequenceMatcher(PieceTokenizer(), [""])
+    assert feed(matcher, [WALK, NEWLINE]) == [False, False]
+
+
+def test_criteria_stop_rows_independently():
+    criteria = StopSequenceCriteria(PieceTokenizer(), ["\n"], stop_token_ids=[EOS])
+    prompt = [WALK, WALK, WALK]
+    first = torch.tensor([prompt + [WALK], prompt + [EOS]])
+    assert criteria(first, None).tolist() == [False, True]
+    second = torch.cat([first, torch.tensor([[NEWLINE], [NEWLINE]])], dim=1)
+    assert criteria(second, None).tolist() == [True, True]
+
+
+def test_deadline_criteria():
+    ids = torch.zeros((2, 3), dtype=torch.long)
+    assert DeadlineStoppingCriteria()(ids, None).tolist() == [False, False]
+    assert DeadlineStoppingCriteria(deadline=0.0)(ids, None).tolist() == [True, True]
+    cancel_event = threading.Event()
+    criteria = DeadlineStoppingCriteria(cancel_event=cancel_event)
+    assert not criteria.expired()
+    cancel_event.set()
+    assert criteria(ids, None).tolist() == [True, True]
+
+
+@pytest.mark.parametrize("text, stops, expected", [
+    ("Walk daily\nmore", ["\n"], "Walk daily"),
+    ("\n\nWalk daily\nmore", ["\n"], "\n\nWalk daily"),
+    ("Walk. Run.", [".", " Run"], "Walk"),
+    ("Walk daily", ["\n"], "Walk daily"),
+    ("Walk daily", [""], "Walk daily"),
+    ("Walk daily", [], "Walk daily"),
+])
+def test_truncate_at_stop(text, stops, expected):
+    assert truncate_at_stop(text, stops) == expected
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Tiny randomly initialized stand-in for Phi-3.5-mini-instruct.
+Builds a Phi-3 architecture model with a few small layers, a locally trained
+BPE tokenizer with the Phi-3 chat template, and optionally a LoRA adapter on
+the same modules simple_train.py targets. Needs no network access, so
+benchmarks and load tests can run AiModelCore on any machine.
+
+Usage:
+    python tiny_model.py --output ./tiny_model
+"""
+
+import os
+import json
+import argparse
+from typing import Dict, Any
+
+TINY_MODEL_MARKER = "tiny_model.json"
+DEFAULT_TINY_MODEL_DIR = "./tiny_model"
+TINY_ADAPTER_DIR = "adapter"
+
+# Bump when the generated model changes so cached copies are rebuilt
+TINY_MODEL_VERSION = 1
+
+DEFAULT_CONFIG = {
+    "hidden_size": 128,
+    "intermediate_size": 256,
+    "num_hidden_layers": 4,
+    "num_attention_heads": 4,
+    "vocab_size": 1024,
+    "max_position_embeddings": 2048,
+    "seed": 0
+}
+
+# Same chat format as Phi-3.5-mini-instruct
+PHI3_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|' + message['role'] + '|>\n' + message['content'] + '<|end|>\n' }}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|assistant|>\n' }}{% endif %}"
+)
+SPECIAL_TOKENS = ["<unk>", "<s>", "<|endoftext|>", "<|system|>", "<|user|>", "<|assistant|>", "<|end|>"]
+
+# Tokenizer training text: habit suggestions and the prompts used by the C# tests
+TOKENIZER_CORPUS = [
+    "You are a helpful habit tracking assistant. Provide concise, actionable responses.",
+    "Please suggest a habit that can be tracked",
+    "Suggest a morning habit. Suggest an evening habit. Suggest a weekend habit.",
+    "Can you tell me about yourself? Can you tell me one good joke? Can you tell me something smart?",
+    "Walk ten thousand steps every day",
+    "Drink eight glasses of water daily",
+    "Meditate ten minutes every single morning",
+    "Read twenty pages of book daily",
+    "Exercise thirty minutes each morning daily",
+    "Write three things you are grateful for tonight",
+    "Stretch for five minutes after waking up",
+    "Go to bed before eleven every night",
+]
+
+
+def build_tiny_model(output_dir: str = DEFAULT_TINY_MODEL_DIR,
+                     with_adapter: bool = True,
+                     force: bool = False,
+                     **config_overrides) -> Dict[str, Any]:
+    """
+    Build (or reuse) the tiny model in output_dir.
+
+    Args:
+        output_dir: Directory for the model, tokenizer and optional adapter
+        with_adapter: Also save a LoRA adapter under output_dir/adapter (needs peft)
+        force: Rebuild even when a matching model already exists
+        **config_overrides: Override DEFAULT_CONFIG entries
+
+    Returns:
+        The marker dict, including "model_path" and "adapter_path" (None without an adapter)
+    """
+    config = dict(DEFAULT_CONFIG, **config_overrides)
+    marker_path = os.path.join(output_dir, TINY_MODEL_MARKER)
+    adapter_dir = os.path.join(output_dir, TINY_ADAPTER_DIR)
+
+    if not force and os.path.exists(marker_path):
+        with open(marker_path, "r") as f:
+            marker = json.load(f)
+        if (marker.get("version") == TINY_MODEL_VERSION and marker.get("config") == config
+                and (marker.get("adapter_path") is not None or not with_adapter)):
+            return marker
+
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+    from transformers import PreTrainedTokenizerFast, Phi3Config, Phi3ForCausalLM
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Byte-level BPE so any input text can be encoded
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=config["vocab_size"],
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    bpe.train_from_iterator(TOKENIZER_CORPUS * 10, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=bpe,
+        bos_token="<s>",
+        eos_token="<|endoftext|>",
+        unk_token="<unk>",
+        pad_token="<|endoftext|>"
+    )
+    tokenizer.chat_template = PHI3_CHAT_TEMPLATE
+    tokenizer.save_pretrained(output_dir)
+
+    torch.manual_seed(config["seed"])
+    model_config = Phi3Config(
+        vocab_size=len(tokenizer),
+        hidden_size=config["hidden_size"],
+        intermediate_size=config["intermediate_size"],
+        num_hidden_layers=config["num_hidden_layers"],
+        num_attention_heads=config["num_attention_heads"],
+        num_key_value_heads=config["num_attention_heads"],
+        max_position_embeddings=config["max_position_embeddings"],
+        original_max_position_embeddings=config["max_position_embeddings"],
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id
+    )
+    model = Phi3ForCausalLM(model_config)
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    model.save_pretrained(output_dir)
+
+    adapter_path = None
+    if with_adapter:
+        try:
+            from peft import LoraConfig, get_peft_model, TaskType
+        except ImportError:
+            print("peft not installed, building the tiny model without an adapter")
+        else:
+            lora_config = LoraConfig(
+                task_type=TaskType.CAUSAL_LM,
+                r=8,
+                lora_alpha=16,
+                lora_dropout=0.0,
+                target_modules=["qkv_proj", "o_proj"],
+                bias="none",
+                init_lora_weights=False  # random B so the adapter changes outputs
+            )
+            get_peft_model(model, lora_config).save_pretrained(adapter_dir)
+            adapter_path = adapter_dir
+
+    parameters = sum(p.numel() for p in model.parameters())
+    marker = {
+        "version": TINY_MODEL_VERSION,
+        "config": config,
+        "parameters": parameters,
+        "model_path": output_dir,
+        "adapter_path": adapter_path
+    }
+    with open(marker_path, "w") as f:
+        json.dump(marker, f, indent=2)
+    return marker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a tiny random stand-in for Phi-3.5-mini-instruct")
+    parser.add_argument("--output", default=DEFAULT_TINY_MODEL_DIR, help="Output directory")
+    parser.add_argument("--no-adapter", action="store_true", help="Do not build a LoRA adapter")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the model exists")
+    parser.add_argument("--layers", type=int, default=DEFAULT_CONFIG["num_hidden_layers"])
+    parser.add_argument("--hidden-size", type=int, default=DEFAULT_CONFIG["hidden_size"])
+    args = parser.parse_args()
+
+    marker = build_tiny_model(
+        args.output,
+        with_adapter=not args.no_adapter,
+        force=args.force,
+        num_hidden_layers=args.layers,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2
+    )
+    print(f"✅ Tiny model ({marker['parameters']:,} parameters) at {marker['model_path']}")
+    if marker["adapter_path"]:
+        print(f"   LoRA adapter at {marker['adapter_path']}")
+
+
+if __name__ == "__main__":
+    main()
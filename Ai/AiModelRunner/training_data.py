@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Training-data pipeline for simple_train.py and qlora_train.py.
+Streams chat examples from JSONL files of any size and drops duplicates. Worker
+processes render the chat template and tokenize, and the tokens are saved as an
+Arrow dataset under ./data_cache. The cache is keyed by the tokenizer, its chat
+template, the source files and max_length. Later runs memory-map it instead of
+tokenizing again, so corpora larger than RAM can be trained on.
+
+Input lines are JSON objects with "messages" (a chat, as passed to
+apply_chat_template), with a "response" and optional "prompt" (default: the
+habit prompt), or with an already rendered "text". A bare JSON string is taken
+as the response. Lines that are not valid examples are skipped and counted.
+
+Usage:
+    python training_data.py habits.jsonl more_habits/ --model microsoft/Phi-3.5-mini-instruct
+    python simple_train.py --data habits.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from ai_model_threads import available_cores
+
+DEFAULT_DATA_CACHE = "./data_cache"
+DEFAULT_PROMPT = "Please suggest a habit that can be tracked"
+CACHE_MANIFEST = "pipeline.json"
+# Bump when rendering or the cached layout changes
+DATA_CACHE_VERSION = 1
+# Examples per worker before tokenizing in parallel pays for starting the workers
+EXAMPLES_PER_WORKER = 1000
+
+
+def find_sources(paths: Iterable[str]) -> List[str]:
+    """Expand directories to the .jsonl files inside them (sorted); files are kept as given."""
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names if name.endswith(".jsonl")
+            )
+            if not found:
+                raise ValueError(f"No .jsonl files in {path}")
+            sources.extend(found)
+        elif os.path.isfile(path):
+            sources.append(path)
+        else:
+            raise ValueError(f"Training data not found: {path}")
+    return sources
+
+
+def parse_example(data: Any) -> Optional[Dict[str, Any]]:
+    """Turn one decoded JSONL value into {"messages": [...]} or {"text": ...}, or None if it is not an example."""
+    if isinstance(data, str):
+        data = {"response": data}
+    if not isinstance(data, dict):
+        return None
+
+    if "text" in data:
+        text = data["text"]
+        return {"text": text} if isinstance(text, str) and text.strip() else None
+
+    messages = data.get("messages")
+    if messages is None:
+        response = data.get("response")
+        prompt = data.get("prompt", DEFAULT_PROMPT)
+        if not isinstance(response, str) or not response.strip() or not isinstance(prompt, str):
+            return None
+        messages = [
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": response.strip()}
+        ]
+    if not isinstance(messages, list) or not messages:
+        return None
+    for message in messages:
+        if (not isinstance(message, dict) or not isinstance(message.get("role"), str)
+                or not isinstance(message.get("content"), str)):
+            return None
+    # Only role and content reach the template, so other keys do not make duplicates distinct
+    return {"messages": [{"role": m["role"], "content": m["content"]} for m in messages]}
+
+
+def iter_examples(sources: Iterable[str], dedupe: bool = True,
+                  stats: Optional[Dict[str, int]] = None) -> Iterator[str]:
+    """
+    Stream examples from JSONL files as canonical JSON strings.
+
+    Args:
+        sources: JSONL file paths
+        dedupe: Skip examples seen earlier; costs about 100 bytes of memory per unique example
+        stats: Dict updated with "examples", "duplicates" and "invalid" counts
+
+    Yields:
+        JSON of the example's {"messages": [...]} or {"text": ...}
+    """
+    stats = stats if stats is not None else {}
+    for name in ("examples", "duplicates", "invalid"):
+        stats.setdefault(name, 0)
+    seen = set()
+
+    for source in sources:
+        with open(source, "rb") as f:
+            for line_number, raw in enumerate(f, 1):
+                if not raw.strip():
+                    continue
+                try:
+                    example = parse_example(json.loads(raw.decode("utf-8")))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    example = None
+                if example is None:
+                    stats["invalid"] += 1
+                    if stats["invalid"] <= 5:
+                        print(f"Skipping {source}:{line_number}: not a training example")
+                    continue
+
+                canonical = json.dumps(example, ensure_ascii=False, sort_keys=True)
+                if dedupe:
+                    digest = hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+                    if digest in seen:
+                        stats["duplicates"] += 1
+                        continue
+                    seen.add(digest)
+                stats["examples"] += 1
+                yield canonical
+
+
+def write_jsonl(path: str, records: Iterable[Dict[str, Any]]):
+    """Write records one JSON object per line, the format iter_examples reads."""
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of everything about the tokenizer that changes the tokens of a rendered example."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        state = backend.to_str()
+    else:
+        state = json.dumps(sorted(tokenizer.get_vocab().items()))
+    digest = hashlib.sha256(state.encode("utf-8"))
+    digest.update(json.dumps([
+        type(tokenizer).__name__,
+        str(tokenizer.special_tokens_map),
+        tokenizer.chat_template
+    ], sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_key(sources: List[str], tokenizer, max_length: Optional[int], dedupe: bool) -> str:
+    """Key of the tokenized cache; source files are identified by path, size and modification time."""
+    files = []
+    for source in sources:
+        stat = os.stat(source)
+        files.append([os.path.abspath(source), stat.st_size, stat.st_mtime_ns])
+    key = json.dumps({
+        "version": DATA_CACHE_VERSION,
+        "sources": files,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "max_length": max_length,
+        "dedupe": dedupe
+    }, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def _example_rows(sources: List[str], dedupe: bool, stats: Dict[str, int]) -> Iterator[Dict[str, str]]:
+    """iter_examples as rows for Dataset.from_generator."""
+    for canonical in iter_examples(sources, dedupe=dedupe, stats=stats):
+        yield {"example": canonical}
+
+
+def _tokenize_batch(batch: Dict[str, List[str]], tokenizer, max_length: Optional[int]) -> Dict[str, List[List[int]]]:
+    """Render and tokenize a batch of canonical examples (runs in the worker processes)."""
+    texts = []
+    for canonical in batch["example"]:
+        example = json.loads(canonical)
+        if "text" in example:
+            texts.append(example["text"])
+        else:
+            texts.append(tokenizer.apply_chat_template(
+                example["messages"],
+                tokenize=False,
+                add_generation_prompt=False
+            ))
+    tokenized = tokenizer(texts, truncation=max_length is not None, max_length=max_length)
+    return {"input_ids": tokenized["input_ids"]}
+
+
+def load_tokenized(paths: Iterable[str],
+                   tokenizer,
+                   max_length: Optional[int] = None,
+                   cache_dir: str = DEFAULT_DATA_CACHE,
+                   num_proc: Optional[int] = None,
+                   dedupe: bool = True,
+                   rebuild: bool = False):
+    """
+    Tokenized, deduplicated examples from JSONL files, built once and memory-mapped from the cache.
+
+    Args:
+        paths: JSONL files, or directories searched for .jsonl files
+        tokenizer: Tokenizer of the model being trained (its chat template renders "messages")
+        max_length: Truncate examples to this many tokens (None = no truncation)
+        cache_dir: Directory holding one tokenized dataset per cache key
+        num_proc: Tokenizer worker processes (default: available cores)
+        dedupe: Drop repeated examples
+        rebuild: Tokenize again even when a cached dataset exists
+
+    Returns:
+        datasets.Dataset with an "input_ids" column, memory-mapped from cache_dir
+    """
+    from datasets import Dataset, load_from_disk
+
+    sources = find_sources(paths)
+    key = cache_key(sources, tokenizer, max_length, dedupe)
+    target = os.path.join(cache_dir, key)
+
+    if rebuild and os.path.isdir(target):
+        shutil.rmtree(target)
+    if os.path.isfile(os.path.join(target, CACHE_MANIFEST)):
+        with open(os.path.join(target, CACHE_MANIFEST), "r") as f:
+            manifest = json.load(f)
+        print(f"Using tokenized data from {target} ({manifest['examples']} examples, {manifest['tokens']} tokens)")
+        return load_from_disk(target)
+
+    print(f"Tokenizing {len(sources)} training data file(s) into {target}...")
+    started = time.perf_counter()
+    # Built next to the target and renamed into place, so an interrupted build is never reused
+    work_dir = os.path.join(cache_dir, f".build-{key}-{os.getpid()}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir)
+    try:
+        stats = {}
+        # Written to Arrow files in chunks as the generator runs, never held in memory whole
+        examples = Dataset.from_generator(
+            _example_rows,
+            gen_kwargs={"sources": sources, "dedupe": dedupe, "stats": stats},
+            cache_dir=work_dir
+        )
+        if len(examples) == 0:
+            raise ValueError(f"No training examples in {', '.join(sources)}")
+
+        workers = num_proc or available_cores()
+        workers = max(1, min(workers, len(examples) // EXAMPLES_PER_WORKER))
+        tokenized = examples.map(
+            _tokenize_batch,
+            fn_kwargs={"tokenizer": tokenizer, "max_length": max_length},
+            batched=True,
+            num_proc=workers if workers > 1 else None,
+            remove_columns=["example"],
+            desc="Tokenizing"
+        )
+        tokens = sum(len(ids) for batch in tokenized.iter(batch_size=EXAMPLES_PER_WORKER)
+                     for ids in batch["input_ids"])
+
+        staging = os.path.join(work_dir, "dataset")
+        tokenized.save_to_disk(staging)
+        manifest = {
+            "version": DATA_CACHE_VERSION,
+            "sources": sources,
+            "tokenizer": getattr(tokenizer, "name_or_path", None),
+            "max_length": max_length,
+            "dedupe": dedupe,
+            "examples": len(tokenized),
+            "duplicates": stats["duplicates"],
+            "invalid": stats["invalid"],
+            "tokens": tokens,
+            "build_seconds": round(time.perf_counter() - started, 3)
+        }
+        with open(os.path.join(staging, CACHE_MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # Another run finished the same build first
+            if not os.path.isfile(os.path.join(target, CACHE_MANIFEST)):
+                raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"Tokenized {manifest['examples']} examples ({manifest['tokens']} tokens) with {workers} process(es) "
+          f"in {manifest['build_seconds']:.1f}s; skipped {manifest['duplicates']} duplicates and "
+          f"{manifest['invalid']} invalid lines")
+    return load_from_disk(target)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokenize JSONL training data into the data cache")
+    parser.add_argument("paths", nargs="+", help="JSONL files or directories of them")
+    parser.add_argument("--model", default="microsoft/Phi-3.5-mini-instruct", help="Model whose tokenizer to use")
+    parser.add_argument("--max-length", type=int, default=256,
+                        help="Truncate examples to this many tokens; simple_train.py uses 256 (0 = no limit)")
+    parser.add_argument("--cache-dir", default=DEFAULT_DATA_CACHE, help="Directory for the tokenized data")
+    parser.add_argument("--workers", type=int, default=None, help="Tokenizer processes (default: available cores)")
+    parser.add_argument("--keep-duplicates", action="store_true", help="Do not drop repeated examples")
+    parser.add_argument("--rebuild", action="store_true", help="Tokenize again even if cached")
+    args = parser.parse_args()
+
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    try:
+        load_tokenized(
+            args.paths,
+            tokenizer,
+            max_length=args.max_length or None,
+            cache_dir=args.cache_dir,
+            num_proc=args.workers,
+            dedupe=not args.keep_duplicates,
+            rebuild=args.rebuild
+        )
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
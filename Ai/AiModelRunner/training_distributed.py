@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Multi-process CPU data-parallel training for simple_train.py.
+Launches simple_train.py under torch.distributed.run (torchrun), on this host or
+on several Linux hosts, with one process per share of the cores. Each process
+pins itself to its own cores and trains on its shard of the data (the Trainer's
+distributed sampler). Gradients are all-reduced over gloo once per optimizer
+step. DDP only all-reduces parameters that require gradients, so only the LoRA
+adapter gradients are exchanged.
+
+With --check, trains the tiny local model (tiny_model.py) in one process and
+then in --nproc processes, and compares the two loss curves.
+
+Usage:
+    python training_distributed.py --nproc 4 -- --data ./habit_data
+    python training_distributed.py --nproc 8 --nnodes 2 --node-rank 0 --master-addr 10.0.0.1 -- --data ./habit_data
+    python training_distributed.py --check --nproc 2
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+import torch
+import torch.distributed as dist
+
+from ai_model_threads import available_cpus, worker_cpus, pin_to_cpus
+
+# Found next to this file; relative --data and --output paths stay relative to the caller
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "simple_train.py")
+DEFAULT_MASTER_PORT = 29500
+# Largest relative loss difference --check accepts at any logged step
+DEFAULT_LOSS_TOLERANCE = 0.05
+# High enough for the tiny model's loss to fall visibly within a --check run
+CHECK_LEARNING_RATE = 5e-3
+
+
+def setup_distributed() -> Optional[Dict[str, int]]:
+    """
+    Join the process group when started by torchrun (WORLD_SIZE > 1).
+
+    Each process is pinned to its share of this host's cores and uses that many torch
+    threads.
+
+    Returns:
+        rank, local_rank, world_size, local_world_size and threads, or None for a single process
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    if world_size <= 1:
+        return None
+
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ.get("LOCAL_RANK", "0"))
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    cpus = available_cpus()
+    threads = max(1, len(cpus) // local_world_size)
+    pin_to_cpus(worker_cpus(local_rank, threads, cpus))
+    torch.set_num_threads(threads)
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend="gloo")
+    return {
+        "rank": rank,
+        "local_rank": local_rank,
+        "world_size": world_size,
+        "local_world_size": local_world_size,
+        "threads": threads
+    }
+
+
+def cleanup_distributed():
+    """Leave the process group, if this process joined one."""
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process() -> bool:
+    """True for rank 0, and for a process that is not part of a group."""
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def print_main(*args, **kwargs):
+    """
+    print on rank 0 only, for progress every process would repeat. Warnings and errors
+    that can differ between processes use print.
+    """
+    if is_main_process():
+        print(*args, **kwargs)
+
+
+@contextmanager
+def main_process_first():
+    """
+    Run the block in each host's first process before the others, so downloads and the
+    tokenized-data cache are written once per host and read by the rest.
+    """
+    if not dist.is_initialized():
+        yield
+        return
+    first = int(os.environ.get("LOCAL_RANK", "0")) == 0
+    if not first:
+        dist.barrier()
+    yield
+    if first:
+        dist.barrier()
+
+
+def broadcast_object(value: Any) -> Any:
+    """Rank 0's value, on every rank (e.g. an answer only rank 0 could ask for)."""
+    if not dist.is_initialized():
+        return value
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+    return values[0]
+
+
+def gradient_bytes(model) -> int:
+    """Bytes of the gradients DDP all-reduces each optimizer step (trainable parameters only)."""
+    return sum(parameter.numel() * parameter.element_size()
+               for parameter in model.parameters() if parameter.requires_grad)
+
+
+def launch_command(script_args: List[str],
+                   nproc: int,
+                   nnodes: int = 1,
+                   node_rank: int = 0,
+                   master_addr: Optional[str] = None,
+                   master_port: int = DEFAULT_MASTER_PORT,
+                   script: str = TRAIN_SCRIPT) -> List[str]:
+    """torchrun command line starting nproc processes of script on this host."""
+    command = [sys.executable, "-m", "torch.distributed.run", f"--nproc-per-node={nproc}"]
+    if nnodes > 1:
+        if not master_addr:
+            raise ValueError("--master-addr (the host of node 0) is needed with more than one node")
+        command += [f"--nnodes={nnodes}", f"--node-rank={node_rank}",
+                    f"--master-addr={master_addr}", f"--master-port={master_port}"]
+    else:
+        # A rendezvous on a free local port, so runs on one host never collide
+        command.append("--standalone")
+    return command + [script] + list(script_args)
+
+
+def launch(script_args: List[str], nproc: int, **kwargs) -> int:
+    """Run simple_train.py in nproc processes on this host; returns the exit code."""
+    command = launch_command(script_args, nproc, **kwargs)
+    env = dict(os.environ)
+    # torchrun would otherwise set 1; each process also sets its count in setup_distributed
+    env["OMP_NUM_THREADS"] = str(max(1, len(available_cpus()) // nproc))
+    print("Running: " + " ".join(command))
+    sys.stdout.flush()
+    return subprocess.call(command, env=env)
+
+
+def read_losses(path: str) -> Dict[int, float]:
+    """Training loss by step from the "log" records of a training_metrics.py file."""
+    losses = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("type") == "log" and "loss" in record:
+                losses[record["step"]] = float(record["loss"])
+    return losses
+
+
+def compare_losses(single: Dict[int, float], distributed: Dict[int, float],
+                   tolerance: float = DEFAULT_LOSS_TOLERANCE) -> Dict[str, Any]:
+    """
+    Compare two loss curves step by step.
+
+    Returns:
+        The per-step rows, the largest relative difference, and whether it is within tolerance
+    """
+    steps = sorted(set(single) & set(distributed))
+    rows = [{"step": step, "single": single[step], "distributed": distributed[step],
+             "relative_difference": abs(distributed[step] - single[step]) / max(abs(single[step]), 1e-8)}
+            for step in steps]
+    worst = max((row["relative_difference"] for row in rows), default=None)
+    return {
+        "rows": rows,
+        "max_relative_difference": worst,
+        "passed": worst is not None and worst <= tolerance
+    }
+
+
+def check(nproc: int, steps: int, tolerance: float, script_args: List[str]) -> bool:
+    """
+    Train the tiny model for steps optimizer steps in one process and in nproc processes, and
+    compare the loss curves. Both runs take EXAMPLES_PER_STEP examples per step, so the curves
+    should only differ by the order examples are drawn in.
+    """
+    directory = tempfile.mkdtemp(prefix="distributed_check_")
+    try:
+        common = ["--benchmark", "--benchmark-steps", str(steps), "--logging-steps", "1",
+                  "--learning-rate", str(CHECK_LEARNING_RATE)] + list(script_args)
+        single_file = os.path.join(directory, "single.jsonl")
+        distributed_file = os.path.join(directory, "distributed.jsonl")
+
+        print(f"\nSingle process, {steps} steps...")
+        if subprocess.call([sys.executable, TRAIN_SCRIPT] + common + ["--metrics-file", single_file]) != 0:
+            print("Single-process run failed")
+            return False
+
+        print(f"\n{nproc} processes, {steps} steps...")
+        if launch(common + ["--metrics-file", distributed_file], nproc) != 0:
+            print("Distributed run failed")
+            return False
+
+        result = compare_losses(read_losses(single_file), read_losses(distributed_file), tolerance)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print(f"\n{'step':>5} {'1 process':>10} {f'{nproc} processes':>12} {'difference':>11}")
+    for row in result["rows"]:
+        print(f"{row['step']:>5} {row['single']:>10.4f} {row['distributed']:>12.4f} "
+              f"{row['relative_difference']:>10.2%}")
+    if result["max_relative_difference"] is None:
+        print("No losses were logged")
+    else:
+        print(f"\nLargest difference {result['max_relative_difference']:.2%} "
+              f"(tolerance {tolerance:.0%}): {'PASS' if result['passed'] else 'FAIL'}")
+    return result["passed"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Train simple_train.py in several processes with gloo data parallelism",
+        epilog="Arguments after -- are passed to simple_train.py")
+    parser.add_argument("--nproc", type=int, default=2,
+                        help="Processes on this host; each gets an equal share of its cores")
+    parser.add_argument("--nnodes", type=int, default=1, help="Hosts taking part (run this on each one)")
+    parser.add_argument("--node-rank", type=int, default=0, help="This host's index, 0 to --nnodes - 1")
+    parser.add_argument("--master-addr", default=None, help="Address of the --node-rank 0 host")
+    parser.add_argument("--master-port", type=int, default=DEFAULT_MASTER_PORT, help="Port on the --node-rank 0 host")
+    parser.add_argument("--check", action="store_true",
+                        help="Compare the loss curve of --nproc processes with one process on the tiny model")
+    parser.add_argument("--check-steps", type=int, default=30, help="Optimizer steps in each --check run")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_LOSS_TOLERANCE,
+                        help="Largest relative loss difference --check accepts")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    script_args = args.script_args[1:] if args.script_args[:1] == ["--"] else args.script_args
+
+    if args.nproc < 1:
+        parser.error("--nproc must be at least 1")
+    if args.check:
+        sys.exit(0 if check(args.nproc, args.check_steps, args.tolerance, script_args) else 1)
+    try:
+        code = launch(script_args, args.nproc, nnodes=args.nnodes, node_rank=args.node_rank,
+                      master_addr=args.master_addr, master_port=args.master_port)
+    except ValueError as e:
+        parser.error(str(e))
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
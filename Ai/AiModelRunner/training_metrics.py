@@ -0,0 +1,211 @@
+"""
+Training throughput and memory instrumentation.
+TrainingMetricsCallback times every optimizer step: wall time, time spent
+waiting for the data loader, time in optimizer.step(), tokens and examples
+(samples) per second, and the process's peak RSS. It appends one JSON line per step to a
+metrics file, followed by the Trainer's log entries and a summary at the end.
+Used by simple_train.py (also in its --benchmark mode) and qlora_train.py.
+
+Records have a "type": "step", "log" or "summary". Steps before warmup_steps
+are written but left out of the summary, so one-off costs such as worker
+start-up and lazy allocations do not skew it.
+"""
+
+import os
+import json
+import time
+import statistics
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from transformers import TrainerCallback
+
+from ai_model_metrics import resident_memory_bytes, peak_resident_memory_bytes
+
+DEFAULT_METRICS_FILE = "training_metrics.jsonl"
+
+
+def _mb(value: Optional[int]) -> Optional[float]:
+    return round(value / (1024 * 1024), 1) if value is not None else None
+
+
+class TrainingMetricsCallback(TrainerCallback):
+    """Per-step throughput, data-loader wait, optimizer time and memory of a Trainer run."""
+
+    def __init__(self,
+                 output_path: Optional[str] = None,
+                 warmup_steps: int = 1,
+                 run_info: Optional[Dict[str, Any]] = None,
+                 count_examples: Optional[Callable[[Dict[str, Any]], int]] = None):
+        """
+        Initialize the callback.
+
+        Args:
+            output_path: JSONL file for the records (None = keep them in memory only)
+            warmup_steps: Leading steps left out of the summary
+            run_info: Configuration copied into the summary (model, packing mode, ...)
+            count_examples: Examples in one batch of model inputs, for rows holding several
+                (packed rows); None counts one example per row
+        """
+        self.output_path = output_path
+        self.warmup_steps = warmup_steps
+        self.run_info = dict(run_info or {})
+        self.count_examples = count_examples
+        self.steps: List[Dict[str, Any]] = []
+
+        self._file = None
+        # End of the last step, log, evaluation or save; the data loader runs from here
+        # until the next step begins (transformers 5 fetches a step's batches up front)
+        self._mark = None
+        self._step_started = None
+        self._data_wait = 0.0
+        self._optimizer_started = None
+        self._optimizer_seconds = 0.0
+        self._tokens_at_start = 0
+        # Examples in the training forward passes of the current step, from count_examples
+        self._examples = 0
+        self._hook = None
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        # Needed for tokens/sec; non-padding tokens where the Trainer can tell them apart
+        if getattr(args, "include_num_input_tokens_seen", None) in (False, "no"):
+            counting = args.include_num_input_tokens_seen
+            args.include_num_input_tokens_seen = "non_padding" if isinstance(counting, str) else True
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if self.output_path and state.is_world_process_zero:
+            directory = os.path.dirname(self.output_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.output_path, "w", encoding="utf-8")
+        model = kwargs.get("model")
+        if self.count_examples is not None and model is not None:
+            # Counted as batches reach the model: the data loader fetches ahead of the step
+            self._hook = model.register_forward_pre_hook(self._count_inputs, with_kwargs=True)
+        self._mark = time.perf_counter()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self._mark = time.perf_counter()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        self._data_wait = now - self._mark if self._mark is not None else 0.0
+        self._step_started = now
+        self._optimizer_seconds = 0.0
+        self._tokens_at_start = state.num_input_tokens_seen
+        self._examples = 0
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._optimizer_started = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        if self._optimizer_started is not None:
+            self._optimizer_seconds += time.perf_counter() - self._optimizer_started
+            self._optimizer_started = None
+
+    def on_step_end(self, args, state, control, **kwargs):
+        now = time.perf_counter()
+        if self._step_started is None:
+            return
+        compute = now - self._step_started
+        wall = self._data_wait + compute
+        tokens = state.num_input_tokens_seen - self._tokens_at_start
+        rss = resident_memory_bytes()
+        # getrusage's peak can lag a fresh /proc reading
+        peak = max((value for value in (rss, peak_resident_memory_bytes()) if value is not None), default=None)
+        if self._hook is not None:
+            # Each process gets an even shard, so this process's count stands for all of them
+            samples = self._examples * args.world_size
+        else:
+            # Nominal: a short last step of an epoch is counted as full
+            samples = args.per_device_train_batch_size * args.gradient_accumulation_steps * args.world_size
+        record = {
+            "type": "step",
+            "step": state.global_step,
+            "epoch": round(state.epoch or 0.0, 4),
+            "wall_seconds": round(wall, 6),
+            "compute_seconds": round(compute, 6),
+            "data_wait_seconds": round(self._data_wait, 6),
+            "optimizer_seconds": round(self._optimizer_seconds, 6),
+            "tokens": tokens,
+            "tokens_per_second": round(tokens / wall, 1) if wall > 0 else None,
+            "samples": samples,
+            "samples_per_second": round(samples / wall, 2) if wall > 0 else None,
+            "rss_mb": _mb(rss),
+            "peak_rss_mb": _mb(peak)
+        }
+        if torch.cuda.is_available():
+            record["peak_cuda_mb"] = _mb(torch.cuda.max_memory_allocated())
+        self.steps.append(record)
+        self._write(record)
+        self._step_started = None
+        self._mark = time.perf_counter()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        self._write(dict({"type": "log", "step": state.global_step}, **(logs or {})))
+        self._mark = time.perf_counter()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._mark = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._mark = time.perf_counter()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self._hook is not None:
+            self._hook.remove()
+            self._hook = None
+        self._write(self.summary())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary(self) -> Dict[str, Any]:
+        """Throughput and memory over the steps after warmup (all steps if there are no more)."""
+        steps = self.steps[self.warmup_steps:] or self.steps
+        summary = dict({"type": "summary"}, **self.run_info)
+        summary.update({"steps": len(steps), "warmup_steps": len(self.steps) - len(steps)})
+        if not steps:
+            return summary
+
+        wall = sum(step["wall_seconds"] for step in steps)
+        summary.update({
+            "step_seconds_p50": round(statistics.median(step["wall_seconds"] for step in steps), 6),
+            "step_seconds_mean": round(wall / len(steps), 6),
+            "tokens_per_second": round(sum(step["tokens"] for step in steps) / wall, 1) if wall > 0 else None,
+            "samples_per_second": round(sum(step["samples"] for step in steps) / wall, 2) if wall > 0 else None,
+            "data_wait_fraction": round(sum(step["data_wait_seconds"] for step in steps) / wall, 4) if wall > 0 else None,
+            "optimizer_seconds_mean": round(statistics.mean(step["optimizer_seconds"] for step in steps), 6),
+            "peak_rss_mb": max((step["peak_rss_mb"] for step in steps if step["peak_rss_mb"] is not None), default=None)
+        })
+        if "peak_cuda_mb" in steps[-1]:
+            summary["peak_cuda_mb"] = max(step["peak_cuda_mb"] for step in steps)
+        return summary
+
+    def _count_inputs(self, module, args, kwargs):
+        # Evaluation runs the model too
+        if module.training:
+            self._examples += self.count_examples(kwargs)
+
+    def _write(self, record: Dict[str, Any]):
+        if self._file is not None:
+            self._file.write(json.dumps(record, default=str) + "\n")
+            self._file.flush()
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    """Human-readable lines for a summary record."""
+    if not summary.get("steps"):
+        return "No training steps were recorded"
+    lines = [f"Steps measured:     {summary['steps']} (after {summary['warmup_steps']} warmup)",
+             f"Step time:          p50 {summary['step_seconds_p50'] * 1000:.1f} ms, "
+             f"mean {summary['step_seconds_mean'] * 1000:.1f} ms",
+             f"Tokens/sec:         {summary['tokens_per_second'] or 0:.1f}",
+             f"Samples/sec:        {summary['samples_per_second'] or 0:.2f}",
+             f"Data-loader wait:   {(summary['data_wait_fraction'] or 0):.1%} of step time",
+             f"Optimizer step:     {summary['optimizer_seconds_mean'] * 1000:.1f} ms"]
+    if summary.get("peak_rss_mb") is not None:
+        lines.append(f"Peak RSS:           {summary['peak_rss_mb']:.0f} MB")
+    if summary.get("peak_cuda_mb") is not None:
+        lines.append(f"Peak CUDA memory:   {summary['peak_cuda_mb']:.0f} MB")
+    return "\n".join(lines)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Tune CPU thread counts and batch size for this machine.
+Benchmarks AiModelCore for each candidate intra-op thread count and batch size,
+picks the fastest combination and writes it to ./thread_config.json, which
+AiModelCore and ai_model_server.py load at startup.
+
+With --workers N the tuner measures one worker's share of the cores (pinned
+to them where supported), so the result fits `ai_model_server.py --workers N`.
+
+Usage:
+    python tune_threads.py
+    python tune_threads.py --workers 4 --pin-workers
+    python tune_threads.py --stub --threads 1 2 4 --batch-sizes 1 8
+"""
+
+import sys
+import argparse
+from typing import Any, Dict, List
+
+import torch
+
+from ai_model_core import AiModelCore, PRECISIONS
+from ai_model_threads import (
+    DEFAULT_THREAD_CONFIG,
+    available_cpus,
+    apply_thread_settings,
+    save_thread_config,
+    worker_cpus,
+    pin_to_cpus
+)
+from benchmark import bench_single, bench_batch
+
+OBJECTIVES = ("throughput", "latency")
+
+
+def candidate_threads(cores: int) -> List[int]:
+    """Powers of two up to cores, plus cores itself."""
+    counts = []
+    count = 1
+    while count < cores:
+        counts.append(count)
+        count *= 2
+    counts.append(cores)
+    return counts
+
+
+def tune(model_core: AiModelCore, thread_counts: List[int], batch_sizes: List[int],
+         max_new_tokens: int, repeats: int) -> List[Dict[str, Any]]:
+    """Single-prompt latency and batched throughput for every thread count."""
+    runs = []
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        single = bench_single(model_core, repeats, max_new_tokens)
+        batches = [bench_batch(model_core, batch_size, repeats, max_new_tokens) for batch_size in batch_sizes]
+        best = max(batches, key=lambda run: run["tokens_per_second"])
+        runs.append({
+            "threads": threads,
+            "latency_p50": single["latency_p50"],
+            "batch": batches,
+            "best_batch_size": best["batch_size"],
+            "best_tokens_per_second": best["tokens_per_second"]
+        })
+        print(f"  threads {threads:>3}: p50 {single['latency_p50'] * 1000:8.1f} ms, "
+              f"best {best['tokens_per_second']:9.1f} tokens/s at batch {best['batch_size']}")
+        sys.stdout.flush()
+    return runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune CPU thread counts and batch size for inference")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Server workers the cores will be split between")
+    parser.add_argument("--threads", type=int, nargs="+", default=None,
+                        help="Intra-op thread counts to try (default: powers of two up to each worker's cores)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--inter-op-threads", type=int, default=1,
+                        help="Inter-op threads to record (generation does not use the inter-op pool)")
+    parser.add_argument("--objective", choices=OBJECTIVES, default="throughput",
+                        help="Pick the thread count with the most batched tokens/s or the lowest single-prompt latency")
+    parser.add_argument("--pin-workers", action="store_true",
+                        help="Record that server workers should be pinned to their own cores")
+    parser.add_argument("--max-new-tokens", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=DEFAULT_THREAD_CONFIG, help="Where to write the config")
+    parser.add_argument("--stub", action="store_true",
+                        help="Tune on the tiny random stand-in model (tiny_model.py), e.g. to try the tuner")
+    parser.add_argument("--model", default=None, help="Model name or path")
+    parser.add_argument("--adapter", default=None, help="Path to LoRA adapters")
+    parser.add_argument("--merge-adapters", action="store_true", help="Merge adapters at load time")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float32")
+    args = parser.parse_args()
+
+    # Counted before pinning: the saved cpu_count is checked against the unpinned server
+    cpus = available_cpus()
+    cores_per_worker = max(1, len(cpus) // args.workers)
+    if args.workers > 1 and pin_to_cpus(worker_cpus(0, cores_per_worker, cpus)):
+        print(f"Measuring on cpus {worker_cpus(0, cores_per_worker, cpus)} (one of {args.workers} workers)")
+    thread_counts = sorted(set(args.threads or candidate_threads(cores_per_worker)))
+
+    model_options = {"merge_adapters": args.merge_adapters, "precision": args.precision,
+                     "thread_config": None, "stop_sequences": ()}
+    if args.model:
+        model_options["model_name"] = args.model
+    if args.adapter:
+        model_options["adapter_path"] = args.adapter
+    if args.stub:
+        from tiny_model import build_tiny_model
+
+        tiny = build_tiny_model()
+        model_options["model_name"] = tiny["model_path"]
+        model_options["adapter_path"] = tiny["adapter_path"] or "./no_adapter"
+        model_options["snapshot_dir"] = None
+
+    # Before the model runs, while the inter-op pool can still be sized
+    apply_thread_settings(None, args.inter_op_threads)
+    model_core = AiModelCore(**model_options)
+
+    print(f"\nTuning {model_core.model_name} ({args.precision}) on {len(cpus)} cores, "
+          f"{cores_per_worker} per worker...")
+    runs = tune(model_core, thread_counts, args.batch_sizes, args.max_new_tokens, args.repeats)
+
+    if args.objective == "latency":
+        best = min(runs, key=lambda run: run["latency_p50"])
+    else:
+        best = max(runs, key=lambda run: run["best_tokens_per_second"])
+
+    save_thread_config({
+        "workers": args.workers,
+        "intra_op_threads": best["threads"],
+        "inter_op_threads": args.inter_op_threads,
+        "max_batch_size": best["best_batch_size"],
+        "pin_workers": args.pin_workers,
+        "objective": args.objective,
+        "model": model_core.model_name,
+        "precision": args.precision,
+        "max_new_tokens": args.max_new_tokens,
+        "runs": runs
+    }, args.output, cpu_count=len(cpus))
+
+    default = next((run for run in runs if run["threads"] == cores_per_worker), None)
+    print(f"\n✅ {best['threads']} intra-op threads, batch size {best['best_batch_size']} "
+          f"({best['best_tokens_per_second']:.1f} tokens/s, p50 {best['latency_p50'] * 1000:.1f} ms)")
+    if default is not None and default is not best:
+        print(f"   vs all {cores_per_worker} cores: {default['best_tokens_per_second']:.1f} tokens/s, "
+              f"p50 {default['latency_p50'] * 1000:.1f} ms")
+    print(f"   Written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
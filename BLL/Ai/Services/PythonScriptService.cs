@@ -1,6 +1,8 @@
 ﻿using Shared.Interfaces;
+using System.Collections.Concurrent;
 using System.Diagnostics;
 using System.Text;
+using System.Text.Json;
 using Shared;
 
 namespace BLL.Ai.Services
@@ -13,6 +15,20 @@ namespace BLL.Ai.Services
         private StreamReader _reader;
         private StreamReader _errorReader;
 
+        // Pipelined protocol (see ai_model_protocol.py): requests carry ids and are answered out of order
+        private const int ProtocolVersion = 1;
+        private readonly ConcurrentDictionary<string, TaskCompletionSource<string>> _pendingRequests = new();
+        private readonly SemaphoreSlim _writeLock = new(1, 1);
+        // Cancelled on Dispose so writers still queued on _writeLock give up before it is disposed
+        private readonly CancellationTokenSource _shutdown = new();
+        private Task? _responseLoop;
+        private long _nextRequestId;
+        private bool _pipelined;
+        private volatile bool _disposed;
+
+        // Python waits up to 10 seconds for in-flight requests after "exit"
+        private static readonly TimeSpan ExitTimeout = TimeSpan.FromSeconds(15);
+
         private string modelName = "mistral:7b";
         private string prompt = Constants.HABIT_TO_TRACK_PROMPT;
 
@@ -69,9 +85,12 @@ namespace BLL.Ai.Services
 
         public async Task<string> SendInputAsync(string input)
         {
-            if (_process == null || _process.HasExited)
+            EnsureRunning();
+
+            // Once pipelined, the response loop owns stdout; plain input becomes a prompt request
+            if (_pipelined)
             {
-                throw new InvalidOperationException("Python process is not running.");
+                return await SendRequestAsync(input);
             }
 
             await _writer.WriteLineAsync(input);
@@ -82,6 +101,68 @@ namespace BLL.Ai.Services
             return line;
         }
 
+        public async Task EnablePipeliningAsync()
+        {
+            EnsureRunning();
+
+            if (_pipelined)
+            {
+                return;
+            }
+
+            await _writer.WriteLineAsync(JsonSerializer.Serialize(new { protocol = ProtocolVersion }));
+            await _writer.FlushAsync();
+
+            var line = await _reader.ReadLineAsync();
+            using (var hello = JsonDocument.Parse(line ?? "{}"))
+            {
+                if (!hello.RootElement.TryGetProperty("protocol", out var version) || version.GetInt32() != ProtocolVersion)
+                {
+                    throw new InvalidOperationException($"Python script does not support protocol version {ProtocolVersion}: {line}");
+                }
+            }
+
+            _pipelined = true;
+            _responseLoop = Task.Run(ReadResponsesAsync);
+        }
+
+        public async Task<string> SendRequestAsync(string prompt, object? parameters = null, CancellationToken cancellationToken = default)
+        {
+            EnsureRunning();
+
+            if (!_pipelined)
+            {
+                throw new InvalidOperationException("Call EnablePipeliningAsync before sending pipelined requests.");
+            }
+
+            var id = Interlocked.Increment(ref _nextRequestId).ToString();
+            var completion = new TaskCompletionSource<string>(TaskCreationOptions.RunContinuationsAsynchronously);
+            _pendingRequests[id] = completion;
+
+            var request = JsonSerializer.Serialize(new
+            {
+                id,
+                prompt,
+                @params = parameters ?? new { }
+            });
+
+            try
+            {
+                await WriteLineAsync(request, cancellationToken);
+            }
+            catch
+            {
+                _pendingRequests.TryRemove(id, out _);
+                throw;
+            }
+
+            // Cancelling asks Python to drop the request; it answers with a "cancelled" error
+            using (cancellationToken.Register(() => _ = CancelRequestAsync(id)))
+            {
+                return await completion.Task;
+            }
+        }
+
         public void Stop()
         {
             Dispose();
@@ -89,23 +170,190 @@ namespace BLL.Ai.Services
 
         public void Dispose()
         {
+            if (_disposed)
+            {
+                return;
+            }
+            _disposed = true;
+
             if (_process != null && !_process.HasExited)
             {
-                _writer.WriteLine("exit");
-                _writer.Flush();
-                _process.WaitForExit();
+                // Taken so "exit" cannot interleave with a pipelined request being written
+                var locked = _writeLock.Wait(ExitTimeout);
+                try
+                {
+                    if (locked)
+                    {
+                        _writer.WriteLine("exit");
+                        _writer.Flush();
+                    }
+                }
+                catch (IOException)
+                {
+                    // Python already closed stdin
+                }
+                finally
+                {
+                    // Nothing may be written after "exit"; queued writers fail instead
+                    _shutdown.Cancel();
+                    if (locked)
+                    {
+                        _writeLock.Release();
+                    }
+                }
+
+                if (!_process.WaitForExit((int)ExitTimeout.TotalMilliseconds))
+                {
+                    try
+                    {
+                        _process.Kill(entireProcessTree: true);
+                    }
+                    catch (InvalidOperationException)
+                    {
+                        // Exited in the meantime
+                    }
+                }
+            }
+            else
+            {
+                _shutdown.Cancel();
             }
 
+            // Python answers everything in flight before exiting; let the loop drain it
+            _responseLoop?.Wait(TimeSpan.FromSeconds(5));
+            FailPendingRequests();
+
             _writer?.Dispose();
             _reader?.Dispose();
             _errorReader?.Dispose();
             _process?.Dispose();
+            _writeLock.Dispose();
+            _shutdown.Dispose();
         }
 
         #endregion
 
         #region Private Methods
 
+        private void EnsureRunning()
+        {
+            if (_disposed)
+            {
+                throw new ObjectDisposedException(nameof(PythonScriptService));
+            }
+
+            if (_process == null || _process.HasExited)
+            {
+                throw new InvalidOperationException("Python process is not running.");
+            }
+        }
+
+        private async Task WriteLineAsync(string line, CancellationToken cancellationToken = default)
+        {
+            using var waitCancellation = CancellationTokenSource.CreateLinkedTokenSource(cancellationToken, _shutdown.Token);
+            await _writeLock.WaitAsync(waitCancellation.Token);
+            try
+            {
+                await _writer.WriteLineAsync(line);
+                await _writer.FlushAsync();
+            }
+            finally
+            {
+                _writeLock.Release();
+            }
+        }
+
+        private async Task CancelRequestAsync(string id)
+        {
+            try
+            {
+                await WriteLineAsync(JsonSerializer.Serialize(new { type = "cancel", id }));
+            }
+            catch (Exception)
+            {
+                // Process already gone; the response loop fails the request
+            }
+        }
+
+        private async Task ReadResponsesAsync()
+        {
+            try
+            {
+                string? line;
+                while ((line = await _reader.ReadLineAsync()) != null)
+                {
+                    CompleteRequest(line);
+                }
+            }
+            catch (Exception)
+            {
+                // Reader closed during shutdown
+            }
+            finally
+            {
+                FailPendingRequests();
+            }
+        }
+
+        private void FailPendingRequests()
+        {
+            foreach (var id in _pendingRequests.Keys)
+            {
+                if (_pendingRequests.TryRemove(id, out var completion))
+                {
+                    completion.TrySetException(new InvalidOperationException("Python process exited."));
+                }
+            }
+        }
+
+        private void CompleteRequest(string line)
+        {
+            JsonDocument document;
+            try
+            {
+                document = JsonDocument.Parse(line);
+            }
+            catch (JsonException)
+            {
+                return;
+            }
+
+            using (document)
+            {
+                var root = document.RootElement;
+
+                // Replies without an id (exit acknowledgement, malformed requests) belong to no caller
+                if (root.ValueKind != JsonValueKind.Object ||
+                    !root.TryGetProperty("id", out var idElement) ||
+                    idElement.ValueKind == JsonValueKind.Null ||
+                    !_pendingRequests.TryRemove(idElement.ToString(), out var completion))
+                {
+                    return;
+                }
+
+                if (root.TryGetProperty("status", out var status) && status.GetString() == "success")
+                {
+                    completion.TrySetResult(root.GetProperty("response").GetString() ?? string.Empty);
+                    return;
+                }
+
+                var error = root.TryGetProperty("error", out var errorElement) ? errorElement.GetString() : line;
+                var code = root.TryGetProperty("code", out var codeElement) ? codeElement.GetString() : null;
+                switch (code)
+                {
+                    case "cancelled":
+                        completion.TrySetCanceled();
+                        break;
+                    case "deadline_exceeded":
+                        completion.TrySetException(new TimeoutException(error));
+                        break;
+                    default:
+                        completion.TrySetException(new InvalidOperationException(error));
+                        break;
+                }
+            }
+        }
+
         private async Task WaitForReadinessAsync()
         {
             var isReady = false;
@@ -1,4 +1,5 @@
-﻿using System.Threading.Tasks;
+﻿using System.Threading;
+using System.Threading.Tasks;
 
 namespace Shared.Interfaces
 {
@@ -6,6 +7,8 @@ namespace Shared.Interfaces
     {
         Task StartAsync();
         Task<string> SendInputAsync(string input);
+        Task EnablePipeliningAsync();
+        Task<string> SendRequestAsync(string prompt, object? parameters = null, CancellationToken cancellationToken = default);
         void Stop();
     }
 }
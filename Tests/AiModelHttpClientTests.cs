@@ -1,5 +1,7 @@
 using BLL.Ai.Clients.PythonAi;
 using System.Diagnostics;
+using System.Net;
+using System.Net.Http.Json;
 using Xunit;
 using Xunit.Abstractions;
 
@@ -177,6 +179,24 @@ namespace Tests
             _output.WriteLine($"Habits from prompt: {response}");
         }
 
+        [Fact]
+        public async Task Chat_ShouldRejectInvalidParameters_WithoutFailingConcurrentRequest()
+        {
+            // Arrange: sent together so they would share a decode batch
+            var valid = _httpClient.PostAsJsonAsync("http://localhost:5000/chat",
+                new { message = "Suggest a habit for exercise" });
+            var invalid = _httpClient.PostAsJsonAsync("http://localhost:5000/chat",
+                new { message = "Suggest a habit for reading", temperature = "hot", max_new_tokens = "x" });
+
+            // Act
+            var responses = await Task.WhenAll(valid, invalid);
+
+            // Assert
+            Assert.Equal(HttpStatusCode.OK, responses[0].StatusCode);
+            Assert.Equal(HttpStatusCode.BadRequest, responses[1].StatusCode);
+            _output.WriteLine($"Rejected: {await responses[1].Content.ReadAsStringAsync()}");
+        }
+
         public void Dispose()
         {
             _httpClient?.Dispose();
@@ -130,6 +130,33 @@ namespace Tests
             }
         }
 
+        [Fact]
+        public async Task TestPipelinedRequests()
+        {
+            // Switch to the pipelined protocol and send several requests without waiting for each answer
+            await _scriptService.EnablePipeliningAsync();
+
+            var prompts = new[]
+            {
+                "Suggest a morning habit",
+                "Suggest an evening habit",
+                "Suggest a weekend habit",
+                Constants.HABIT_TO_TRACK_PROMPT
+            };
+
+            var requests = prompts
+                .Select(prompt => _scriptService.SendRequestAsync(prompt, new { max_new_tokens = 15 }))
+                .ToList();
+            var responses = await Task.WhenAll(requests);
+
+            Assert.Equal(prompts.Length, responses.Length);
+            foreach (var response in responses)
+            {
+                Assert.NotNull(response);
+                Assert.True(response.Length > 0);
+            }
+        }
+
         public void Dispose()
         {
             Dispose(true);